@@ -1,7 +1,12 @@
 import os
 import cv2
+import time
 import argparse
+import functools
+import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from page_store import PageStoreWriter
 
 def grayscale(image):
     """
@@ -32,6 +37,52 @@ def binarize_image(gray_image, threshold=160, max_value=230):
     return binary_image
 
 
+def binarize_otsu(gray_image, max_value=230):
+    """
+    Applies binary thresholding with a threshold chosen per image by Otsu's method.
+
+    Parameters:
+        gray_image (numpy.ndarray): Grayscale image.
+        max_value (int): Maximum pixel value to use with the THRESH_BINARY thresholding.
+
+    Returns:
+        numpy.ndarray: Binarized (black-and-white) image.
+    """
+    _, binary_image = cv2.threshold(gray_image, 0, max_value, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return binary_image
+
+
+def binarize_sauvola(gray_image, window_size=31, k=0.2, max_value=230, dynamic_range=128):
+    """
+    Applies Sauvola's local thresholding, which follows uneven brightness within a page.
+
+    The threshold of every pixel is `mean * (1 + k * (std / dynamic_range - 1))` of the window around it. The local
+    mean and standard deviation are computed from integral images, so the cost does not depend on the window size.
+
+    Parameters:
+        gray_image (numpy.ndarray): Grayscale image.
+        window_size (int): Size of the (odd) square window around each pixel.
+        k (float): Sensitivity to the local contrast.
+        max_value (int): Pixel value of the background in the binarized image.
+        dynamic_range (float): Dynamic range of the standard deviation.
+
+    Returns:
+        numpy.ndarray: Binarized (black-and-white) image.
+    """
+    radius = window_size // 2
+    padded = cv2.copyMakeBorder(gray_image, radius, radius, radius, radius, cv2.BORDER_REFLECT)
+    sums, square_sums = cv2.integral2(padded, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+    size = 2 * radius + 1
+    def window(integral):
+        return integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+
+    mean = window(sums) / size ** 2
+    std = np.sqrt(np.maximum(window(square_sums) / size ** 2 - mean ** 2, 0))
+    threshold = mean * (1 + k * (std / dynamic_range - 1))
+    return np.where(gray_image > threshold, max_value, 0).astype(np.uint8)
+
+
 def crop_image(image, crop_fraction=0.05):
     """
     Crops an image by removing a certain fraction from each edge.
@@ -49,26 +100,145 @@ def crop_image(image, crop_fraction=0.05):
     return image[top:bottom, left:right]
 
 
-def process_image(img_path, output_dir, threshold=160, crop=0):
+def edge_length(fraction, edge_fraction):
+    # Number of leading rows or columns that are mostly dark, i.e. the dark edge of the scan
+    light = np.flatnonzero(fraction <= edge_fraction)
+    return light[0] if len(light) else len(fraction)
+
+
+def find_text_area(binary_image, min_fraction=0.005, edge_fraction=0.2, margin=10):
+    """
+    Finds the text area of a binarized page from the projection profiles of its dark pixels.
+
+    The dark edges of the scan, i.e. the rows and columns at the sides of the page in which more than `edge_fraction`
+    of the pixels are dark, are removed first. Within the rest of the page, rows and columns with fewer than
+    `min_fraction` dark pixels are empty, and the text area spans from the first to the last row and column with text.
+
+    Parameters:
+        binary_image (numpy.ndarray): Binarized image.
+        min_fraction (float): Fraction of dark pixels below which a row or column is considered empty.
+        edge_fraction (float): Fraction of dark pixels above which a row or column at the side is considered a scan edge.
+        margin (int): Number of pixels kept around the text area.
+
+    Returns:
+        tuple: The top, bottom, left and right bounds of the text area, or the whole image if no text is found.
+    """
+    height, width = binary_image.shape[:2]
+    dark = binary_image == 0
+
+    row_fraction, column_fraction = dark.mean(axis=1), dark.mean(axis=0)
+    top, bottom = edge_length(row_fraction, edge_fraction), height - edge_length(row_fraction[::-1], edge_fraction)
+    left, right = edge_length(column_fraction, edge_fraction), width - edge_length(column_fraction[::-1], edge_fraction)
+    if top >= bottom or left >= right:
+        return 0, height, 0, width
+
+    inner = dark[top:bottom, left:right]
+    text_rows = np.flatnonzero(inner.mean(axis=1) >= min_fraction)
+    text_columns = np.flatnonzero(inner.mean(axis=0) >= min_fraction)
+    if len(text_rows) == 0 or len(text_columns) == 0:
+        return 0, height, 0, width
+
+    return (
+        int(max(top + text_rows[0] - margin, 0)), int(min(top + text_rows[-1] + 1 + margin, height)),
+        int(max(left + text_columns[0] - margin, 0)), int(min(left + text_columns[-1] + 1 + margin, width)),
+    )
+
+
+def auto_crop_image(binary_image, margin=10):
+    """
+    Crops a binarized image to its text area, see `find_text_area`.
+
+    Parameters:
+        binary_image (numpy.ndarray): Binarized image.
+        margin (int): Number of pixels kept around the text area.
+
+    Returns:
+        numpy.ndarray: Cropped image.
+    """
+    top, bottom, left, right = find_text_area(binary_image, margin=margin)
+    return binary_image[top:bottom, left:right]
+
+
+METHODS = ("global", "otsu", "sauvola")
+
+
+def binarize(gray_image, threshold=160, crop=0, method="global", auto_crop=False):
+    """
+    Binarizes and crops a grayscale page with the chosen thresholding method.
+
+    Parameters:
+        gray_image (numpy.ndarray): Grayscale image.
+        threshold (int): Threshold value for the global method.
+        crop (float): Fraction of the image dimensions to crop from each side.
+        method (str): 'global' for a fixed threshold, 'otsu' for a threshold per image, or 'sauvola' for a threshold per pixel.
+        auto_crop (bool): Whether to crop the image to its text area after the fixed crop.
+
+    Returns:
+        numpy.ndarray: Binarized and cropped image.
+    """
+    if method == "otsu":
+        binary_image = binarize_otsu(gray_image)
+    elif method == "sauvola":
+        binary_image = binarize_sauvola(gray_image)
+    else:
+        binary_image = binarize_image(gray_image, threshold)
+    cropped_image = crop_image(binary_image, crop)
+    return auto_crop_image(cropped_image) if auto_crop else cropped_image
+
+
+def preprocess_image(img_path, threshold=160, crop=0, method="global", auto_crop=False):
     image = cv2.imread(img_path)
-    img_name = os.path.splitext(os.path.basename(img_path))[0]
     gray_image = grayscale(image)
-    binary_image = binarize_image(gray_image, threshold)
-    cropped_image = crop_image(binary_image, crop)
+    return binarize(gray_image, threshold, crop, method, auto_crop)
+
+
+def process_image(img_path, output_dir, threshold=160, crop=0, method="global", auto_crop=False):
+    img_name = os.path.splitext(os.path.basename(img_path))[0]
+    cropped_image = preprocess_image(img_path, threshold, crop, method, auto_crop)
         
     output_file_path = os.path.join(output_dir, f"binarized_{img_name}.jpg")
     cv2.imwrite(output_file_path, cropped_image)
 
 
-def process_directory(input_path, output_dir, threshold=160, crop=0):
+def map_images(function, image_files, threads=1):
+    # Yields the results of `function` for every image in order. OpenCV and NumPy release the GIL while they work on an
+    # image, so threads process several images at the same time.
+    if threads <= 1:
+        yield from map(function, image_files)
+        return
+
+    with ThreadPoolExecutor(threads) as executor:
+        yield from executor.map(function, image_files)
+
+
+def store_images(image_files, store_path, threshold=160, crop=0, method="global", auto_crop=False, threads=1):
+    # Writes the binarized images bit-packed into a single page store instead of one JPG per image
+    preprocess = functools.partial(preprocess_image, threshold=threshold, crop=crop, method=method, auto_crop=auto_crop)
+    with PageStoreWriter(store_path) as store:
+        for img_path, image in tqdm(zip(image_files, map_images(preprocess, image_files, threads)), total=len(image_files), desc="Processing images"):
+            img_name = os.path.splitext(os.path.basename(img_path))[0]
+            store.add(f"binarized_{img_name}", image)
+    print(f"Saved {len(image_files)} pages to {store_path}")
+
+
+def process_directory(input_path, output_dir, threshold=160, crop=0, store=False, method="global", auto_crop=False, threads=1):
     image_files = []
     for root, _, files in os.walk(input_path):
         for file in files:
             if file.lower().endswith(".jpg"):
                 image_files.append(os.path.join(root, file))
 
-    for img_path in tqdm(image_files, desc="Processing images"):
-        process_image(img_path, output_dir, threshold, crop)
+    start_time = time.perf_counter()
+    if store:
+        store_path = os.path.join(output_dir, os.path.basename(os.path.normpath(input_path)) + ".pages")
+        store_images(sorted(image_files), store_path, threshold, crop, method, auto_crop, threads)
+    else:
+        process = functools.partial(process_image, output_dir=output_dir, threshold=threshold, crop=crop, method=method, auto_crop=auto_crop)
+        for _ in tqdm(map_images(process, image_files, threads), total=len(image_files), desc="Processing images"):
+            pass
+    elapsed = time.perf_counter() - start_time
+    if image_files:
+        print(f"Binarized {len(image_files)} images in {elapsed:.1f} s ({len(image_files) / elapsed:.1f} images/s) with {threads} threads ({method})")
 
 
 def main():
@@ -77,6 +247,10 @@ def main():
     parser.add_argument("-o", "--output", type=str, help="Path to the output directory. Default: 'binarized_images' in the current working directory.", default="./binarized_images")
     parser.add_argument("-t", "--threshold", type=int, help="Threshold value for binarization.", default=160)
     parser.add_argument("-c", "--crop", type=float, help="Fraction of the image dimensions to crop from each side.", default=0.0)
+    parser.add_argument("-m", "--method", type=str, choices=METHODS, help="Thresholding method: 'global' uses --threshold, 'otsu' chooses a threshold per image, 'sauvola' a threshold per pixel from its neighbourhood. Default: global", default="global")
+    parser.add_argument("-a", "--auto_crop", action="store_true", help="Crop every image to its text area, found from the rows and columns that contain dark pixels.")
+    parser.add_argument("-n", "--threads", type=int, help="Number of images to process in parallel. Default: 1", default=1)
+    parser.add_argument("-s", "--store", action="store_true", help="Save the binarized images of a directory bit-packed in a single '<directory name>.pages' file instead of one JPG per image.")
 
     args = parser.parse_args()
 
@@ -94,11 +268,11 @@ def main():
     if os.path.isfile(input_path):
         # Single PDF file
         print(f"Processing single file: {input_path}")
-        process_image(input_path, output_dir, args.threshold, args.crop)
+        process_image(input_path, output_dir, args.threshold, args.crop, args.method, args.auto_crop)
     elif os.path.isdir(input_path):
         # Directory or nested directories of PDFs
         print(f"Processing directory: {input_path}")
-        process_directory(input_path, output_dir, args.threshold, args.crop)
+        process_directory(input_path, output_dir, args.threshold, args.crop, args.store, args.method, args.auto_crop, args.threads)
     else:
         print(f"Error: The input path {input_path} does not exist or is not valid.")
         exit(1)
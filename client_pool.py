@@ -0,0 +1,423 @@
+import time
+import httpx
+import random
+import asyncio
+import openai
+import contextlib
+from types import SimpleNamespace
+from openai import OpenAI, AsyncOpenAI
+
+
+# Errors after which a request is sent to another endpoint or retried. Other errors (e.g. an invalid request) are
+# raised directly.
+FAILOVER_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError, openai.RateLimitError)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for requests that failed on every healthy endpoint.
+
+    Args:
+        retries (int, optional): The number of times a request is retried. Defaults to 3.
+        base_delay (float, optional): The maximum delay in seconds before the first retry. Defaults to 1.0.
+        max_delay (float, optional): The maximum delay in seconds before any retry. Defaults to 30.0.
+
+    Notes:
+        - The delay before retry `n` is drawn uniformly between 0 and `min(max_delay, base_delay * 2 ** n)`, so that
+          requests that failed at the same moment (e.g. during an overload) do not all come back at the same moment.
+    """
+
+    def __init__(self, retries=3, base_delay=1.0, max_delay=30.0):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class AdaptiveLimiter:
+    """
+    Asynchronous concurrency limit that adapts to the latency and errors of the server (AIMD).
+
+    The limiter is used as `async with limiter:` around a single request. While the latency of the requests is stable,
+    the limit grows by about one request per round trip (additive increase). When the latency rises above
+    `latency_tolerance` times the lowest observed latency, or a request fails with an overload error, the limit is
+    multiplied by `decrease_factor` (multiplicative decrease), at most once per round trip.
+
+    Args:
+        limit (int): The initial number of requests in flight.
+        max_limit (int, optional): The maximum number of requests in flight. Defaults to `limit`.
+        min_limit (int, optional): The minimum number of requests in flight. Defaults to 1.
+        adaptive (bool, optional): Whether to adapt the limit. If False, the limiter behaves like a semaphore with
+                                   `limit` slots. Defaults to True.
+        latency_tolerance (float, optional): The ratio to the lowest latency above which the server is considered
+                                             overloaded. Defaults to 2.0.
+        decrease_factor (float, optional): The factor the limit is multiplied with when the server is overloaded.
+                                           Defaults to 0.75.
+
+    Notes:
+        - The latency is smoothed with an exponential moving average. The lowest latency slowly drifts upwards, so that
+          a lasting change in the length of the requests does not keep the limit low forever.
+    """
+
+    def __init__(self, limit, max_limit=None, min_limit=1, adaptive=True, latency_tolerance=2.0, decrease_factor=0.75):
+        self.limit = float(limit)
+        self.max_limit = max(max_limit or limit, limit)
+        self.min_limit = min_limit
+        self.adaptive = adaptive
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.lowest_limit = self.limit
+        self.highest_limit = self.limit
+        self.start_times = {}
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < max(int(self.limit), self.min_limit))
+            self.in_flight += 1
+        self.start_times[asyncio.current_task()] = time.monotonic()
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        latency = time.monotonic() - self.start_times.pop(asyncio.current_task())
+        overloaded = exc_type is not None and issubclass(exc_type, FAILOVER_ERRORS)
+        if self.adaptive and (exc_type is None or overloaded):
+            self.update(latency, overloaded)
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+        return False
+
+    def update(self, latency, overloaded):
+        """
+        Adapts the limit after a request that took `latency` seconds.
+        """
+        now = time.monotonic()
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.baseline = self.latency if self.baseline is None else min(self.baseline * 1.001, self.latency)
+
+        if overloaded or self.latency > self.latency_tolerance * self.baseline:
+            if now - self.last_decrease > self.latency:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.last_decrease = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self.lowest_limit = min(self.lowest_limit, self.limit)
+        self.highest_limit = max(self.highest_limit, self.limit)
+
+    def report(self):
+        return (f"Concurrency limit: {self.limit:.1f} (lowest {self.lowest_limit:.1f}, highest {self.highest_limit:.1f}), "
+                f"smoothed latency: {self.latency or 0.0:.2f} s")
+
+
+def load_endpoints(path):
+    """
+    Reads the base URLs of the LLM servers from a file with one URL per line.
+
+    Args:
+        path (str): The path to the file. Empty lines and lines starting with '#' are ignored.
+
+    Returns:
+        list: The base URLs, e.g. ['http://localhost:8000/v1/', 'http://localhost:8001/v1/'].
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+class Endpoint:
+    """
+    A single OpenAI-compatible server of a `ClientPool`, with its client and request statistics.
+    """
+
+    def __init__(self, base_url, client):
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.client = client
+        self.healthy = True
+        self.drained_at = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.busy_time = 0.0
+
+
+class ClientPool:
+    """
+    Pool of OpenAI-compatible LLM servers that routes every request to the least-loaded healthy server.
+
+    The pool can be used in place of an `OpenAI` client: `pool.chat.completions.create(...)` picks the healthy endpoint
+    with the fewest requests in flight and sends the request there. If the request fails with a connection error,
+    timeout or server error, it is sent again to another endpoint, so no line is lost when a server goes down. If it
+    failed on every healthy endpoint, it is retried after a backoff delay according to the `retry_policy`.
+
+    Args:
+        base_urls (list): The base URLs of the servers, e.g. ['http://localhost:8000/v1/'].
+        api_key (str): The API key of the servers.
+        timeout (float, optional): The timeout per request in seconds. Defaults to 60.0.
+        max_failures (int, optional): The number of consecutive failures after which an endpoint is drained.
+                                      Defaults to 3.
+        recheck_interval (float, optional): The number of seconds after which a drained endpoint is probed again.
+                                            Defaults to 30.0.
+        retry_policy (RetryPolicy, optional): The backoff of requests that failed on every endpoint. Defaults to
+                                              `RetryPolicy()`.
+
+    Notes:
+        - The health of an endpoint is probed with a request to `/v1/models`. All endpoints are probed when the pool
+          is created, and endpoints that are not healthy are drained: no new requests are routed to them.
+        - A drained endpoint is probed again every `recheck_interval` seconds, and receives requests again once it
+          is healthy.
+        - An endpoint that cannot be reached is drained immediately; after timeouts and server errors it is drained
+          after `max_failures` consecutive failures. The last healthy endpoint is never drained.
+        - The client of every endpoint is created with `max_retries=0`, so that a failing request is retried on another
+          endpoint first, and otherwise with the backoff of the pool instead of the built-in retries of `openai`.
+    """
+
+    def __init__(self, base_urls, api_key, timeout=60.0, max_failures=3, recheck_interval=30.0, retry_policy=None):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.recheck_interval = recheck_interval
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.start_time = time.monotonic()
+        self.endpoints = [Endpoint(base_url, self.make_client(base_url)) for base_url in base_urls]
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+        for endpoint in self.endpoints:
+            self.set_health(endpoint, self.probe(endpoint))
+        healthy = [endpoint.base_url for endpoint in self.endpoints if endpoint.healthy]
+        print(f"Healthy LLM endpoints: {len(healthy)} of {len(self.endpoints)}")
+
+    def make_client(self, base_url):
+        return OpenAI(base_url=base_url, api_key=self.api_key, timeout=self.timeout, max_retries=0)
+
+    def probe(self, endpoint):
+        """
+        Returns whether an endpoint answers a request for its models.
+        """
+        try:
+            response = httpx.get(endpoint.base_url + "models", headers={"Authorization": f"Bearer {self.api_key}"}, timeout=5.0)
+            return response.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    def set_health(self, endpoint, healthy):
+        if healthy and not endpoint.healthy:
+            print(f"LLM endpoint is healthy again: {endpoint.base_url}")
+        elif not healthy and endpoint.healthy:
+            print(f"Draining LLM endpoint: {endpoint.base_url}")
+        endpoint.healthy = healthy
+        endpoint.drained_at = None if healthy else time.monotonic()
+        endpoint.consecutive_failures = 0
+
+    def due_for_recheck(self):
+        """
+        Returns the drained endpoints that have not been probed for `recheck_interval` seconds.
+        """
+        now = time.monotonic()
+        due = [endpoint for endpoint in self.endpoints if not endpoint.healthy and now - endpoint.drained_at >= self.recheck_interval]
+        for endpoint in due:
+            endpoint.drained_at = now
+        return due
+
+    def pick(self, exclude=()):
+        """
+        Returns the healthy endpoint with the fewest requests in flight.
+
+        Args:
+            exclude (iterable, optional): Endpoints that already failed for the current request. They are only picked
+                                          if no other healthy endpoint is left. Defaults to ().
+
+        Notes:
+            - If no endpoint is healthy, all endpoints are considered, so that requests are still attempted (and fail
+              with the error of the server) instead of being dropped by the pool.
+        """
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy] or self.endpoints
+        candidates = [endpoint for endpoint in healthy if endpoint not in exclude] or healthy
+        return min(candidates, key=lambda endpoint: (endpoint.in_flight, endpoint.completed))
+
+    def start(self, endpoint):
+        endpoint.in_flight += 1
+        return time.monotonic()
+
+    def finish(self, endpoint, start_time, error=None):
+        """
+        Updates the statistics of an endpoint after a request, and drains it after too many consecutive failures.
+        """
+        endpoint.in_flight -= 1
+        endpoint.busy_time += time.monotonic() - start_time
+        if error is None:
+            endpoint.completed += 1
+            endpoint.consecutive_failures = 0
+            return
+
+        endpoint.failed += 1
+        endpoint.consecutive_failures += 1
+        print(f"Request to {endpoint.base_url} failed: {error}")
+        unreachable = isinstance(error, openai.APIConnectionError) and not isinstance(error, openai.APITimeoutError)
+        others_healthy = any(other.healthy for other in self.endpoints if other is not endpoint)
+        if others_healthy and (unreachable or endpoint.consecutive_failures >= self.max_failures):
+            self.set_health(endpoint, False)
+
+    def create(self, **kwargs):
+        """
+        Sends a chat completion request to the least-loaded healthy endpoint, failing over to other endpoints and
+        retrying with backoff.
+
+        Args:
+            **kwargs: The arguments of `client.chat.completions.create`.
+
+        Returns:
+            ChatCompletion: The completion of the first endpoint that answered the request.
+
+        Raises:
+            openai.OpenAIError: The error of the last attempt if the request still failed after all retries, or any
+                                error that is not a reason to fail over.
+        """
+        for endpoint in self.due_for_recheck():
+            self.set_health(endpoint, self.probe(endpoint))
+
+        failed = []
+        attempt = 0
+        while True:
+            try:
+                return self.attempt(failed, **kwargs)
+            except FAILOVER_ERRORS:
+                if not self.all_failed(failed):
+                    continue
+                if attempt >= self.retry_policy.retries:
+                    raise
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                failed = []
+
+    def attempt(self, failed, **kwargs):
+        """
+        Sends a request to the least-loaded healthy endpoint that did not fail yet, and adds it to `failed` if it fails.
+        """
+        endpoint = self.pick(exclude=failed)
+        start_time = self.start(endpoint)
+        try:
+            completion = endpoint.client.chat.completions.create(**kwargs)
+        except FAILOVER_ERRORS as e:
+            self.finish(endpoint, start_time, e)
+            failed.append(endpoint)
+            raise
+        except BaseException:
+            endpoint.in_flight -= 1
+            endpoint.failed += 1
+            raise
+        self.finish(endpoint, start_time)
+        return completion
+
+    def all_failed(self, failed):
+        """
+        Returns whether the current attempt of a request failed on every healthy endpoint.
+        """
+        return all(endpoint in failed or not endpoint.healthy for endpoint in self.endpoints)
+
+    def report(self):
+        """
+        Returns a summary of the number of requests and the throughput of every endpoint.
+
+        Returns:
+            str: One line per endpoint.
+        """
+        elapsed = time.monotonic() - self.start_time
+        lines = []
+        for endpoint in self.endpoints:
+            status = "healthy" if endpoint.healthy else "drained"
+            throughput = endpoint.completed / elapsed if elapsed else 0.0
+            latency = endpoint.busy_time / (endpoint.completed + endpoint.failed) if endpoint.completed + endpoint.failed else 0.0
+            lines.append(f"{endpoint.base_url}: {endpoint.completed} requests, {endpoint.failed} failed, "
+                         f"{throughput:.2f} requests/s, {latency:.2f} s average latency ({status})")
+        return "\n".join(lines)
+
+
+class AsyncClientPool(ClientPool):
+    """
+    Asynchronous counterpart of `ClientPool`, which can be used in place of an `AsyncOpenAI` client.
+
+    Args:
+        base_urls (list): The base URLs of the servers.
+        api_key (str): The API key of the servers.
+        http_client (httpx.AsyncClient): The HTTP client with keep-alive connections that is shared by all endpoints.
+        timeout (float, optional): The timeout per request in seconds. Defaults to 60.0.
+        max_failures (int, optional): The number of consecutive failures after which an endpoint is drained.
+                                      Defaults to 3.
+        recheck_interval (float, optional): The number of seconds after which a drained endpoint is probed again.
+                                            Defaults to 30.0.
+        retry_policy (RetryPolicy, optional): The backoff of requests that failed on every endpoint. Defaults to
+                                              `RetryPolicy()`.
+        limiter (AdaptiveLimiter, optional): The limit on the number of requests in flight over all endpoints.
+                                             Defaults to None, which does not limit the requests.
+
+    Notes:
+        - The endpoints are probed synchronously when the pool is created, before any request is sent. Drained
+          endpoints are probed again in the background, so a recheck never blocks the requests in flight.
+        - Every attempt of a request holds a slot of the `limiter` only while it is in flight; the backoff delay before
+          a retry does not hold a slot, so other requests keep the servers busy in the meantime.
+    """
+
+    def __init__(self, base_urls, api_key, http_client, timeout=60.0, max_failures=3, recheck_interval=30.0, retry_policy=None, limiter=None):
+        self.http_client = http_client
+        self.limiter = limiter or contextlib.nullcontext()
+        self.probes = set()
+        super().__init__(base_urls, api_key, timeout, max_failures, recheck_interval, retry_policy)
+
+    def make_client(self, base_url):
+        return AsyncOpenAI(base_url=base_url, api_key=self.api_key, http_client=self.http_client, timeout=self.timeout, max_retries=0)
+
+    async def recheck(self, endpoint):
+        try:
+            response = await self.http_client.get(endpoint.base_url + "models", headers={"Authorization": f"Bearer {self.api_key}"}, timeout=5.0)
+            self.set_health(endpoint, response.status_code == 200)
+        except httpx.HTTPError:
+            self.set_health(endpoint, False)
+
+    async def create(self, **kwargs):
+        """
+        Asynchronous counterpart of `ClientPool.create`.
+        """
+        for endpoint in self.due_for_recheck():
+            task = asyncio.create_task(self.recheck(endpoint))
+            self.probes.add(task)
+            task.add_done_callback(self.probes.discard)
+
+        failed = []
+        attempt = 0
+        while True:
+            try:
+                return await self.attempt(failed, **kwargs)
+            except FAILOVER_ERRORS:
+                if not self.all_failed(failed):
+                    continue
+                if attempt >= self.retry_policy.retries:
+                    raise
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                failed = []
+
+    async def attempt(self, failed, **kwargs):
+        """
+        Asynchronous counterpart of `ClientPool.attempt`, which holds a slot of the limiter while the request is in flight.
+        """
+        async with self.limiter:
+            endpoint = self.pick(exclude=failed)
+            start_time = self.start(endpoint)
+            try:
+                completion = await endpoint.client.chat.completions.create(**kwargs)
+            except FAILOVER_ERRORS as e:
+                self.finish(endpoint, start_time, e)
+                failed.append(endpoint)
+                raise
+            except BaseException:
+                endpoint.in_flight -= 1
+                endpoint.failed += 1
+                raise
+            self.finish(endpoint, start_time)
+            return completion
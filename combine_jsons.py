@@ -1,12 +1,119 @@
 import os
+import re
 import json
 import argparse
+import multiprocessing
+
+MANIFEST = "combine_manifest.json"
+
+def page_files(d):
+    # Returns the (page number, file name) of every page JSON of a directory in page order. The page number is taken
+    # from the `<year>_<page>.json` name given by extract_people.py, so the files do not have to be read to sort them.
+    pages = []
+    for file in os.listdir(d):
+        if not file.endswith(".json"):
+            continue
+        match = re.search(r"_(\d+)\.json$", file)
+        if match:
+            pages.append((int(match.group(1)), file))
+        else:
+            data = read_page(os.path.join(d, file))
+            if data is not None:
+                pages.append((data.get('page'), file))
+    return sorted(pages, key=lambda page: (page[0] is None, page[0] or 0, page[1]))
+
+def read_page(f_path):
+    try:
+        with open(f_path, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+            data.pop("year", None)
+            return data
+    except FileNotFoundError:
+        print(f"File not found: {f_path}")
+    except json.JSONDecodeError as e:
+        print(f"JSON decoding failed: {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+    return None
+
+def format_page(f_path):
+    # Reads a page JSON and formats it as an element of the "pages" list of the combined JSON, or returns None if it
+    # could not be read. JSON strings cannot contain a raw newline, so every newline starts a new line of the page.
+    data = read_page(f_path)
+    if data is None:
+        return None
+    return "\n        " + json.dumps(data, indent=4, ensure_ascii=False).replace("\n", "\n        ")
+
+def format_pages(paths, workers=1):
+    # Yields the formatted pages in the order of `paths`. With several workers, the pages are read and formatted in
+    # parallel processes, and only the pages that are waiting to be written are held in memory.
+    if workers <= 1:
+        yield from map(format_page, paths)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap(format_page, paths, chunksize=64)
+
+def write_combined(output_path, year, pages):
+    # Writes the `{"year", "pages"}` document page by page, in the same format as `json.dump(data, indent=4,
+    # ensure_ascii=False)`, and returns the number of pages. The document is written to a temporary file first, so an
+    # interrupted run never leaves a truncated document behind.
+    temp_path = output_path + ".tmp"
+    count = 0
+    with open(temp_path, 'w', encoding='utf-8') as new_json:
+        new_json.write('{\n    "year": ' + json.dumps(year, ensure_ascii=False) + ',\n    "pages": [')
+        for page in pages:
+            if page is None:
+                continue
+            new_json.write(("," if count else "") + page)
+            count += 1
+        new_json.write("\n    ]\n}" if count else "]\n}")
+    os.replace(temp_path, output_path)
+    return count
+
+def input_stats(d):
+    # The size and modification time of every page JSON of a directory, to detect changed inputs
+    stats = {}
+    for file in sorted(os.listdir(d)):
+        if file.endswith(".json"):
+            stat = os.stat(os.path.join(d, file))
+            stats[file] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+def combine_directory(d, output_dir, workers=1):
+    # Combines the page JSONs of one directory into `<directory name>_combined.json` and returns its path, or None if
+    # it could not be saved
+    i = os.path.basename(os.path.normpath(d))
+    year = os.path.splitext(i)[0]
+    paths = [os.path.join(d, file) for _, file in page_files(d)]
+    output_path = f'{output_dir}/{year}_combined.json'
+    try:
+        write_combined(output_path, year, format_pages(paths, workers))
+    except Exception as e:
+        print(f"Failed to save JSON file: {e}")
+        return None
+    return output_path
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_manifest(output_dir, manifest):
+    temp_path = os.path.join(output_dir, MANIFEST + ".tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, os.path.join(output_dir, MANIFEST))
 
 def main():
 
     parser = argparse.ArgumentParser(description="Combine JSONs into one JSON dictionary.")
     parser.add_argument("-i", "--input", type=str, required=True, help="Path to the directory containing nested directories containing the JSON files.")
     parser.add_argument("-o", "--output", type=str, help="Path to the output directory. Default: 'combined_jsons' in the current working directory.", default="./combined_jsons",)
+    parser.add_argument("-w", "--workers", type=int, help="Number of processes reading JSON files in parallel. Default: 1", default=1)
+    parser.add_argument("-f", "--force", action="store_true", help="Combine every directory, also if its JSON files did not change since the last run.")
 
     args = parser.parse_args()
 
@@ -19,35 +126,23 @@ def main():
         except OSError as e:
             print(f"Failed to create directory: {e}")
 
+    # The manifest records the size and modification time of the inputs of every combined JSON, so directories whose
+    # JSON files did not change are skipped
+    manifest = load_manifest(output_dir)
+    skipped = 0
     for i in sorted(os.listdir(input_dir)):
         d = os.path.join(input_dir, i)
         if os.path.isdir(d):
-            new_dict = {
-                'year': os.path.splitext(i)[0],
-                'pages': []
-            }
-            dictionary_list = []
-            for file in sorted(os.listdir(d)):
-                if file != ".DS_Store":
-                    f_path = os.path.join(d, file)
-                    try:
-                        with open(f_path, 'r', encoding="utf-8") as f:
-                            data = json.load(f)
-                            data.pop("year", None)
-                            dictionary_list.append(data)
-                    except FileNotFoundError:
-                        print(f"File not found: {f_path}")
-                    except json.JSONDecodeError as e:
-                        print(f"JSON decoding failed: {e}")
-                    except Exception as e:
-                        print(f"An unexpected error occurred: {e}")
-
-            new_dict['pages'] = sorted(dictionary_list, key=lambda x: x['page'])
-            try:
-                with open(f'{output_dir}/{os.path.splitext(i)[0]}_combined.json', 'w', encoding='utf-8') as new_json:
-                    json.dump(new_dict, new_json, indent=4, ensure_ascii=False)
-            except Exception as e:
-                print(f"Failed to save JSON file: {e}")
+            stats = input_stats(d)
+            output_path = f'{output_dir}/{os.path.splitext(i)[0]}_combined.json'
+            if not args.force and manifest.get(i) == stats and os.path.exists(output_path):
+                skipped += 1
+                continue
+            if combine_directory(d, output_dir, args.workers):
+                manifest[i] = stats
+                save_manifest(output_dir, manifest)
+    if skipped:
+        print(f"Skipped {skipped} unchanged directories")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
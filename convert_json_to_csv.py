@@ -1,60 +1,290 @@
 import os
 import csv
 import json
+import time
 import argparse
 
-def main():
-    parser = argparse.ArgumentParser(description="Convert JSON to CSV.")
-    parser.add_argument("-i", "--input", type=str, required=True, help="Path to a single JSON.")
-    parser.add_argument("-o", "--output", type=str, help="Path to the output file. Default: 'combined_json.csv' in the current working directory.", default="./combined_json.csv",)
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
-    args = parser.parse_args()
-    input_file = os.path.abspath(args.input)
-    output_file = os.path.abspath(args.output)
-    output_dir = os.path.dirname(output_file)
+# Output formats and their file extensions. Parquet and Arrow require pyarrow (pip install pyarrow).
+FORMATS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+COLUMNS = ["year", "page", "name", "jobTitle", "address"]
+
+class JsonStream:
+    """
+    Incremental reader of a JSON document, which decodes one value at a time from a buffer that is refilled in chunks.
+
+    Args:
+        file: The file object, opened in text mode.
+        chunk_size (int, optional): The number of characters read at a time. Defaults to 1048576.
+    """
+
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def fill(self):
+        # Drops the consumed part of the buffer and reads the next chunk. Returns False at the end of the file.
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        self.eof = not chunk
+        return bool(chunk)
+
+    def peek(self):
+        """
+        Returns the next character that is not whitespace, without consuming it, or "" at the end of the file.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n":
+                self.position += 1
+            if self.position < len(self.buffer) or not self.fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, characters):
+        """
+        Consumes the next character, which must be one of `characters`, and returns it.
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise json.JSONDecodeError(f"Expected one of {characters!r}", self.buffer, self.position)
+        self.position += 1
+        return character
+
+    def value(self):
+        """
+        Decodes the next complete JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+def iter_pages(input_file):
+    # Yields (year, page) for every page of a combined JSON, reading one page at a time, so the memory use does not
+    # depend on the size of the file. The year has to come before the pages, as in the output of combine_jsons.py.
+    with open(input_file, 'r', encoding='utf-8') as f:
+        stream = JsonStream(f)
+        year = "Unknown"
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key == "pages":
+                stream.expect("[")
+                if stream.peek() == "]":
+                    stream.expect("]")
+                else:
+                    while True:
+                        yield year, stream.value()
+                        if stream.expect(",]") == "]":
+                            break
+            else:
+                value = stream.value()
+                if key == "year":
+                    year = value
+            if stream.expect(",}") == "}":
+                return
+
+def iter_persons(register):
+    # Yields the person records of the register of a page. extract_people.py writes the list of persons of every line,
+    # so the lists are flattened; person records that are not in a list are taken as they are, and anything else is
+    # skipped.
+    for entry in register:
+        if isinstance(entry, dict):
+            yield entry
+        elif isinstance(entry, list):
+            for person in entry:
+                if isinstance(person, dict):
+                    yield person
+
+def iter_batches(input_files, batch_size=65536):
+    # Yields the persons of all input files as batches of columns, with at most `batch_size` rows per batch
+    batch = {column: [] for column in COLUMNS}
+    for input_file in input_files:
+        for year, page in iter_pages(input_file):
+            page_number = page.get("page", "Unknown")
+            for entry in iter_persons(page.get("register", [])):
+                batch["year"].append(year)
+                batch["page"].append(page_number)
+                batch["name"].append(entry.get("name", ""))
+                batch["jobTitle"].append(entry.get("jobTitle", ""))
+                batch["address"].append(entry.get("address", ""))
+                if len(batch["year"]) >= batch_size:
+                    yield batch
+                    batch = {column: [] for column in COLUMNS}
+    if batch["year"]:
+        yield batch
+
+class CsvExport:
+    """
+    Writes batches of columns to a CSV file, with the same header and rows as before.
+    """
+
+    def __init__(self, output_file):
+        self.file = open(output_file, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, batch):
+        self.writer.writerows(zip(*(batch[column] for column in COLUMNS)))
+
+    def close(self):
+        self.file.close()
+
+class ArrowExport:
+    """
+    Writes batches of columns to a Parquet file, as one row group per batch, or to an Arrow IPC file.
 
-    if not os.path.exists(output_dir):
-        try:
-            os.makedirs(output_dir, exist_ok=True)
-        except OSError as e:
-            print(f"Failed to create directory: {e}")
+    The columns are typed: the page is an integer (null if it is unknown), and the other columns are strings. Values
+    that are not strings, such as a list returned by the LLM instead of an address, are stored as JSON.
+    """
 
-    # Load the JSON data
+    def __init__(self, output_file, output_format):
+        self.schema = pyarrow.schema([
+            ("year", pyarrow.string()),
+            ("page", pyarrow.int32()),
+            ("name", pyarrow.string()),
+            ("jobTitle", pyarrow.string()),
+            ("address", pyarrow.string()),
+        ])
+        if output_format == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(output_file, self.schema, compression="zstd")
+        else:
+            self.writer = pyarrow.ipc.new_file(output_file, self.schema)
+
+    @staticmethod
+    def text(value):
+        return value if isinstance(value, str) or value is None else json.dumps(value, ensure_ascii=False)
+
+    def write(self, batch):
+        arrays = [
+            pyarrow.array([self.text(value) for value in batch["year"]], pyarrow.string()),
+            pyarrow.array([value if isinstance(value, int) else None for value in batch["page"]], pyarrow.int32()),
+        ] + [pyarrow.array([self.text(value) for value in batch[column]], pyarrow.string()) for column in ("name", "jobTitle", "address")]
+        self.writer.write_batch(pyarrow.record_batch(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def export(input_files, outputs, batch_size=65536):
+    # Streams the persons of all input files into one file per format. `outputs` maps every format to its output file.
+    # Returns the number of rows, or None if the export failed.
+    for input_file in input_files:
+        if not os.path.isfile(input_file):
+            print(f"File not found: {input_file}")
+            return None
+
+    for output_file in outputs.values():
+        output_dir = os.path.dirname(output_file)
+        if not os.path.exists(output_dir):
+            try:
+                os.makedirs(output_dir, exist_ok=True)
+            except OSError as e:
+                print(f"Failed to create directory: {e}")
+
+    # The formats are written to temporary files, which replace the output files only when the export succeeded, so a
+    # failed export does not leave truncated output files behind
+    temp_files = {output_file: output_file + ".tmp" for output_file in outputs.values()}
+    writers = []
+    rows = 0
+    failed = True
     try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        print(f"File not found: {input_file}")
+        for output_format, output_file in outputs.items():
+            temp_file = temp_files[output_file]
+            writers.append(CsvExport(temp_file) if output_format == "csv" else ArrowExport(temp_file, output_format))
+        for batch in iter_batches(input_files, batch_size):
+            for writer in writers:
+                writer.write(batch)
+            rows += len(batch["year"])
+        # Closing a Parquet or Arrow file writes its footer, which can fail as well
+        while writers:
+            writers.pop().close()
+        failed = False
+    except FileNotFoundError as e:
+        print(f"File not found: {e.filename}")
+        return None
     except json.JSONDecodeError as e:
         print(f"JSON decoding failed: {e}")
+        return None
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        print(f"Failed to save output file: {e}")
+        return None
+    finally:
+        if failed:
+            for writer in writers:
+                writer.close()
+            for temp_file in temp_files.values():
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+    for output_file, temp_file in temp_files.items():
+        os.replace(temp_file, output_file)
+    return rows
 
-    # Open the CSV file for writing
-    try:
-        with open(output_file, 'w', encoding='utf-8', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            
-            # Write the header row
-            writer.writerow(["year", "page", "name", "jobTitle", "address"])
-            
-            # Loop through the pages and write rows
-            for page in data.get("pages", []):
-                page_number = page.get("page", "Unknown")
-                year = data.get("year", "Unknown")
-                for entry in page.get("register", []):
-                    # Write a row if entry is valid
-                    if isinstance(entry, dict):
-                        writer.writerow([
-                            year,
-                            page_number,
-                            entry.get("name", ""),
-                            entry.get("jobTitle", ""),
-                            entry.get("address", "")
-                        ])
-            print(f"CSV file has been created: {output_file}")
-    except Exception as e:
-        print(f"Failed to save CSV file: {e}")
+def convert_json_to_csv(input_file, output_file):
+    # Writes the persons of a combined JSON to a CSV file, and returns whether the CSV file was created
+    if export([input_file], {"csv": output_file}) is None:
+        return False
+    print(f"CSV file has been created: {output_file}")
+    return True
+
+def find_inputs(input_paths):
+    # Expands directories into the JSON files they contain
+    input_files = []
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            input_files.extend(sorted(os.path.join(input_path, file) for file in os.listdir(input_path) if file.endswith(".json") and file != "combine_manifest.json"))
+        else:
+            input_files.append(input_path)
+    return input_files
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert JSON to CSV, Parquet or Arrow.")
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True, help="Path to one or more combined JSONs, or directories of combined JSONs. The persons of all inputs are written to the same output file.")
+    parser.add_argument("-o", "--output", type=str, help="Path to the output file. The extension is replaced for every format. Default: 'combined_json.csv' in the current working directory.", default="./combined_json.csv",)
+    parser.add_argument("-f", "--format", type=str, nargs="+", choices=FORMATS, help="One or more output formats. Parquet and Arrow require pyarrow. Default: csv", default=["csv"])
+    parser.add_argument("-b", "--batch_size", type=int, help="Number of rows that are held in memory and written at a time, and the size of the row groups of a Parquet file. Default: 65536", default=65536)
+
+    args = parser.parse_args()
+
+    if pyarrow is None and set(args.format) - {"csv"}:
+        parser.error("The parquet and arrow formats require the pyarrow package (pip install pyarrow).")
+
+    input_files = [os.path.abspath(path) for path in find_inputs(args.input)]
+    output_file = os.path.abspath(args.output)
+    outputs = {output_format: os.path.splitext(output_file)[0] + FORMATS[output_format] for output_format in args.format}
+    if args.format == ["csv"]:
+        outputs["csv"] = output_file
+
+    start_time = time.perf_counter()
+    rows = export(input_files, outputs, args.batch_size)
+    if rows is None:
+        exit(1)
+    elapsed = time.perf_counter() - start_time
+    for output_format, path in outputs.items():
+        print(f"{output_format.upper() if output_format == 'csv' else output_format.capitalize()} file has been created: {path}")
+    print(f"Exported {rows} persons from {len(input_files)} files in {elapsed:.1f} s")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,22 +1,49 @@
 import os
 import fitz
 import argparse
+import multiprocessing
 from tqdm import tqdm
 
-def convert_pdf_to_jpg(input_path, output_dir, zoom=2, dpi=200):
+
+def page_tasks(input_path, output_dir, zoom=2, dpi=200, chunk_size=16):
+    # Splits the pages of a PDF into ranges of at most `chunk_size` pages, which are rendered by the workers
     try:
-        # Open the PDF file
-        doc = fitz.open(input_path)
-        total_pages = doc.page_count
-    except fitz.fitz.FileDataError:
+        with fitz.open(input_path) as doc:
+            total_pages = doc.page_count
+    except fitz.FileDataError:
         print(f"Error: '{input_path}' is not a valid PDF file or is corrupted.")
+        return []
     except Exception as e:
         print(f"An unexpected error occurred while opening '{input_path}': {e}")
-    
-    for page_number in tqdm(range(total_pages), desc='Converting pages', ncols=100, unit='page'):
-        page = doc.load_page(page_number)
-        mat = fitz.Matrix(zoom, zoom)  # Scale matrix for high resolution
-        image = page.get_pixmap(matrix=mat, dpi=dpi)
+        return []
+
+    return [
+        (input_path, output_dir, first_page, min(first_page + chunk_size, total_pages), zoom, dpi)
+        for first_page in range(0, total_pages, chunk_size)
+    ]
+
+
+def render_pages(task):
+    # Renders a range of pages of a PDF with a document handle of its own, so that ranges can be rendered in parallel.
+    # Errors are reported per page, so that a bad page does not stop the other pages and ranges.
+    input_path, output_dir, first_page, last_page, zoom, dpi = task
+    try:
+        doc = fitz.open(input_path)
+    except Exception as e:
+        print(f"Error: Could not open '{input_path}' to render pages {1 + first_page}-{last_page}: {e}")
+        return last_page - first_page
+
+    for page_number in range(first_page, last_page):
+        try:
+            page = doc.load_page(page_number)
+            # An explicit resolution takes precedence over the zoom factor
+            if dpi:
+                image = page.get_pixmap(dpi=dpi)
+            else:
+                image = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))  # Scale matrix for high resolution
+        except Exception as e:
+            print(f"Error rendering page {1 + page_number} of '{input_path}': {e}")
+            continue
 
         # Construct output filename with zero-padded page number
         output_filename = f"{os.path.basename(input_path).split('.')[0]}_page_{1 + page_number:04}.jpg"
@@ -34,20 +61,48 @@ def convert_pdf_to_jpg(input_path, output_dir, zoom=2, dpi=200):
             print(f"An unexpected error occurred while saving to '{output_path}': {e}")
     
     doc.close()
+    return last_page - first_page
+
+
+def convert_pdfs(pdf_paths, output_dir, zoom=2, dpi=200, workers=1):
+    # Renders the pages of all PDFs, with the page ranges of all PDFs sharing one pool of `workers` processes
+    tasks = [task for pdf_path in pdf_paths for task in page_tasks(pdf_path, output_dir, zoom, dpi)]
+    render_ranges(tasks, workers)
+
+
+def render_ranges(tasks, workers=1):
+    # Renders the page ranges of `tasks`, see `render_pages`
+    total_pages = sum(last_page - first_page for _, _, first_page, last_page, _, _ in tasks)
+
+    with tqdm(total=total_pages, desc='Converting pages', ncols=100, unit='page') as progress:
+        if workers <= 1:
+            for task in tasks:
+                progress.update(render_pages(task))
+        else:
+            with multiprocessing.Pool(workers) as pool:
+                for page_count in pool.imap_unordered(render_pages, tasks):
+                    progress.update(page_count)
+
+
+def convert_pdf_to_jpg(input_path, output_dir, zoom=2, dpi=200, workers=1):
+    convert_pdfs([input_path], output_dir, zoom, dpi, workers)
 
 
-def process_directory(input_path, output_dir):
+def process_directory(input_path, output_dir, zoom=2, dpi=200, workers=1):
+    pdf_paths = []
     for root, _, files in os.walk(input_path):
         for file in files:
             if file.lower().endswith(".pdf"):
-                pdf_path = os.path.join(root, file)
-                convert_pdf_to_jpg(pdf_path, output_dir)
+                pdf_paths.append(os.path.join(root, file))
+    convert_pdfs(pdf_paths, output_dir, zoom, dpi, workers)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert PDF files to JPG images.")
     parser.add_argument("-i", "--input", type=str, required=True, help="Path to a single PDF, a directory of PDFs, or a directory containing nested directories with PDFs.")
     parser.add_argument("-o", "--output", type=str, help="Path to the output directory. Default: 'output' in the current working directory.", default="./output",)
+    parser.add_argument("-d", "--dpi", type=int, help="Resolution at which the pages are rendered. Default: 200", default=200)
+    parser.add_argument("-w", "--workers", type=int, help="Number of processes rendering pages in parallel. Default: 1", default=1)
 
     args = parser.parse_args()
 
@@ -65,11 +120,11 @@ def main():
     if os.path.isfile(input_path):
         # Single PDF file
         print(f"Processing single file: {input_path}")
-        convert_pdf_to_jpg(input_path, output_dir)
+        convert_pdf_to_jpg(input_path, output_dir, dpi=args.dpi, workers=args.workers)
     elif os.path.isdir(input_path):
         # Directory or nested directories of PDFs
         print(f"Processing directory: {input_path}")
-        process_directory(input_path, output_dir)
+        process_directory(input_path, output_dir, dpi=args.dpi, workers=args.workers)
     else:
         print(f"Error: The input path {input_path} does not exist or is not valid.")
         exit(1)
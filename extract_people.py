@@ -1,16 +1,54 @@
 import os
 import re
 import json
+import math
+import tempfile
+import httpx
+import openai
+import asyncio
 import argparse
+import functools
+import contextlib
+import contextvars
+from collections import Counter
 from tqdm import tqdm
-from openai import Client, OpenAI
+from llm_cache import ResponseCache
+from journal import ProgressJournal
+from client_pool import FAILOVER_ERRORS, ClientPool, AsyncClientPool, AdaptiveLimiter, RetryPolicy, load_endpoints
 from llama_index.core import PromptTemplate
-from templates.prompt import prompt_template
-from templates.json_schema import json_schema
+from templates.prompt import prompt_template, packed_prompt_template
+from templates.json_schema import json_schema, guided_json_schema, packed_json_schema, person_list_json_schema, packed_person_list_json_schema
 from templates.system_message import system_message
 from templates.page_object import create_page_object
 
 
+# The numbers of requests, lines and tokens of the current call of `extract_pages` or `process_pages_async`. It is a
+# context variable, so that calls in different threads or event loops, such as the books of pipeline.py, each count
+# their own statistics.
+run_stats = contextvars.ContextVar("run_stats", default=None)
+
+
+def count(key, value=1):
+    # Adds to a statistic of the current call, if any
+    stats = run_stats.get()
+    if stats is not None:
+        stats[key] += value
+
+
+@contextlib.contextmanager
+def collect_stats():
+    """
+    Collects the statistics of the requests, lines and tokens in a new Counter, which is yielded.
+    """
+    stats = Counter()
+    token = run_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        run_stats.reset(token)
+
+
+@functools.lru_cache(maxsize=None)
 def make_system_message(system_message=system_message, schema=json_schema):
     """
     Generates a system message by formatting a predefined system message template with a given JSON schema.
@@ -27,12 +65,27 @@ def make_system_message(system_message=system_message, schema=json_schema):
     Notes:
         - The function uses the `PromptTemplate` class to format the system message template with the JSON schema.
         - If no `system_message` or `schema` is provided, the default `system_message` and `json_schema` values will be used.
+        - The result is memoized, so the system message is only rendered once per run instead of once per line.
     """
     system_prompt = PromptTemplate(system_message)
     evaluated_system_prompt = system_prompt.format(jsonschema=schema)
     return evaluated_system_prompt
 
 
+@functools.lru_cache(maxsize=None)
+def make_prompt_template(template):
+    """
+    Parses a template into a `PromptTemplate` once, so that it can be reused for every record.
+
+    Args:
+        template (str): The template to parse.
+
+    Returns:
+        PromptTemplate: The parsed template.
+    """
+    return PromptTemplate(template)
+
+
 def make_human_message(record, template=prompt_template):
     """
     Generates the human input message for a LLM by formatting a provided record using a predefined template.
@@ -52,12 +105,66 @@ def make_human_message(record, template=prompt_template):
         - If no template is provided, the default `prompt_template` will be used.
         - The `record` can be a string, dictionary, or any other data type that can be formatted using the specified template.
     """
-    prompt = PromptTemplate(template)
+    prompt = make_prompt_template(template)
     evaluated_human_prompt = prompt.format(record = record)
     return evaluated_human_prompt
 
 
-def ask_llama(system, user, client, MODEL):
+# Stop sequences of a request without schema-guided decoding. They start the comments that the model tends to add after
+# the JSON, and do not occur in a reply that is only JSON, so they end a rambling reply without cutting off records.
+STOP_SEQUENCES = ["\n\nNote", "\n\nExplanation", "\n\nThis ", "\n\nI "]
+
+
+def make_request_options(guided=False, max_tokens=None, record_count=None):
+    """
+    Builds the additional parameters of a chat request for schema-guided decoding and output-length caps.
+
+    Args:
+        guided (bool, optional): Whether to constrain the output of the model to the JSON schema of a list of persons
+                                 with the guided decoding of vLLM. Defaults to False.
+        max_tokens (int, optional): The maximum number of tokens the model may generate for a single record. Defaults
+                                    to None, which does not cap the output.
+        record_count (int, optional): The number of records in a packed request. Defaults to None, for a request with
+                                      a single record.
+
+    Returns:
+        dict: The parameters to pass to `ask_llama` as `options`.
+
+    Notes:
+        - For a packed request the packed JSON schema, which includes the record number, is used and the output cap is
+          multiplied by the number of records.
+        - The schema is passed as `guided_json` in the request body, which the OpenAI-compatible server of vLLM uses to
+          only allow tokens that keep the output valid. The generation therefore ends with the JSON array itself.
+        - Without guided decoding, the generation is ended by the `STOP_SEQUENCES`, in addition to `max_tokens`.
+    """
+    options = {}
+    if max_tokens:
+        options["max_tokens"] = max_tokens * (record_count or 1)
+    if guided:
+        schema = packed_person_list_json_schema if record_count else person_list_json_schema
+        options["extra_body"] = {"guided_json": schema}
+    else:
+        options["stop"] = STOP_SEQUENCES
+    return options
+
+
+def select_system_message(options=None):
+    """
+    Returns the system message of a request for a single record that matches its output: a JSON array of persons with
+    schema-guided decoding, which forces the output to an array, and JSON objects otherwise.
+
+    Args:
+        options (dict, optional): The parameters of the request, see `make_request_options`. Defaults to None.
+
+    Returns:
+        str: The system message.
+    """
+    if options and "guided_json" in options.get("extra_body", {}):
+        return make_system_message(schema=guided_json_schema)
+    return make_system_message()
+
+
+def ask_llama(system, user, client, MODEL, cache=None, options=None):
     """
     Sends a message to the Llama API to get a response based on system and user messages.
 
@@ -67,25 +174,92 @@ def ask_llama(system, user, client, MODEL):
     Args:
         system (str): The system-level message that provides context or instructions for the API model.
         user (str): The user message or query to which the model will respond.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        options (dict, optional): Additional (sampling) parameters for the request. Defaults to None.
 
     Returns:
         str or None: The model's response to the user input as a string, or `None` if the API request fails.
 
     Notes:
+        - If a `cache` is given, a cached response for the same model, messages and options is returned without
+          calling the server, and successful responses are added to the cache.
         - The function makes use of the `client.chat.completions.create()` method to interact with the Llama model API.
         - If the API request is successful, the function returns the response content as a string.
-        - If there is an error with the API request (e.g., network issue, invalid request), the function prints the error
-          and returns `None`.
+        - If the API request still fails after the retries of the client (e.g., network issue, overloaded server), the
+          function prints the error and returns `None`, so that the line is sent again in the next retry round.
 
     Exceptions:
-        - `Exception`: Any error during the API request (e.g., network failure, invalid parameters) will be caught
-          and printed as an error message.
+        - Errors that are not in `client_pool.FAILOVER_ERRORS` (e.g., an invalid request, a schema that the server
+          rejects or an invalid API key) are raised, because sending the request again would fail in the same way.
     """
+    options = options or {}
+    if cache:
+        key = ResponseCache.make_key(MODEL, system, user, options)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
     try:
         messages = [{"role": "system", "content": system}, {"role":"user","content":user}]
-        completion = client.chat.completions.create(model=MODEL, messages=messages)
-        return completion.choices[0].message.content
-    except Exception as e:
+        completion = client.chat.completions.create(model=MODEL, messages=messages, **options)
+        output = completion.choices[0].message.content
+        count_usage(completion)
+        if cache and output:
+            cache.put(key, output)
+        return output
+    except FAILOVER_ERRORS as e:
+        print(f"API request failed: {e}")
+        return None
+
+
+def count_usage(completion):
+    """
+    Adds the number of prompt and decoded tokens of a completion to the statistics of the current call, see `run_stats`.
+    """
+    count("requests")
+    if completion.usage:
+        count("prompt_tokens", completion.usage.prompt_tokens)
+        count("completion_tokens", completion.usage.completion_tokens)
+
+
+async def ask_llama_async(system, user, client, MODEL, cache=None, options=None):
+    """
+    Asynchronous counterpart of `ask_llama` that sends a message to the Llama API without blocking the event loop.
+
+    The number of requests that are in flight at the same time is bounded by the limiter of the `AsyncClientPool`, so
+    that many lines can be dispatched at once while the server is never sent more requests than it can handle.
+
+    Args:
+        system (str): The system-level message that provides context or instructions for the API model.
+        user (str): The user message or query to which the model will respond.
+        client (AsyncOpenAI): The asynchronous OpenAI-compatible client used to reach the server.
+        MODEL (str): The name of the model served by the server.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        options (dict, optional): Additional (sampling) parameters for the request. Defaults to None.
+
+    Returns:
+        str or None: The model's response to the user input as a string, or `None` if the API request fails.
+
+    Exceptions:
+        - Only the errors in `client_pool.FAILOVER_ERRORS` (e.g., timeout, network failure) are caught and printed;
+          other errors are raised, see `ask_llama`.
+    """
+    options = options or {}
+    if cache:
+        key = ResponseCache.make_key(MODEL, system, user, options)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    try:
+        messages = [{"role": "system", "content": system}, {"role":"user","content":user}]
+        completion = await client.chat.completions.create(model=MODEL, messages=messages, **options)
+        output = completion.choices[0].message.content
+        count_usage(completion)
+        if cache and output:
+            cache.put(key, output)
+        return output
+    except FAILOVER_ERRORS as e:
         print(f"API request failed: {e}")
         return None
 
@@ -387,7 +561,99 @@ def preprocess_line(line):
     return line
 
 
-def process_line(line, client, MODEL):
+class PagePreprocessor:
+    """
+    Applies the complete page and line preprocessing chain with regular expressions that are compiled only once.
+
+    The output is identical to calling `process_page` on a page and `preprocess_line` on each of its lines, but the
+    patterns are not looked up for every call, redundant passes are dropped, and the pages of a book can be streamed
+    through `iter_pages` one at a time.
+
+    Example:
+        preprocessor = PagePreprocessor()
+        for page_lines in preprocessor.iter_pages(text_list):
+            ...
+
+    Notes:
+        - `strip_text` replaces '-\\n' after all newlines have already been replaced by spaces, so that pass never
+          matches and is skipped here.
+        - The line filter of `process_page` is kept exactly as it is, including its operator precedence, so that the
+          same lines are selected.
+    """
+
+    def __init__(self):
+        self.newline_pattern = re.compile(r'\n\n|\n')
+        self.strip_pattern = re.compile(r"[^a-zA-Z0-9\s,.\(\)\{\}'-]")
+        self.phone_pattern = re.compile(r'\b(?:[Tt]el|[Tt]elef|[Tt]elefoon)\.\s*\d+\b')
+        self.split_pattern = re.compile(r'(\s\d+[a-zA-Z0-9]*)\b')
+        self.left_side_pattern = re.compile(r'^[^a-zA-Z]+')
+        self.ocr_mistake_pattern = re.compile(r'\(.*[134].*\)')
+        self.missing_space_pattern = re.compile(r'(?<=[.])(?=[^\s])')
+        self.whitespace_pattern = re.compile(r'\s+')
+        self.initial_pattern = re.compile(r'(?<=[A-Z])(?!\.)\b')
+
+    @staticmethod
+    def replace_ocr_digits(match):
+        return match.group(0).replace('1', 'J.').replace('3', 'J').replace('4', 'J')
+
+    def process_page(self, page):
+        """
+        Equivalent of `process_page`: cleans a page and returns the lines that contain a person record.
+
+        Args:
+            page (str): The OCR text of a page.
+
+        Returns:
+            list: The selected lines of the page, before line preprocessing.
+        """
+        if not page:
+            return []
+
+        try:
+            page = self.newline_pattern.sub(' ', page).replace('{', '(')
+            page = self.phone_pattern.sub('', self.strip_pattern.sub('', page))
+            parts = self.split_pattern.split(page)
+            page_lines = [line.strip() for line in (parts[i] + parts[i + 1].strip() for i in range(0, len(parts) - 1, 2)) if line.strip()]
+            return [self.left_side_pattern.sub('', line) for line in page_lines if '(' in line or ')' in line and 15 < len(line) < 150]
+        except Exception as e:
+            print(f"Error processing page: {e}")
+            return []
+
+    def preprocess_line(self, line):
+        """
+        Equivalent of `preprocess_line`: fixes OCR mistakes and formats the initials and spacing of a line.
+
+        Args:
+            line (str): A line returned by `process_page`.
+
+        Returns:
+            str: The preprocessed line.
+        """
+        line = self.ocr_mistake_pattern.sub(self.replace_ocr_digits, line)
+        line = self.whitespace_pattern.sub(' ', self.missing_space_pattern.sub(' ', line))
+        return self.initial_pattern.sub('.', line)
+
+    def __call__(self, page):
+        """
+        Returns the preprocessed lines of a page, ready to be sent to the language model.
+        """
+        return [self.preprocess_line(line) for line in self.process_page(page)]
+
+    def iter_pages(self, pages):
+        """
+        Lazily yields the preprocessed lines of each page of a book, one page at a time.
+
+        Args:
+            pages (iterable): The OCR text of the pages.
+
+        Yields:
+            list: The preprocessed lines of the next page.
+        """
+        for page in pages:
+            yield self(page)
+
+
+def process_line(line, client, MODEL, cache=None, options=None):
     """
     Processes a line of text by sending it to a language model and extracting structured data from the model's response.
     The function generates a system and human message, sends them to the model, and attempts to parse the JSON-like 
@@ -395,15 +661,17 @@ def process_line(line, client, MODEL):
 
     Args:
         line (str): The input line of text to be processed by the language model.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        options (dict, optional): Additional parameters for the request, see `make_request_options`. Defaults to None.
 
     Returns:
-        list: A list of dictionaries (person records) parsed from the model's response.
+        list or None: A list of dictionaries (person records) parsed from the model's response, or `None` if the
+                      request failed, so that the line can be retried.
 
     Notes:
         - The function first generates a system and human message using the input line and predefined templates.
         - It then sends the generated messages to a language model (e.g., Llama) to process the information.
-        - The model's response is expected to contain one or more JSON-like objects. These objects are extracted using a
-          regular expression and parsed into Python dictionaries.
+        - The person records are parsed from the model's response with `parse_person_list`.
         - In case of an error (e.g., empty response or JSON parsing error), the function will print an error message and 
           return an empty list.
 
@@ -412,15 +680,73 @@ def process_line(line, client, MODEL):
         - If parsing the JSON data fails, an error message is printed and the function proceeds without adding any records 
           to the list.
     """
-    person_list = []
-    system_message = make_system_message()
+    system_message = select_system_message(options)
     human_message = make_human_message(line)
-    output = ask_llama(system_message, human_message, client, MODEL)
+    output = ask_llama(system_message, human_message, client, MODEL, cache, options)
+    if output is None:
+        return None
+    return parse_person_list(output)
+
+
+async def process_line_async(line, client, MODEL, cache=None, options=None):
+    """
+    Asynchronous counterpart of `process_line`.
+
+    Builds the system and human message for a line, sends them with `ask_llama_async`, and parses the person
+    records from the model's response with `parse_person_list`.
+
+    Args:
+        line (str): The input line of text to be processed by the language model.
+        client (AsyncOpenAI): The asynchronous OpenAI-compatible client used to reach the server.
+        MODEL (str): The name of the model served by the server.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        options (dict, optional): Additional parameters for the request, see `make_request_options`. Defaults to None.
+
+    Returns:
+        list or None: A list of dictionaries (person records) parsed from the model's response, or `None` if the
+                      request failed.
+    """
+    system_message = select_system_message(options)
+    human_message = make_human_message(line)
+    output = await ask_llama_async(system_message, human_message, client, MODEL, cache, options)
+    if output is None:
+        return None
+    return parse_person_list(output)
+
+
+def parse_person_list(output):
+    """
+    Parses the person records from the raw response of the language model.
+
+    Args:
+        output (str or None): The model's response, or `None` if the request failed.
+
+    Returns:
+        list: A list of dictionaries (person records) found in the response.
+
+    Notes:
+        - A response of schema-guided decoding is a JSON array of persons, which is parsed directly. This also handles
+          values that contain braces.
+        - Otherwise the model's response is expected to contain one or more JSON-like objects. These objects are
+          extracted using a regular expression and parsed into Python dictionaries.
+        - If the response is empty, or parsing the JSON data fails, an error message is printed and the records parsed
+          so far are returned.
+    """
+    person_list = []
 
     if not output:
         print("Empty response from language model.")
         return person_list
 
+    try:
+        parsed = json.loads(output)
+        if isinstance(parsed, dict):
+            return [parsed]
+        if isinstance(parsed, list):
+            return [obj for obj in parsed if isinstance(obj, dict)]
+    except json.JSONDecodeError:
+        pass
+
     try:
         json_objects = re.findall(r'\{.*?\}', output, re.DOTALL)
         for obj in json_objects:
@@ -444,6 +770,9 @@ def create_page_json(person_list, page_number, input_name, output_directory):
         output_directory (str): The directory where the JSON file will be saved. If the directory doesn't exist, 
                                 it will be created.
 
+    Returns:
+        bool: True if the JSON file was saved, False otherwise.
+
     Notes:
         - The function first checks if the output directory exists; if not, it will be created.
         - It then generates a page object using the provided `person_list`, `page_number`, and `input_name`.
@@ -451,6 +780,8 @@ def create_page_json(person_list, page_number, input_name, output_directory):
         - If there is an error during file creation or writing, an error message is printed.
         - The resulting JSON file will contain structured information about the people on the page and will be saved
           in the specified directory with a filename format that includes the name of the input file and page number.
+        - The file is first written to a temporary file in the same directory, which is then renamed to its final name,
+          so an interrupted run never leaves a truncated page file behind.
 
     Exceptions:
         - If there is an error creating the output directory or saving the JSON file, an error message is printed.
@@ -458,12 +789,559 @@ def create_page_json(person_list, page_number, input_name, output_directory):
 
     page_object = create_page_object(input_name, page_number, person_list)
 
+    temp_filename = None
     try:
         json_filename = f'{output_directory}/{input_name}_{page_number}.json'
-        with open(json_filename, 'w+') as output_file:
+        with tempfile.NamedTemporaryFile('w', dir=output_directory, suffix='.tmp', delete=False) as output_file:
+            temp_filename = output_file.name
             json.dump(page_object, output_file, indent=4)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.replace(temp_filename, json_filename)
+        return True
     except Exception as e:
         print(f"Failed to save JSON file: {e}")
+        if temp_filename and os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        return False
+
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens of a text for the Llama tokenizer.
+
+    Args:
+        text (str): The text to estimate the token count of.
+
+    Returns:
+        int: The estimated number of tokens.
+
+    Notes:
+        - The estimate assumes three characters per token, which is on the safe side for the short Dutch records in
+          the address books. It avoids loading a tokenizer, which is not always available on the compute nodes.
+    """
+    return math.ceil(len(text) / 3)
+
+
+def pack_lines(lines, token_budget, reply_tokens=48):
+    """
+    Groups consecutive lines into packs that fit a token budget, so that many records can be sent in one request.
+
+    Args:
+        lines (list): The preprocessed lines of a page.
+        token_budget (int): The maximum number of tokens a pack may use for its records and their replies.
+        reply_tokens (int, optional): The number of tokens reserved for the reply of each record. Defaults to 48.
+
+    Returns:
+        list: A list of packs, where each pack is a list of indices into `lines`.
+
+    Notes:
+        - The cost of a record is the estimated number of tokens of its numbered line plus `reply_tokens`, because the
+          reply grows with the number of records as well.
+        - A pack always contains at least one record, even if that record alone exceeds the budget.
+    """
+    packs = []
+    current_pack = []
+    current_tokens = 0
+    for index, line in enumerate(lines):
+        cost = estimate_tokens(f"{len(current_pack) + 1}. {line}\n") + reply_tokens
+        if current_pack and current_tokens + cost > token_budget:
+            packs.append(current_pack)
+            current_pack = []
+            current_tokens = 0
+        current_pack.append(index)
+        current_tokens += cost
+
+    if current_pack:
+        packs.append(current_pack)
+    return packs
+
+
+def make_packed_human_message(records, template=packed_prompt_template):
+    """
+    Generates the human input message for a pack of records, numbering the records from 1.
+
+    Args:
+        records (list): The lines of text that form the pack.
+        template (str, optional): The template used for formatting the records. Defaults to `packed_prompt_template`.
+
+    Returns:
+        str: The formatted message with the numbered records inserted into the template.
+    """
+    numbered_records = "\n".join(f"{number}. {record}" for number, record in enumerate(records, start=1))
+    prompt = make_prompt_template(template)
+    return prompt.format(records=numbered_records)
+
+
+def parse_packed_person_list(output, record_count):
+    """
+    Parses the reply to a packed request and splits the person records back onto the records of the pack.
+
+    Args:
+        output (str or None): The model's response, or `None` if the request failed.
+        record_count (int): The number of records in the pack.
+
+    Returns:
+        dict: A dictionary mapping the zero-based position of a record in the pack to the list of persons found in it.
+              Records the model did not answer for are absent from the dictionary.
+
+    Notes:
+        - The reply is first parsed as a whole JSON array. If that fails, the JSON-like objects are extracted one by
+          one, so that a single malformed object does not lose the rest of the pack.
+        - Objects without a valid `record` number are ignored. The `record` key is removed from the person records, so
+          that they follow the same format as the records of `process_line`.
+    """
+    results = {}
+    if not output:
+        print("Empty response from language model.")
+        return results
+
+    objects = []
+    try:
+        parsed = json.loads(output[output.index('['):output.rindex(']') + 1])
+        objects = [obj for obj in parsed if isinstance(obj, dict)]
+    except (ValueError, TypeError):
+        for obj in re.findall(r'\{.*?\}', output, re.DOTALL):
+            try:
+                objects.append(json.loads(obj))
+            except json.JSONDecodeError as e:
+                print(f"Error parsing JSON from model response: {e}")
+
+    for obj in objects:
+        try:
+            position = int(obj.pop("record")) - 1
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= position < record_count:
+            results.setdefault(position, []).append(obj)
+    return results
+
+
+def process_lines_packed(lines, client, MODEL, token_budget, cache=None, guided=False, max_tokens=None):
+    """
+    Processes the lines of a page by sending as many lines per request as fit the token budget.
+
+    Args:
+        lines (list): The preprocessed lines of a page.
+        client (OpenAI): The OpenAI-compatible client used to reach the server.
+        MODEL (str): The name of the model served by the server.
+        token_budget (int): The token budget of a pack, see `pack_lines`.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        guided (bool, optional): Whether to use schema-guided decoding, see `make_request_options`. Defaults to False.
+        max_tokens (int, optional): The maximum number of generated tokens per record. Defaults to None.
+
+    Returns:
+        list: A list with one list of person records per line, in the order of `lines`. Lines whose request failed
+              are `None`.
+
+    Notes:
+        - The system message with the packed JSON schema is sent once per pack instead of once per line.
+        - Lines that are missing from the reply of their pack are retried on their own with `process_line`.
+    """
+    system_message = make_system_message(schema=packed_json_schema)
+    line_options = make_request_options(guided, max_tokens)
+    person_lists = [None] * len(lines)
+    for pack in pack_lines(lines, token_budget):
+        human_message = make_packed_human_message([lines[index] for index in pack])
+        pack_options = make_request_options(guided, max_tokens, len(pack))
+        results = parse_packed_person_list(ask_llama(system_message, human_message, client, MODEL, cache, pack_options), len(pack))
+        for position, index in enumerate(pack):
+            person_lists[index] = results[position] if position in results else process_line(lines[index], client, MODEL, cache, line_options)
+    return person_lists
+
+
+async def process_lines_packed_async(lines, client, MODEL, token_budget, cache=None, guided=False, max_tokens=None):
+    """
+    Asynchronous counterpart of `process_lines_packed`, which sends the packs of a page concurrently.
+
+    Args:
+        lines (list): The preprocessed lines of a page.
+        client (AsyncOpenAI): The asynchronous OpenAI-compatible client used to reach the server.
+        MODEL (str): The name of the model served by the server.
+        token_budget (int): The token budget of a pack, see `pack_lines`.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        guided (bool, optional): Whether to use schema-guided decoding, see `make_request_options`. Defaults to False.
+        max_tokens (int, optional): The maximum number of generated tokens per record. Defaults to None.
+
+    Returns:
+        list: A list with one list of person records per line, in the order of `lines`. Lines whose request failed
+              are `None`.
+    """
+    system_message = make_system_message(schema=packed_json_schema)
+    line_options = make_request_options(guided, max_tokens)
+
+    async def process_pack(pack):
+        human_message = make_packed_human_message([lines[index] for index in pack])
+        pack_options = make_request_options(guided, max_tokens, len(pack))
+        output = await ask_llama_async(system_message, human_message, client, MODEL, cache, pack_options)
+        results = parse_packed_person_list(output, len(pack))
+        retries = [index for position, index in enumerate(pack) if position not in results]
+        retried = await asyncio.gather(*(process_line_async(lines[index], client, MODEL, cache, line_options) for index in retries))
+        pack_results = {index: results[position] for position, index in enumerate(pack) if position in results}
+        pack_results.update(zip(retries, retried))
+        return pack_results
+
+    person_lists = [None] * len(lines)
+    for pack_results in await asyncio.gather(*(process_pack(pack) for pack in pack_lines(lines, token_budget))):
+        for index, person_list in pack_results.items():
+            person_lists[index] = person_list
+    return person_lists
+
+
+# Patterns of the rule-based parser for well-formed entries, see `parse_line_rule_based`.
+FAST_PATH_LINE = re.compile(r"^(?P<surname>[A-Z][A-Za-z'-]*(?: [A-Za-z][A-Za-z'-]*){0,3}) ?\((?P<initials>[^()]{1,40})\) ?,? ?(?P<rest>[^()]*)$")
+FAST_PATH_INITIAL = re.compile(r"^(?:[A-Z][a-z]?\.|[A-Z][a-z]{1,3}\.|van|de|der|den|ter|ten|te|v\.|d\.|'t|la|le|du)$")
+FAST_PATH_ADDRESS = re.compile(r"^(?P<street>[A-Z][A-Za-z.' -]*[A-Za-z.]) ?(?P<number>\d+[a-zA-Z]?)$")
+# A street without a house number is only recognized by the usual endings of Dutch street names, because a job title
+# after the name ('Jansen (H.), Werkman') has the same form
+FAST_PATH_STREET = re.compile(r"^[A-Z][A-Za-z.' -]*(?:straat|str\.|weg|laan|plein|kade|gracht|singel|dijk|diep|markt|steeg|pad|dreef|hof|park|plantsoen|wal|haven|brug|ring|baan|zijde|kamp|gang|veld|oord|stede)$", re.IGNORECASE)
+
+
+def parse_line_rule_based(line):
+    """
+    Parses a well-formed address book entry without the language model.
+
+    Most entries follow the fixed format 'Surname (Initials), job, Street 12' that the system message describes. This
+    function parses such a line directly into the register format of the language model, and scores how confident it
+    is that the line follows the format.
+
+    Args:
+        line (str): A preprocessed line, see `PagePreprocessor`.
+
+    Returns:
+        tuple: A list with the parsed person record (empty if the line does not match the format at all), and a
+               confidence score between 0 and 1.
+
+    Example:
+        persons, confidence = parse_line_rule_based("De Vries (J. H.), Dokter, Hoofdstraat 12b")
+        print(persons)     # Output: [{'name': 'De Vries (J. H.)', 'jobTitle': 'Dokter', 'address': 'Hoofdstraat 12b'}]
+        print(confidence)  # Output: 1.0
+
+    Notes:
+        - The confidence is lowered for initials that are not initials, titles or name prefixes, for an address without
+          a house number, more so if it does not end like a street name, for more than one job field, and for digits
+          in the name or job. An address without a house number always scores below 0.8.
+        - `split_text` joins the house number to the street name without a space ('Zuiderdiep46b'). The address is
+          returned with a space between them ('Zuiderdiep 46b'), like the examples in the system message.
+        - Lines with more than one person (more than one pair of parentheses) do not match, and are left to the
+          language model.
+    """
+    match = FAST_PATH_LINE.match(line.strip())
+    if not match:
+        return [], 0.0
+
+    surname = match.group("surname").strip()
+    initials = " ".join(match.group("initials").split())
+    parts = [part.strip() for part in match.group("rest").split(",") if part.strip()]
+    if not parts:
+        return [], 0.0
+
+    address = parts[-1]
+    job_title = ", ".join(parts[:-1])
+    confidence = 1.0
+    if not all(FAST_PATH_INITIAL.match(initial) for initial in initials.split()):
+        confidence -= 0.4
+    address_match = FAST_PATH_ADDRESS.match(address)
+    if address_match:
+        address = f"{address_match.group('street')} {address_match.group('number')}"
+    else:
+        # Below the suggested threshold of 0.8 even for a street name, which is left to the language model
+        confidence -= 0.25 if FAST_PATH_STREET.match(address) else 0.5
+    if len(parts) > 2:
+        confidence -= 0.3
+    if any(character.isdigit() for character in surname + job_title):
+        confidence -= 0.3
+
+    person = {"name": f"{surname} ({initials})", "jobTitle": job_title, "address": address}
+    return [person], round(max(confidence, 0.0), 2)
+
+
+def prepare_page(page_number, page_lines, journal=None, fast_path_threshold=None):
+    """
+    Collects the results of the lines of a page that do not need the language model.
+
+    Args:
+        page_number (int): The page number.
+        page_lines (list): The preprocessed lines of the page.
+        journal (ProgressJournal, optional): The journal with the stored line results of earlier runs. Defaults to None.
+        fast_path_threshold (float, optional): The minimum confidence of `parse_line_rule_based` for a line to be
+                                               parsed without the language model. Defaults to None, which sends all
+                                               lines to the language model.
+
+    Returns:
+        tuple: The list with the person records of each line (`None` for lines that still have to be processed), and the
+               list of the indices of those lines.
+
+    Notes:
+        - Lines parsed by the rule-based parser are recorded in the journal, and counted in the statistics of the
+          current call, see `run_stats`.
+    """
+    person_list = journal.stored_results(page_number, page_lines) if journal else [None] * len(page_lines)
+    pending = [line_number for line_number, persons in enumerate(person_list) if persons is None]
+
+    if fast_path_threshold is not None:
+        remaining = []
+        for line_number in pending:
+            persons, confidence = parse_line_rule_based(page_lines[line_number])
+            if persons and confidence >= fast_path_threshold:
+                person_list[line_number] = persons
+                if journal:
+                    journal.record_line(page_number, line_number, page_lines[line_number], persons)
+            else:
+                remaining.append(line_number)
+        count("fast_path_lines", len(pending) - len(remaining))
+        pending = remaining
+
+    count("llm_lines", len(pending))
+    return person_list, pending
+
+
+def store_results(page_number, page_lines, person_list, line_numbers, results, journal=None):
+    """
+    Stores the results of processed lines of a page, and collects the lines whose request failed.
+
+    Args:
+        page_number (int): The page number.
+        page_lines (list): The preprocessed lines of the page.
+        person_list (list): The list with the person records of each line of the page, which is updated in place.
+        line_numbers (list): The indices of the processed lines.
+        results (iterable): The person records of each processed line, or `None` for lines whose request failed.
+        journal (ProgressJournal, optional): The journal in which the results are recorded. Defaults to None.
+
+    Returns:
+        list: The indices of the lines whose request failed, which form the retry queue of the page.
+    """
+    failed = []
+    for line_number, persons in zip(line_numbers, results):
+        if persons is None:
+            failed.append(line_number)
+            continue
+        person_list[line_number] = persons
+        if journal:
+            journal.record_line(page_number, line_number, page_lines[line_number], persons)
+    return failed
+
+
+def finish_page(person_list, failed, page_number, input_name, output_directory, journal=None):
+    """
+    Saves the JSON file of a page, and marks the page as done in the journal if none of its lines failed.
+
+    Args:
+        person_list (list): The list with the person records of each line of the page.
+        failed (list): The indices of the lines that still failed after all retries.
+        page_number (int): The page number.
+        input_name (str): The name of input file containing the text.
+        output_directory (str): The directory where the JSON file will be saved.
+        journal (ProgressJournal, optional): The journal in which the progress is recorded. Defaults to None.
+
+    Notes:
+        - Failed lines are saved as empty lists. Because the page is not marked as done, a run with `--resume` sends
+          only those lines to the language model again.
+    """
+    for line_number in failed:
+        person_list[line_number] = []
+    if failed:
+        count("failed_lines", len(failed))
+        print(f"Page {page_number}: {len(failed)} lines failed after all retries.")
+    if create_page_json(person_list, page_number, input_name, output_directory) and journal and not failed:
+        journal.record_page(page_number)
+
+
+def extract_pages(text_list, first_page, input_name, output_directory, base_urls, api_key, MODEL, timeout=60.0, pack_tokens=0, cache=None, journal=None, guided=False, max_tokens=None, fast_path_threshold=None, retries=3, line_retries=2, stop=None):
+    """
+    Extracts the people of a range of pages one request at a time, and saves a JSON file per page.
+
+    Args:
+        text_list (list): The OCR text of the pages to process.
+        first_page (int): The page number of the first page in `text_list`.
+        input_name (str): The name of input file containing the text.
+        output_directory (str): The directory where the JSON files will be saved.
+        base_urls (list): The base URLs of the OpenAI-compatible servers, see `ClientPool`.
+        api_key (str): The API key of the servers.
+        MODEL (str): The name of the model served by the server.
+        timeout (float, optional): The timeout per request in seconds. Defaults to 60.0.
+        pack_tokens (int, optional): The token budget for packing several lines into one request. Defaults to 0.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        journal (ProgressJournal, optional): The journal in which the progress is recorded. Pages that the journal marks
+                                             as done are skipped, and stored line results are reused. Defaults to None.
+        guided (bool, optional): Whether to use schema-guided decoding, see `make_request_options`. Defaults to False.
+        max_tokens (int, optional): The maximum number of generated tokens per record. Defaults to None.
+        fast_path_threshold (float, optional): The minimum confidence for a line to be parsed without the language
+                                               model, see `prepare_page`. Defaults to None.
+        retries (int, optional): The number of times a request is retried with backoff after a retryable error, see
+                                 `RetryPolicy`. Defaults to 3.
+        line_retries (int, optional): The number of rounds in which the failed lines of a page are sent again before the
+                                      page is saved. Defaults to 2.
+        stop (threading.Event, optional): An event that stops the extraction when it is set: no further page is started
+                                          or saved. Defaults to None.
+
+    Returns:
+        Counter: The numbers of requests, lines and tokens of this call.
+    """
+    client = ClientPool(base_urls, api_key, timeout, retry_policy=RetryPolicy(retries))
+    preprocessor = PagePreprocessor()
+    options = make_request_options(guided, max_tokens)
+    with collect_stats() as stats:
+        for index, page_lines in tqdm(enumerate(preprocessor.iter_pages(text_list)), total=len(text_list), desc='Processing Pages', unit='page', ncols=100):
+            page_number = first_page + index
+            if stop is not None and stop.is_set():
+                break
+            if journal and journal.is_page_done(page_number):
+                continue
+
+            person_list, pending = prepare_page(page_number, page_lines, journal, fast_path_threshold)
+            if pack_tokens > 0:
+                results = process_lines_packed([page_lines[line_number] for line_number in pending], client, MODEL, pack_tokens, cache, guided, max_tokens)
+            else:
+                results = (process_line(page_lines[line_number], client, MODEL, cache, options) for line_number in pending)
+            failed = store_results(page_number, page_lines, person_list, pending, results, journal)
+
+            for _ in range(line_retries):
+                if not failed:
+                    break
+                count("retried_lines", len(failed))
+                results = (process_line(page_lines[line_number], client, MODEL, cache, options) for line_number in failed)
+                failed = store_results(page_number, page_lines, person_list, failed, results, journal)
+
+            if stop is not None and stop.is_set():
+                break
+            finish_page(person_list, failed, page_number, input_name, output_directory, journal)
+    print(client.report())
+    return stats
+
+
+async def process_page_async(page_lines, page_number, input_name, output_directory, client, MODEL, pack_tokens=0, cache=None, journal=None, guided=False, max_tokens=None, fast_path_threshold=None, line_retries=2, stop=None):
+    """
+    Extracts the people of a single page by dispatching all of its lines concurrently, and saves the page JSON.
+
+    Args:
+        page_lines (list): The preprocessed lines of the page, see `PagePreprocessor`.
+        page_number (int): The page number of the document being processed.
+        input_name (str): The name of input file containing the text.
+        output_directory (str): The directory where the JSON file will be saved.
+        client (AsyncClientPool): The pool of asynchronous OpenAI-compatible clients used to reach the servers.
+        MODEL (str): The name of the model served by the server.
+        pack_tokens (int, optional): The token budget for packing several lines into one request. Defaults to 0,
+                                     which sends one request per line.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        journal (ProgressJournal, optional): The journal in which the progress is recorded, see `extract_pages`.
+                                             Defaults to None.
+        guided (bool, optional): Whether to use schema-guided decoding, see `make_request_options`. Defaults to False.
+        max_tokens (int, optional): The maximum number of generated tokens per record. Defaults to None.
+        fast_path_threshold (float, optional): The minimum confidence for a line to be parsed without the language
+                                               model, see `prepare_page`. Defaults to None.
+        line_retries (int, optional): The number of rounds in which the failed lines of the page are sent again before
+                                      the page is saved. Defaults to 2.
+        stop (threading.Event, optional): An event that stops the extraction when it is set, see `extract_pages`.
+                                          Defaults to None.
+
+    Notes:
+        - `asyncio.gather` returns the results in the order of the lines on the page, regardless of the order in which
+          the requests complete, so the page JSON is identical to the one written by the serial extraction.
+        - The failed lines are retried after the other lines of the page have finished, so that the retries of one
+          page do not hold up the requests of the other pages.
+    """
+    if journal and journal.is_page_done(page_number):
+        return
+
+    person_list, pending = prepare_page(page_number, page_lines, journal, fast_path_threshold)
+    options = make_request_options(guided, max_tokens)
+
+    if pack_tokens > 0:
+        results = await process_lines_packed_async([page_lines[line_number] for line_number in pending], client, MODEL, pack_tokens, cache, guided, max_tokens)
+    else:
+        results = await asyncio.gather(*(process_line_async(page_lines[line_number], client, MODEL, cache, options) for line_number in pending))
+    failed = store_results(page_number, page_lines, person_list, pending, results, journal)
+
+    for _ in range(line_retries):
+        if not failed:
+            break
+        count("retried_lines", len(failed))
+        results = await asyncio.gather(*(process_line_async(page_lines[line_number], client, MODEL, cache, options) for line_number in failed))
+        failed = store_results(page_number, page_lines, person_list, failed, results, journal)
+
+    if stop is not None and stop.is_set():
+        return
+    finish_page(person_list, failed, page_number, input_name, output_directory, journal)
+
+
+async def cancel_on_stop(stop, tasks, interval=1.0):
+    """
+    Cancels the page tasks of `process_pages_async` once `stop` is set, checking every `interval` seconds.
+    """
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+    for task in tasks:
+        task.cancel()
+
+
+async def process_pages_async(text_list, first_page, input_name, output_directory, base_urls, api_key, MODEL, concurrency=16, timeout=60.0, pack_tokens=0, cache=None, journal=None, guided=False, max_tokens=None, fast_path_threshold=None, retries=3, line_retries=2, adaptive=False, max_concurrency=None, stop=None):
+    """
+    Extracts the people of a range of pages with many requests in flight at the same time.
+
+    All pages are scheduled at once and their lines share a single limit of in-flight requests, so the continuous
+    batching of the server is kept busy instead of waiting for one round trip per line.
+
+    Args:
+        text_list (list): The OCR text of the pages to process.
+        first_page (int): The page number of the first page in `text_list`.
+        input_name (str): The name of input file containing the text.
+        output_directory (str): The directory where the JSON files will be saved.
+        base_urls (list): The base URLs of the OpenAI-compatible servers, see `ClientPool`.
+        api_key (str): The API key of the servers.
+        MODEL (str): The name of the model served by the server.
+        concurrency (int, optional): The (initial) number of requests in flight. Defaults to 16.
+        timeout (float, optional): The timeout per request in seconds. Defaults to 60.0.
+        pack_tokens (int, optional): The token budget for packing several lines into one request. Defaults to 0.
+        cache (ResponseCache, optional): The response cache to consult before calling the server. Defaults to None.
+        journal (ProgressJournal, optional): The journal in which the progress is recorded, see `extract_pages`.
+                                             Defaults to None.
+        guided (bool, optional): Whether to use schema-guided decoding, see `make_request_options`. Defaults to False.
+        max_tokens (int, optional): The maximum number of generated tokens per record. Defaults to None.
+        fast_path_threshold (float, optional): The minimum confidence for a line to be parsed without the language
+                                               model, see `prepare_page`. Defaults to None.
+        retries (int, optional): The number of times a request is retried with backoff, see `RetryPolicy`. Defaults to 3.
+        line_retries (int, optional): The number of retry rounds of the failed lines of a page, see `process_page_async`.
+                                      Defaults to 2.
+        adaptive (bool, optional): Whether to adapt the number of requests in flight to the latency and errors of the
+                                   servers, see `AdaptiveLimiter`. Defaults to False, which keeps it at `concurrency`.
+        max_concurrency (int, optional): The upper bound of the adaptive limit. Defaults to 4 times `concurrency`.
+        stop (threading.Event, optional): An event that stops the extraction when it is set: the pages in progress are
+                                          cancelled without being saved. Defaults to None.
+
+    Returns:
+        Counter: The numbers of requests, lines and tokens of this call.
+
+    Notes:
+        - A single `httpx.AsyncClient` with keep-alive connections is shared by all requests, and its connection pool is
+          sized to the largest limit the `AdaptiveLimiter` can reach.
+        - Every request is routed to the least-loaded healthy server of the `AsyncClientPool`.
+    """
+    max_concurrency = (max_concurrency or 4 * concurrency) if adaptive else concurrency
+    limiter = AdaptiveLimiter(concurrency, max_concurrency, adaptive=adaptive)
+    limits = httpx.Limits(max_connections=limiter.max_limit, max_keepalive_connections=limiter.max_limit)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as http_client:
+        client = AsyncClientPool(base_urls, api_key, http_client, timeout, retry_policy=RetryPolicy(retries), limiter=limiter)
+        preprocessor = PagePreprocessor()
+        # The tasks copy the context when they are created, so they add to the statistics of this call
+        with collect_stats() as stats:
+            tasks = [
+                asyncio.create_task(process_page_async(page_lines, first_page + index, input_name, output_directory, client, MODEL, pack_tokens, cache, journal, guided, max_tokens, fast_path_threshold, line_retries, stop))
+                for index, page_lines in enumerate(preprocessor.iter_pages(text_list))
+            ]
+        watcher = asyncio.create_task(cancel_on_stop(stop, tasks)) if stop is not None else None
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc='Processing Pages', unit='page', ncols=100):
+            try:
+                await task
+            except asyncio.CancelledError:
+                if stop is None or not stop.is_set():
+                    raise
+        if watcher:
+            watcher.cancel()
+        print(client.report())
+        if adaptive:
+            print(limiter.report())
+    return stats
 
 
 def main():
@@ -472,6 +1350,22 @@ def main():
     parser.add_argument("-o", "--output", type=str, help="Path to the output directory.")
     parser.add_argument("-s", "--start_page", type=int, required=True, help="First page you want to process.")
     parser.add_argument("-e", "--end_page", type=int, required=True, help="Last page you want to process.")
+    parser.add_argument("-n", "--concurrency", type=int, help="Maximum number of LLM requests in flight. A value above 1 enables the asynchronous extraction. Default: 1", default=1)
+    parser.add_argument("-p", "--pack_tokens", type=int, help="Token budget for packing several lines into one LLM request. Default: 0 (one line per request)", default=0)
+    parser.add_argument("-g", "--guided", action="store_true", help="Constrain the LLM output to the JSON schema of a list of persons with the guided decoding of vLLM.")
+    parser.add_argument("-m", "--max_tokens", type=int, help="Maximum number of tokens the LLM may generate per line. Default: no limit", default=None)
+    parser.add_argument("-f", "--fast_path_threshold", type=float, help="Parse well-formed lines with a rule-based parser instead of the LLM if its confidence is at least this value (0-1), e.g. 0.8. Default: send all lines to the LLM", default=None)
+    parser.add_argument("--cache_dir", type=str, help="Directory of the persistent LLM response cache. Default: 'llm_cache' in the current working directory.", default="./llm_cache")
+    parser.add_argument("--cache_size", type=float, help="Maximum size of the LLM response cache in MB. Default: 1024", default=1024)
+    parser.add_argument("--no_cache", action="store_true", help="Do not read from or write to the LLM response cache.")
+    parser.add_argument("-r", "--resume", action="store_true", help="Resume an interrupted run from the progress journal in the output directory.")
+    parser.add_argument("--endpoints", type=str, nargs="+", help="Base URLs of one or more LLM servers. Requests are routed to the least-loaded healthy server. Default: http://localhost:8000/v1/", default=None)
+    parser.add_argument("--endpoints_file", type=str, help="Path to a file with the base URL of one LLM server per line, instead of --endpoints.", default=None)
+    parser.add_argument("-t", "--timeout", type=float, help="Timeout per LLM request in seconds. Default: 60", default=60.0)
+    parser.add_argument("--retries", type=int, help="Number of retries with exponential backoff of an LLM request after a timeout, connection, overload or server error. Default: 3", default=3)
+    parser.add_argument("--line_retries", type=int, help="Number of rounds in which the failed lines of a page are sent again before the page is saved. Default: 2", default=2)
+    parser.add_argument("--adaptive", action="store_true", help="Adapt the number of LLM requests in flight to the latency and errors of the servers, starting at --concurrency. Enables the asynchronous extraction.")
+    parser.add_argument("--max_concurrency", type=int, help="Upper bound of the adaptive number of LLM requests in flight. Default: 4 times --concurrency", default=None)
 
     args = parser.parse_args()
 
@@ -495,12 +1389,31 @@ def main():
 
     print(f"Start at page: {args.start_page}")
     print(f"End at page: {args.end_page}")
+    print(f"Concurrency: {args.concurrency}{' (adaptive)' if args.adaptive else ''}")
+    if args.pack_tokens > 0:
+        print(f"Packing token budget: {args.pack_tokens}")
+    if args.guided:
+        print("Using schema-guided decoding")
 
     BASEURL = 'http://localhost:8000/v1/'
     APIKEY = 'EMPTY'
     MODEL = "meta-llama/Llama-3.1-8B-Instruct"
 
-    client = OpenAI(base_url=BASEURL,api_key=APIKEY)
+    if args.endpoints_file:
+        endpoints = load_endpoints(args.endpoints_file)
+    else:
+        endpoints = args.endpoints or [BASEURL]
+    print(f"LLM endpoints: {', '.join(endpoints)}")
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, args.cache_size)
+        print(f"LLM cache: {os.path.abspath(args.cache_dir)}")
+
+    journal_path = os.path.join(output_directory, f"{input_name}_journal.jsonl")
+    journal = ProgressJournal(journal_path, resume=args.resume)
+    if args.resume:
+        print(f"Resuming from {journal_path}: {len(journal.done_pages)} pages done, {len(journal.lines)} line results stored")
 
     data = load_json(path_to_json)
     first_page = args.start_page
@@ -508,13 +1421,34 @@ def main():
 
     if data:
         text_list = get_text(data, first_page, last_page)
-        for index, page in tqdm(enumerate(text_list), total=len(text_list), desc='Processing Pages', unit='page', ncols=100):
-            person_list = []
-            page_number = first_page + index
-            page_lines = process_page(page)
-            for line in page_lines:
-                person_list.append(process_line(preprocess_line(line), client, MODEL))
-            create_page_json(person_list, page_number, input_name, output_directory)
+        try:
+            if args.concurrency > 1 or args.adaptive:
+                stats = asyncio.run(process_pages_async(text_list, first_page, input_name, output_directory, endpoints, APIKEY, MODEL, args.concurrency, args.timeout, args.pack_tokens, cache, journal, args.guided, args.max_tokens, args.fast_path_threshold, args.retries, args.line_retries, args.adaptive, args.max_concurrency))
+            else:
+                stats = extract_pages(text_list, first_page, input_name, output_directory, endpoints, APIKEY, MODEL, args.timeout, args.pack_tokens, cache, journal, args.guided, args.max_tokens, args.fast_path_threshold, args.retries, args.line_retries)
+        except openai.OpenAIError as e:
+            # An error that retrying cannot fix, e.g. an invalid request; the progress so far is kept in the journal
+            print(f"API request failed: {e}")
+            journal.close()
+            if cache:
+                cache.close()
+            exit(1)
+
+        tokens_per_line = stats["completion_tokens"] / stats["llm_lines"] if stats["llm_lines"] else 0.0
+        print(f"LLM usage: {stats['llm_lines']} lines, {stats['requests']} requests, {stats['prompt_tokens']} prompt tokens, "
+              f"{stats['completion_tokens']} decoded tokens ({tokens_per_line:.1f} per line)")
+        if args.fast_path_threshold is not None:
+            total_lines = stats["fast_path_lines"] + stats["llm_lines"]
+            fast_path_share = 100 * stats["fast_path_lines"] / total_lines if total_lines else 0.0
+            print(f"Rule-based parser: {stats['fast_path_lines']} of {total_lines} lines ({fast_path_share:.1f}%), LLM: {stats['llm_lines']} lines")
+        if stats["retried_lines"]:
+            print(f"Retried lines: {stats['retried_lines']}, failed after all retries: {stats['failed_lines']}")
+
+    journal.close()
+
+    if cache:
+        print(cache.stats())
+        cache.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
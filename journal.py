@@ -0,0 +1,115 @@
+import os
+import json
+
+
+class ProgressJournal:
+    """
+    Append-only journal of the progress of `extract_people.py` for a single book.
+
+    Every line with a result and every page that was saved is appended as one JSON record to the journal, and the
+    file is flushed after each record. After an interruption, a run with `resume=True` reads the journal back, skips
+    the pages that were already saved and reuses the stored results of the lines of half-done pages, so that no line
+    with a stored result is sent to the language model again.
+
+    Args:
+        path (str): The path to the journal file.
+        resume (bool, optional): Whether to continue from an existing journal. If False, the journal is started
+                                 anew. Defaults to False.
+
+    Notes:
+        - The journal contains two kinds of records:
+            - `{"page": 12, "line": 3, "text": "...", "persons": [...]}` for the result of a line.
+            - `{"page": 12, "done": true}` once the JSON file of the page has been saved.
+        - A stored line result is only reused if the text of the line is unchanged, so a changed preprocessing step
+          does not silently reuse results of different lines.
+        - A truncated last record, as left behind by a crash during a write, is ignored.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done_pages = set()
+        self.lines = {}
+
+        truncated = False
+        if resume and os.path.exists(path):
+            truncated = self.load()
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if truncated:
+            self.file.write("\n")
+
+    def load(self):
+        """
+        Reads the records of an existing journal.
+
+        Returns:
+            bool: True if the last record is truncated, so that the next record has to start on a new line.
+        """
+        line = "\n"
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("done"):
+                    self.done_pages.add(record["page"])
+                elif "line" in record:
+                    self.lines[(record["page"], record["line"])] = (record["text"], record["persons"])
+        return not line.endswith("\n")
+
+    def is_page_done(self, page_number):
+        """
+        Returns whether the JSON file of a page has already been saved.
+        """
+        return page_number in self.done_pages
+
+    def stored_results(self, page_number, page_lines):
+        """
+        Returns the stored results of the lines of a page.
+
+        Args:
+            page_number (int): The page number.
+            page_lines (list): The preprocessed lines of the page.
+
+        Returns:
+            list: A list with the stored person records of each line, or `None` for lines without a stored result.
+        """
+        results = []
+        for index, line in enumerate(page_lines):
+            text, persons = self.lines.get((page_number, index), (None, None))
+            results.append(persons if text == line else None)
+        return results
+
+    def record_line(self, page_number, line_number, line, persons):
+        """
+        Appends the result of a line to the journal.
+
+        Args:
+            page_number (int): The page number.
+            line_number (int): The index of the line on the page.
+            line (str): The preprocessed text of the line.
+            persons (list): The person records extracted from the line, or `None` if its request failed.
+
+        Notes:
+            - An empty list is a valid result of a line without persons, and is recorded. Lines whose request failed
+              are not recorded, so they are sent again on resume.
+        """
+        if persons is None:
+            return
+        self.lines[(page_number, line_number)] = (line, persons)
+        self.write({"page": page_number, "line": line_number, "text": line, "persons": persons})
+
+    def record_page(self, page_number):
+        """
+        Marks a page as done after its JSON file has been saved, and syncs the journal to disk.
+        """
+        self.done_pages.add(page_number)
+        self.write({"page": page_number, "done": True})
+        os.fsync(self.file.fileno())
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
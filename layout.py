@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+
+
+def find_runs(mask, min_gap=1, min_length=1):
+    """
+    Finds the runs of True values in a profile.
+
+    Parameters:
+        mask (numpy.ndarray): Boolean profile.
+        min_gap (int): Runs separated by fewer than `min_gap` False values are merged.
+        min_length (int): Runs shorter than `min_length` (after merging) are dropped.
+
+    Returns:
+        list: The (start, stop) of every run.
+    """
+    padded = np.concatenate(([False], mask, [False]))
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    runs = []
+    for start, stop in zip(changes[::2], changes[1::2]):
+        if runs and start - runs[-1][1] < min_gap:
+            runs[-1] = (runs[-1][0], stop)
+        else:
+            runs.append((start, stop))
+    return [(int(start), int(stop)) for start, stop in runs if stop - start >= min_length]
+
+
+def find_columns(dark, min_gap_fraction=0.02, min_width_fraction=0.05):
+    """
+    Finds the text columns of a page from the vertical projection profile of its text.
+
+    Parameters:
+        dark (numpy.ndarray): Binary mask of the text of the page, smeared horizontally, see `find_regions`.
+        min_gap_fraction (float): Minimum width of the gap between two columns, as a fraction of the page width.
+        min_width_fraction (float): Minimum width of a column, as a fraction of the page width. Narrower runs, such as
+                                    the rules between columns, are dropped.
+
+    Returns:
+        list: The (left, right) of every column, from left to right.
+    """
+    width = dark.shape[1]
+    profile = dark.mean(axis=0)
+    # A column rule or a speck of noise only covers a few rows, text covers a noticeable part of the page height
+    return find_runs(profile > 0.01, max(int(width * min_gap_fraction), 1), int(width * min_width_fraction))
+
+
+def find_blocks(dark, min_gap):
+    """
+    Finds the blocks of text lines within a column from its horizontal projection profile.
+
+    Parameters:
+        dark (numpy.ndarray): Binary mask of the text of the column.
+        min_gap (int): Minimum height of the empty space between two blocks, in pixels.
+
+    Returns:
+        list: The (top, bottom) of every block, from top to bottom.
+    """
+    return find_runs(dark.any(axis=1), min_gap, 3)
+
+
+def find_regions(binary_image, block_gap_fraction=0.015, margin=5):
+    """
+    Segments a binarized page into columns, and every column into blocks of text lines.
+
+    The dark pixels are first smeared horizontally with a morphological dilation, so that the gaps between letters and
+    words do not split a column, while the wider gaps between columns remain. Columns are found from the vertical
+    projection profile of the page, and blocks from the horizontal projection profile of every column.
+
+    Parameters:
+        binary_image (numpy.ndarray): Binarized page with dark text on a light background.
+        block_gap_fraction (float): Minimum height of the empty space between two blocks, as a fraction of the page height.
+        margin (int): Number of pixels kept around every region.
+
+    Returns:
+        list: The (top, bottom, left, right) of every region in reading order: the columns from left to right, and the
+              blocks of a column from top to bottom. An empty list if the page has no text.
+    """
+    height, width = binary_image.shape[:2]
+    dark = (binary_image < 128).astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 150, 3), 1))
+    smeared = cv2.dilate(dark, kernel)
+
+    regions = []
+    block_gap = max(int(height * block_gap_fraction), 1)
+    for left, right in find_columns(smeared):
+        for top, bottom in find_blocks(smeared[:, left:right], block_gap):
+            regions.append((max(top - margin, 0), min(bottom + margin, height), max(left - margin, 0), min(right + margin, width)))
+    return regions
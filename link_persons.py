@@ -0,0 +1,438 @@
+import os
+import re
+import csv
+import time
+import argparse
+import functools
+import multiprocessing
+from collections import Counter, defaultdict
+from convert_json_to_csv import iter_pages, iter_persons, find_inputs, COLUMNS
+from persons_db import text, normalize, normalize_initials, split_name, split_address
+
+# Name prefixes that are not indexed under their first letter ('De Vries' is found under V)
+NAME_PREFIXES = {"van", "de", "der", "den", "ter", "ten", "te", "t", "het", "la", "le", "du", "v", "d"}
+# Spelling variants and frequent OCR confusions of Dutch surnames, applied in order by `phonetic`
+PHONETIC_RULES = [
+    (re.compile(r"ij|y"), "ei"), (re.compile(r"ae|aa"), "a"), (re.compile(r"ee"), "e"), (re.compile(r"oo"), "o"),
+    (re.compile(r"uu"), "u"), (re.compile(r"ou|au"), "ou"), (re.compile(r"sch"), "s"), (re.compile(r"ch|g"), "g"),
+    (re.compile(r"ck|c|q"), "k"), (re.compile(r"ph|v"), "f"), (re.compile(r"z"), "s"), (re.compile(r"dt|d$"), "t"),
+    (re.compile(r"([^aeiou])h"), r"\1"), (re.compile(r"(.)\1+"), r"\1"),
+]
+# The blocking passes: records are only compared if they have the same key in at least one pass
+PASSES = ["surname+street", "surname+initials", "street+number"]
+
+
+@functools.lru_cache(maxsize=65536)
+def phonetic(surname):
+    """
+    Returns a phonetic code of a normalized surname, which is the same for spelling variants such as 'Meijer', 'Meyer'
+    and 'Meier', or 'Smit' and 'Schmidt', and for many OCR errors in the vowels.
+
+    Args:
+        surname (str): The surname, normalized with `normalize`.
+
+    Returns:
+        str: The phonetic code, or "" if the surname has no letters.
+    """
+    words = [word for word in surname.split() if word not in NAME_PREFIXES] or surname.split()
+    code = "".join(character for character in "".join(words) if character.isalpha())
+    for pattern, replacement in PHONETIC_RULES:
+        code = pattern.sub(replacement, code)
+    return code
+
+
+@functools.lru_cache(maxsize=1 << 18)
+def jaro_winkler(a, b):
+    """
+    Returns the Jaro-Winkler similarity of two strings, between 0 (nothing in common) and 1 (equal). The same surnames,
+    streets and job titles are compared over and over, so the similarities are cached.
+    """
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    window = max(max(len(a), len(b)) // 2 - 1, 0)
+    matched_b = [False] * len(b)
+    matches_a = []
+    for i, character in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not matched_b[j] and b[j] == character:
+                matched_b[j] = True
+                matches_a.append(character)
+                break
+    if not matches_a:
+        return 0.0
+    matches_b = [character for character, matched in zip(b, matched_b) if matched]
+    transpositions = sum(x != y for x, y in zip(matches_a, matches_b)) / 2
+    m = len(matches_a)
+    jaro = (m / len(a) + m / len(b) + (m - transpositions) / m) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+
+def load_records(input_files):
+    """
+    Reads the persons of CSV files of `convert_json_to_csv.py` or combined JSONs of `combine_jsons.py`.
+
+    Args:
+        input_files (list): The paths to the files.
+
+    Returns:
+        list: A list of (year, page, name, job title, address) tuples, in the order of the files.
+    """
+    records = []
+    for input_file in input_files:
+        if input_file.endswith(".csv"):
+            with open(input_file, 'r', encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    records.append(tuple(row.get(column, "") for column in COLUMNS))
+        else:
+            for year, page in iter_pages(input_file):
+                for entry in iter_persons(page.get("register", [])):
+                    records.append((text(year), page.get("page", "Unknown"), text(entry.get("name")), text(entry.get("jobTitle")), text(entry.get("address"))))
+    return records
+
+
+def make_features(record):
+    # The fields that blocking and scoring use: the year as a number, the keys of the surname, initials and street, the
+    # house number, the normalized job title, and the blocking key of every pass. Blocking keys are only compared, so
+    # their hashes are stored instead of the tuples, which saves most of the memory of the features.
+    year, _, name, job_title, address = record
+    year = str(year)
+    surname, initials = split_name(name)
+    street, house_number = split_address(address)
+    surname_key, initials_key, street_key = normalize(surname), normalize_initials(initials), normalize(street)
+    code = phonetic(surname_key)
+    keys = (
+        hash((code, street_key)) if code and street_key else None,
+        hash((code, initials_key)) if code and initials_key else None,
+        hash((street_key, house_number.lower())) if street_key and house_number else None,
+    )
+    return (int(year) if year.isdigit() else None, surname_key, initials_key, street_key, house_number.lower(), normalize(job_title), keys)
+
+
+def initials_similarity(a, b):
+    if not a or not b:
+        return 0.5
+    if a == b:
+        return 1.0
+    if a.startswith(b) or b.startswith(a):
+        return 0.7
+    return 0.4 if a[0] == b[0] else 0.0
+
+
+def score(a, b):
+    """
+    Scores how likely two records are the same person, between 0 and 1.
+
+    The score is a weighted sum of the similarity of the surnames (0.35), the initials (0.25), the addresses (0.3, of
+    which 0.21 for the street and 0.09 for the house number) and the job titles (0.1). A person who moved, but whose
+    name and job did not change, still scores about 0.8.
+
+    Args:
+        a (tuple): The features of the first record, see `make_features`.
+        b (tuple): The features of the second record.
+
+    Returns:
+        float: The score.
+    """
+    surname = jaro_winkler(a[1], b[1])
+    initials = initials_similarity(a[2], b[2])
+    street = jaro_winkler(a[3], b[3])
+    house_number = 0.5 if not a[4] or not b[4] else float(a[4] == b[4])
+    job_title = 0.5 if not a[5] or not b[5] else jaro_winkler(a[5], b[5])
+    return 0.35 * surname + 0.25 * initials + 0.21 * street + 0.09 * house_number + 0.1 * job_title
+
+
+# The features of all records, set in every worker process by `init_worker`
+FEATURES = None
+
+
+def init_worker(features):
+    global FEATURES
+    FEATURES = features
+
+
+def compare_block(task):
+    """
+    Scores the pairs of records of a block from different years that are at most `max_gap` years apart.
+
+    Pairs that already have the same key in an earlier pass were compared in that pass, and are skipped, so every pair
+    is compared only once. The keys of skipped blocks are cleared by `make_blocks`, so their pairs are still compared
+    in a later pass.
+
+    Args:
+        task (tuple): The index of the pass, the indices of the records of the block, the maximum number of years
+                      between two records, and the minimum score of a match.
+
+    Returns:
+        tuple: The number of compared pairs, and a list of (score, record index, record index) tuples of the pairs that
+               scored at least the minimum score.
+    """
+    pass_index, indices, max_gap, threshold = task
+    indices = sorted(indices, key=lambda index: FEATURES[index][0])
+    compared = 0
+    matches = []
+    for position, i in enumerate(indices):
+        a = FEATURES[i]
+        for j in indices[position + 1:]:
+            b = FEATURES[j]
+            gap = b[0] - a[0]
+            if gap == 0:
+                continue
+            if gap > max_gap:
+                break
+            if any(a[6][earlier] is not None and a[6][earlier] == b[6][earlier] for earlier in range(pass_index)):
+                continue
+            compared += 1
+            pair_score = score(a, b)
+            if pair_score >= threshold:
+                matches.append((pair_score, i, j))
+    return compared, matches
+
+
+def make_blocks(features, max_block):
+    """
+    Groups the records by their blocking key, for every pass.
+
+    The key of a skipped block is cleared in the features of its records, because `compare_block` skips the pairs that
+    share a key of an earlier pass, and the pairs of a skipped block were not compared in that pass.
+
+    Args:
+        features (list): The features of all records, see `make_features`. Modified in place.
+        max_block (int): The maximum number of records of a block. Larger blocks are skipped, because comparing them
+                         would take too long; they are the most frequent surnames on the most frequent streets.
+
+    Returns:
+        tuple: A list of (pass index, record indices) tuples of the blocks with records from more than one year, and a
+               Counter of the number of records in skipped blocks per pass.
+    """
+    blocks = []
+    skipped = Counter()
+    for pass_index in range(len(PASSES)):
+        groups = defaultdict(list)
+        for index, record in enumerate(features):
+            key = record[6][pass_index]
+            if key is not None and record[0] is not None:
+                groups[key].append(index)
+        for indices in groups.values():
+            if len(indices) < 2 or len({features[index][0] for index in indices}) < 2:
+                continue
+            if len(indices) > max_block:
+                skipped[PASSES[pass_index]] += len(indices)
+                for index in indices:
+                    keys = list(features[index][6])
+                    keys[pass_index] = None
+                    features[index] = features[index][:6] + (tuple(keys),)
+                continue
+            blocks.append((pass_index, indices))
+    # The largest blocks first, so they do not end up as the last task of a single worker
+    blocks.sort(key=lambda block: -len(block[1]))
+    return blocks, skipped
+
+
+def cross_product(features, max_gap):
+    # The number of pairs that comparing every record with every record of the other years would compare
+    years = Counter(record[0] for record in features if record[0] is not None)
+    return sum(years[a] * years[b] for a in years for b in years if 0 < b - a <= max_gap)
+
+
+def keep_best(best, features, matches, candidates):
+    """
+    Records the best match of every record in every other year, and keeps the matches that can still be the best match
+    of both their records.
+
+    A best match can only be replaced by a better one, so a match that is already beaten is dropped as soon as it
+    arrives, and only a fraction of all matches is held in memory. Equal scores go to the record with the lowest index,
+    so the result does not depend on the order in which the blocks are compared.
+
+    Args:
+        best (dict): The best (score, -record index) of every record in every year, by `record index * 10000 + year`.
+        features (list): The features of all records, see `make_features`.
+        matches (list): The (score, record index, record index) tuples of the matches of a block.
+        candidates (list): The matches that can still be linked, which the matches that are kept are appended to.
+    """
+    for match in matches:
+        pair_score, i, j = match
+        key_i, key_j = i * 10000 + features[j][0], j * 10000 + features[i][0]
+        rank_i, rank_j = (pair_score, -j), (pair_score, -i)
+        best_i = rank_i >= best.get(key_i, rank_i)
+        best_j = rank_j >= best.get(key_j, rank_j)
+        if best_i:
+            best[key_i] = rank_i
+        if best_j:
+            best[key_j] = rank_j
+        if best_i and best_j:
+            candidates.append(match)
+
+
+def cluster(features, candidates, best):
+    """
+    Groups the matched records into persons.
+
+    A pair is only linked if each record is the best match of the other in the year of the other, and records are
+    linked in the order of their score, as long as the two groups have no year in common. A person therefore has at most
+    one record per year, and a household with two persons of the same name is not merged into one person.
+
+    Args:
+        features (list): The features of all records, see `make_features`.
+        candidates (list): The (score, record index, record index) tuples of the matches, see `keep_best`.
+        best (dict): The best match of every record in every year, see `keep_best`.
+
+    Returns:
+        tuple: The person index of every record, numbered in the order of the first record of every person, and the
+               number of linked pairs.
+    """
+    parent = list(range(len(features)))
+    years = {}
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    linked = 0
+    for pair_score, i, j in sorted(candidates, reverse=True):
+        if best[i * 10000 + features[j][0]][1] != -j or best[j * 10000 + features[i][0]][1] != -i:
+            continue
+        root_i, root_j = find(i), find(j)
+        years_i = years.get(root_i, {features[i][0]})
+        years_j = years.get(root_j, {features[j][0]})
+        if root_i == root_j or years_i & years_j:
+            continue
+        parent[root_j] = root_i
+        years[root_i] = years_i | years_j
+        years.pop(root_j, None)
+        linked += 1
+
+    person_ids = {}
+    persons = []
+    for index in range(len(features)):
+        persons.append(person_ids.setdefault(find(index), len(person_ids)))
+    return persons, linked
+
+
+def link(records, workers=1, max_gap=2, threshold=0.75, max_block=2000):
+    """
+    Links the records of the same person in different years.
+
+    Records are only compared within blocks: records with the same phonetic code of the surname and the same street,
+    with the same phonetic code and the same initials, so a person is also found after a move, or with the same
+    address, so a household is also found when the OCR misread the surname. This compares a small fraction of all
+    pairs. The blocks are compared in parallel processes.
+
+    Args:
+        records (list): The (year, page, name, job title, address) tuples of the persons, see `load_records`.
+        workers (int, optional): The number of processes comparing blocks. Defaults to 1.
+        max_gap (int, optional): The maximum number of years between two records of a person, e.g. 2 to link a person
+                                 over a missing year. Defaults to 2.
+        threshold (float, optional): The minimum score of a match, see `score`. Defaults to 0.75.
+        max_block (int, optional): The maximum number of records of a block, see `make_blocks`. Defaults to 2000.
+
+    Returns:
+        tuple: The person index of every record, and a dictionary with the statistics of the linkage.
+    """
+    start_time = time.perf_counter()
+    features = [make_features(record) for record in records]
+    blocks, skipped = make_blocks(features, max_block)
+    tasks = [(pass_index, indices, max_gap, threshold) for pass_index, indices in blocks]
+
+    compared = 0
+    matches = 0
+    best = {}
+    candidates = []
+    if workers <= 1:
+        init_worker(features)
+        results = map(compare_block, tasks)
+        for block_compared, block_matches in results:
+            compared += block_compared
+            matches += len(block_matches)
+            keep_best(best, features, block_matches, candidates)
+    else:
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(features,)) as pool:
+            for block_compared, block_matches in pool.imap_unordered(compare_block, tasks, chunksize=64):
+                compared += block_compared
+                matches += len(block_matches)
+                keep_best(best, features, block_matches, candidates)
+
+    persons, linked = cluster(features, candidates, best)
+    sizes = Counter(Counter(persons).values())
+    stats = {
+        "records": len(records),
+        "years": len({record[0] for record in features if record[0] is not None}),
+        "blocks": len(blocks),
+        "skipped": dict(skipped),
+        "compared": compared,
+        "cross_product": cross_product(features, max_gap),
+        "matches": matches,
+        "linked": linked,
+        "persons": len(set(persons)),
+        "linked_persons": sum(count for size, count in sizes.items() if size > 1),
+        "seconds": time.perf_counter() - start_time,
+    }
+    return persons, stats
+
+
+def report(stats):
+    lines = [
+        f"Records: {stats['records']} in {stats['years']} years",
+        f"Blocks: {stats['blocks']}",
+        f"Pairs compared: {stats['compared']} of {stats['cross_product']} cross-year pairs "
+        f"({100 * stats['compared'] / stats['cross_product'] if stats['cross_product'] else 0.0:.4f}%)",
+        f"Matches: {stats['matches']} pairs scored above the threshold, {stats['linked']} linked",
+        f"Persons: {stats['persons']}, of which {stats['linked_persons']} in more than one year",
+        f"Time: {stats['seconds']:.1f} s",
+    ]
+    for pass_name, count in stats["skipped"].items():
+        lines.append(f"Skipped {count} records in blocks larger than the maximum ({pass_name})")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Link the persons of the address books of different years.")
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True, help="CSV files of convert_json_to_csv.py or combined JSONs of combine_jsons.py: one or more files, or directories of files.")
+    parser.add_argument("-o", "--output", type=str, help="Path to the output CSV, with a person_id column before the columns of convert_json_to_csv.py. Default: 'linked_persons.csv' in the current working directory.", default="./linked_persons.csv")
+    parser.add_argument("-w", "--workers", type=int, help="Number of processes comparing blocks in parallel. Default: 1", default=1)
+    parser.add_argument("-g", "--max_gap", type=int, help="Maximum number of years between two records of a person. Default: 2", default=2)
+    parser.add_argument("-t", "--threshold", type=float, help="Minimum score (0-1) of two records of the same person. Default: 0.75", default=0.75)
+    parser.add_argument("--max_block", type=int, help="Maximum number of records of a block; larger blocks are skipped. Default: 2000", default=2000)
+
+    args = parser.parse_args()
+
+    # A directory holds either the CSV files or the combined JSONs of all years; the CSV files are used if it has both
+    input_files = []
+    for input_path in args.input:
+        csv_files = sorted(os.path.join(input_path, file) for file in os.listdir(input_path) if file.endswith(".csv")) if os.path.isdir(input_path) else []
+        input_files.extend(csv_files or find_inputs([input_path]))
+    if not input_files:
+        parser.error("No CSV or JSON files found.")
+
+    try:
+        records = load_records(input_files)
+    except FileNotFoundError as e:
+        print(f"File not found: {e.filename}")
+        exit(1)
+    except ValueError as e:
+        print(f"JSON decoding failed: {e}")
+        exit(1)
+    print(f"Read {len(records)} persons from {len(input_files)} files")
+
+    persons, stats = link(records, args.workers, args.max_gap, args.threshold, args.max_block)
+    print(report(stats))
+
+    output_file = os.path.abspath(args.output)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["person_id"] + COLUMNS)
+        for person, record in zip(persons, records):
+            writer.writerow([f"P{person + 1:07d}"] + list(record))
+    print(f"CSV file has been created: {output_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+
+
+# The time in seconds after which a hit updates the last use of a response again. An hour is precise enough to evict
+# the least recently used responses, and a warm cache is read without writing to the database.
+TOUCH_INTERVAL = 3600
+# The number of updates of the last use that are written in one transaction
+TOUCH_BATCH = 1000
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of LLM responses stored in a SQLite database.
+
+    A response is stored under a hash of everything that determines it: the model, the rendered system message, the
+    rendered human message and the sampling parameters. Re-running `extract_people.py` over pages that were already
+    processed therefore does not send those requests to the server again, while a change to any template or parameter
+    automatically results in new requests.
+
+    Args:
+        cache_dir (str): The directory in which the database `responses.sqlite` is stored. It is created if it does not exist.
+        max_size_mb (float, optional): The maximum total size of the cached responses in megabytes. Defaults to 1024.
+        label (str, optional): The name of the cache in `stats`. Defaults to "LLM cache".
+
+    Notes:
+        - When the cache grows beyond `max_size_mb`, the least recently used responses are evicted until it is back
+          below 90% of the limit.
+        - The number of hits and misses is counted, and can be reported with `stats`.
+        - A hit updates the last use of a response only if it is older than `TOUCH_INTERVAL`, and the updates are
+          written in batches, with the next `put` or when the cache is closed, so hits do not cost a write each.
+        - The same class caches the OCR results of `ocr.py`, in a directory of its own, with keys computed by `ocr.py`.
+          Run `python llm_cache.py --cache_dir <directory>` to inspect either cache.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=1024, label="LLM cache"):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.label = label
+        self.path = os.path.join(cache_dir, "responses.sqlite")
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.touched = []
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, system, user, options=None):
+        """
+        Computes the cache key of a request.
+
+        Args:
+            model (str): The name of the model.
+            system (str): The rendered system message.
+            user (str): The rendered human message.
+            options (dict, optional): The sampling parameters of the request. Defaults to None.
+
+        Returns:
+            str: The SHA-256 hex digest identifying the request.
+        """
+        payload = json.dumps([model, system, user, options or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Looks up a cached response and marks it as recently used.
+
+        Args:
+            key (str): The cache key of the request, see `make_key`.
+
+        Returns:
+            str or None: The cached response, or `None` if the request is not in the cache.
+        """
+        row = self.connection.execute("SELECT response, last_used FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        now = time.time()
+        if now - row[1] > TOUCH_INTERVAL:
+            self.touched.append((now, key))
+            if len(self.touched) >= TOUCH_BATCH:
+                self.write_touched()
+                self.connection.commit()
+        return row[0]
+
+    def write_touched(self):
+        # Writes the pending updates of the last use, without committing them
+        if self.touched:
+            self.connection.executemany("UPDATE responses SET last_used = ? WHERE key = ?", self.touched)
+            self.touched = []
+
+    def put(self, key, response):
+        """
+        Stores a response in the cache, evicting the least recently used responses if the cache becomes too large.
+
+        Args:
+            key (str): The cache key of the request, see `make_key`.
+            response (str): The response of the model.
+        """
+        size = len(response.encode("utf-8"))
+        # The eviction needs the last use of the responses that were hit
+        self.write_touched()
+        previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, response, size, time.time()),
+        )
+        self.size += size - (previous[0] if previous else 0)
+        if self.size > self.max_size:
+            self.evict(int(self.max_size * 0.9))
+        self.connection.commit()
+
+    def evict(self, target_size):
+        """
+        Removes the least recently used responses until the total size is at most `target_size` bytes.
+
+        Args:
+            target_size (int): The total size in bytes to shrink the cache to.
+        """
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used")
+        evicted = []
+        for key, size in rows:
+            if self.size <= target_size:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        """
+        Returns a one-line summary of the cache usage of this run.
+
+        Returns:
+            str: The number of hits and misses, the hit rate, and the current size of the cache.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0.0
+        return f"{self.label}: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), {self.size / (1024 * 1024):.1f} MB in {self.path}"
+
+    def summary(self):
+        """
+        Returns a description of the contents of the cache.
+
+        Returns:
+            str: The number of entries, their total size compared to the limit, and the oldest and latest use.
+        """
+        count, first_used, last_used = self.connection.execute("SELECT COUNT(*), MIN(last_used), MAX(last_used) FROM responses").fetchone()
+        lines = [
+            f"Cache: {self.path}",
+            f"Entries: {count}",
+            f"Size: {self.size / (1024 * 1024):.1f} MB of {self.max_size / (1024 * 1024):.0f} MB",
+        ]
+        if count:
+            lines.append(f"Used between {time.ctime(first_used)} and {time.ctime(last_used)}")
+        return "\n".join(lines)
+
+    def recent(self, limit=10):
+        """
+        Returns the most recently used entries.
+
+        Args:
+            limit (int, optional): The maximum number of entries. Defaults to 10.
+
+        Returns:
+            list: A list of (key, size, last used, response) tuples, most recently used first.
+        """
+        return self.connection.execute(
+            "SELECT key, size, last_used, response FROM responses ORDER BY last_used DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        self.connection.execute("DELETE FROM responses")
+        self.connection.commit()
+        self.connection.execute("VACUUM")
+        self.size = 0
+
+    def close(self):
+        self.write_touched()
+        self.connection.commit()
+        self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear the LLM response cache of extract_people.py or the OCR cache of ocr.py.")
+    parser.add_argument("-d", "--cache_dir", type=str, help="Directory of the cache, e.g. 'llm_cache' or 'ocr_cache'. Default: 'llm_cache' in the current working directory.", default="./llm_cache")
+    parser.add_argument("-l", "--list", type=int, help="Number of most recently used entries to show. Default: 0", default=0)
+    parser.add_argument("--clear", action="store_true", help="Remove all entries from the cache.")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.cache_dir, "responses.sqlite")):
+        print(f"Error: No cache found in {args.cache_dir}")
+        exit(1)
+
+    cache = ResponseCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+        print(f"Cleared {cache.path}")
+    print(cache.summary())
+    for key, size, last_used, response in cache.recent(args.list):
+        preview = response.strip().replace("\n", " | ")[:80]
+        print(f"{key[:16]}  {size:>8} B  {time.ctime(last_used)}  {preview}")
+    cache.close()
+
+if __name__ == "__main__":
+    main()
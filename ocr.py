@@ -1,56 +1,325 @@
 import os
 import json
+import time
+import hashlib
+import textwrap
 import argparse
+import threading
+import functools
+import multiprocessing
+import numpy as np
 import pytesseract
 from PIL import Image
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from layout import find_regions
+from page_store import PageStore
+from llm_cache import ResponseCache
 
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
-def ocr_page(input_path, language="nld", config=3):
+
+BACKENDS = ("pytesseract", "tesserocr")
+
+# Page segmentation mode for the regions found by the layout analysis: a single uniform block of text
+REGION_PSM = 6
+
+
+# The Tesseract API handles of the current thread. A handle must not be used by two threads at the same time, and the
+# handles of a thread are freed when the thread ends.
+engines = threading.local()
+
+
+def get_engine(language="nld", config=3):
+    # One Tesseract API handle per thread, language and page segmentation mode, so the traineddata is only loaded once.
+    # TESSDATA_PREFIX points to the traineddata if it is not in the default location of the tesserocr build.
+    handles = engines.__dict__.setdefault("handles", {})
+    if (language, config) not in handles:
+        tessdata = os.environ.get("TESSDATA_PREFIX", tesserocr.get_languages()[0])
+        handles[(language, config)] = tesserocr.PyTessBaseAPI(path=tessdata, lang=language, psm=config)
+    return handles[(language, config)]
+
+
+@functools.lru_cache(maxsize=None)
+def region_executor(threads):
+    # One pool of region threads per process, shared by all pages, so the threads and their Tesseract API handles are
+    # created once instead of for every page
+    return ThreadPoolExecutor(threads)
+
+
+def ocr_region(image, language="nld", config=3, backend="pytesseract"):
+    # OCRs an in-memory PIL image with the given backend
+    if backend == "tesserocr":
+        engine = get_engine(language, config)
+        engine.SetImage(image)
+        return engine.GetUTF8Text()
+
+    configuration = "--psm " + str(config)
+    return pytesseract.image_to_string(image, lang=language, config=configuration)
+
+
+def ocr_regions(image, language="nld", backend="pytesseract", threads=1):
+    # Splits a page into columns and blocks (see layout.find_regions), OCRs every region as a single block of text and
+    # joins the text of the regions in reading order. Up to `threads` regions are OCRed at the same time.
+    regions = find_regions(np.asarray(image.convert("L")))
+    crops = [image.crop((left, top, right, bottom)) for top, bottom, left, right in regions]
+    ocr = functools.partial(ocr_region, language=language, config=REGION_PSM, backend=backend)
+    if threads > 1:
+        texts = list(region_executor(threads).map(ocr, crops))
+    else:
+        texts = [ocr(crop) for crop in crops]
+    return "\n\n".join(text.strip() for text in texts if text.strip())
+
+
+def ocr_image(image, language="nld", config=3, backend="pytesseract", layout=False, region_threads=1):
+    # OCRs an in-memory PIL image, either as a whole with page segmentation mode `config`, or region by region
+    if layout:
+        return ocr_regions(image, language, backend, region_threads)
+    return ocr_region(image, language, config, backend)
+
+
+@functools.lru_cache(maxsize=None)
+def tesseract_version(backend="pytesseract"):
     try:
-        image = Image.open(input_path)
-        configuration = "--psm " + str(config)
-        text = pytesseract.image_to_string(image, lang=language, config=configuration)
+        if backend == "tesserocr":
+            return tesserocr.tesseract_version().splitlines()[0]
+        return str(pytesseract.get_tesseract_version())
+    except Exception:
+        return "unknown"
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ocr_cache_key(content_hash, language="nld", config=3, backend="pytesseract", layout=False):
+    # Key of the OCR cache: the hash of the image content and everything else that determines its text
+    settings = [content_hash, language, REGION_PSM if layout else config, layout, backend, tesseract_version(backend)]
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+
+def ocr_page(input_path, language="nld", config=3, backend="pytesseract", layout=False, region_threads=1):
+    # Returns the text of an image, or None if the image could not be OCRed
+    try:
+        with Image.open(input_path) as image:
+            text = ocr_image(image, language, config, backend, layout, region_threads)
         return text
     except FileNotFoundError:
         print(f"Error: File not found - {input_path}")
-        return ""
+        return None
     except Exception as e:
         print(f"Error processing file {input_path}: {e}")
-        return ""
+        return None
+
+
+def ocr_task(task):
+    page_number, input_path, language, config, backend, layout, region_threads = task
+    return page_number, ocr_page(input_path, language, config, backend, layout, region_threads)
+
+
+def image_cache_key(task):
+    _, input_path, language, config, backend, layout, _ = task
+    return ocr_cache_key(hash_file(input_path), language, config, backend, layout)
+
+
+def available_cpus():
+    # The CPUs this process may run on, which respects the allocation of a SLURM job
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def limit_threads(thread_limit):
+    # Limits the OpenMP threads of Tesseract in a worker process, unless the user set a limit
+    os.environ.setdefault("OMP_THREAD_LIMIT", str(thread_limit))
+
+
+def ocr_pages(tasks, workers=1, task_function=ocr_task):
+    # Yields (page number, text) in the order of the tasks, OCRing up to `workers` pages at the same time
+    if workers <= 1:
+        for task in tasks:
+            yield task_function(task)
+        return
 
+    # Every worker runs its own Tesseract process, so Tesseract's own OpenMP threads would only oversubscribe the CPUs.
+    # The limit is set in the workers, not in this process, whose later pools may have a different number of workers.
+    thread_limit = max(1, available_cpus() // workers)
+    with multiprocessing.Pool(workers, initializer=limit_threads, initargs=(thread_limit,)) as pool:
+        yield from pool.imap(task_function, tasks)
 
-def process_directory(input_path, output_dir, language="nld", config=3):
+
+def read_records(path):
+    # Yields (offset, record) for every complete record of a JSON Lines file with OCR results. A record that was cut
+    # off by a crash has no trailing newline and is ignored.
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.endswith(b"\n"):
+                try:
+                    yield offset, json.loads(line)
+                except ValueError:
+                    pass
+            offset += len(line)
+
+
+def open_records(path, resume=False):
+    # Opens the JSON Lines file for appending. A record that was cut off is terminated, so the next record starts on a
+    # new line.
+    if not resume or not os.path.exists(path):
+        return open(path, 'w', encoding='utf-8')
+
+    truncated = False
+    with open(path, 'rb') as f:
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            truncated = f.read(1) != b"\n"
+    records = open(path, 'a', encoding='utf-8')
+    if truncated:
+        records.write("\n")
+    return records
+
+
+def compact_records(records_path, output_path, year, page_numbers):
+    # Writes the `{"year", "content"}` JSON consumed by extract_people.py from the JSON Lines file. Only the offsets of
+    # the records are kept in memory, and the pages are written one by one in page order, in the same format as
+    # `json.dump(data, indent=4)`. `page_numbers` gives the page number of every image of the book as it is now: records
+    # of an earlier run keep the page number the image had then, which changes when images are added or removed. The
+    # latest record of an image wins, and images without text or no longer in the book are left out.
+    offsets = {}
+    for offset, record in read_records(records_path):
+        page_number = page_numbers.get(record["image"])
+        if page_number is None:
+            continue
+        if record["text"].strip():
+            offsets[page_number] = offset
+        else:
+            offsets.pop(page_number, None)
+
+    temp_path = output_path + ".tmp"
+    with open(records_path, 'rb') as records, open(temp_path, 'w', encoding='utf-8') as outfile:
+        outfile.write('{\n    "year": ' + json.dumps(year) + ',\n    "content": [')
+        for index, page_number in enumerate(sorted(offsets)):
+            records.seek(offsets[page_number])
+            record = json.loads(records.readline())
+            page_data = {
+                "page": page_number,
+                "text": record["text"]
+            }
+            outfile.write(("," if index else "") + "\n" + textwrap.indent(json.dumps(page_data, indent=4), " " * 8))
+        outfile.write("\n    ]\n}" if offsets else "]\n}")
+    os.replace(temp_path, output_path)
+    return len(offsets)
+
+
+def ocr_book(file_name, pages, output_dir, workers=1, backend="pytesseract", resume=False, task_function=ocr_task, cache=None, cache_key=image_cache_key):
+    # OCRs the pages of a book and saves the results. `pages` is a list of (page number, image name, task) tuples, and
+    # `task_function` turns a task into (page number, text). With a `cache`, pages whose key (see `cache_key`) is in the
+    # cache are not OCRed again.
+
+    # Every page is appended to a JSON Lines file as soon as it is OCRed, so an interrupted run loses at most the
+    # pages in progress and can be resumed
+    records_path = os.path.join(output_dir, file_name + ".jsonl")
+    done = set()
+    if resume and os.path.exists(records_path):
+        done = {record["image"] for _, record in read_records(records_path)}
+        print(f"Resuming from {records_path}: {len(done)} images already OCRed")
+
+    image_names = {page_number: image_name for page_number, image_name, _ in pages}
+    start_time = time.perf_counter()
+    with open_records(records_path, resume) as records:
+        def record_page(page_number, text):
+            record = {"page": page_number, "image": image_names[page_number], "text": text}
+            records.write(json.dumps(record, ensure_ascii=False) + "\n")
+            records.flush()
+
+        # The cache is only used by this process, so the workers only receive the pages that have to be OCRed
+        tasks, keys = [], {}
+        for page_number, image_name, task in pages:
+            if image_name in done:
+                continue
+            if cache:
+                keys[page_number] = cache_key(task)
+                text = cache.get(keys[page_number])
+                if text is not None:
+                    record_page(page_number, text)
+                    continue
+            tasks.append(task)
+
+        for page_number, text in tqdm(ocr_pages(tasks, workers, task_function), total=len(tasks), ncols=100, desc="OCRing Images", unit="image"):
+            # Images that failed are not recorded, so that they are OCRed again on resume
+            if text is None:
+                continue
+            record_page(page_number, text)
+            if cache:
+                cache.put(keys[page_number], text)
+    elapsed = time.perf_counter() - start_time
+    if tasks:
+        print(f"OCRed {len(tasks)} images in {elapsed:.1f} s ({60 * len(tasks) / elapsed:.1f} pages/min) with {workers} workers ({backend})")
+
+    output_path = os.path.join(output_dir, file_name + ".json")
+    try:
+        page_count = compact_records(records_path, output_path, file_name, {image_name: page_number for page_number, image_name in image_names.items()})
+        print(f"Successfully saved OCR results of {page_count} pages to {output_path}")
+    except IOError as e:
+        print(f"Error: Failed to save JSON file - {output_path}. {e}")
+
+
+@functools.lru_cache(maxsize=None)
+def open_store(store_path):
+    # One memory map of a page store per process
+    return PageStore(store_path)
+
+
+def ocr_store_task(task):
+    page_number, store_path, page_index, language, config, backend, layout, region_threads = task
+    try:
+        image = Image.fromarray(open_store(store_path).page(page_index))
+        return page_number, ocr_image(image, language, config, backend, layout, region_threads)
+    except Exception as e:
+        print(f"Error processing page {page_number} of {store_path}: {e}")
+        return page_number, None
+
+
+def store_cache_key(task):
+    _, store_path, page_index, language, config, backend, layout, _ = task
+    return ocr_cache_key(open_store(store_path).digest(page_index), language, config, backend, layout)
+
+
+def process_store(store_path, output_dir, language="nld", config=3, workers=1, backend="pytesseract", resume=False, layout=False, region_threads=1, cache=None):
+    # OCRs the pages of a page store written by `binarize_images.py --store`, in the order in which they are stored
+    try:
+        store = PageStore(store_path)
+    except (OSError, ValueError) as e:
+        print(f"Error: Failed to open page store - {store_path}. {e}")
+        return
+
+    file_name = os.path.splitext(os.path.basename(store_path))[0]
+    pages = [(page_index + 1, name, (page_index + 1, store_path, page_index, language, config, backend, layout, region_threads)) for page_index, name in enumerate(store.names)]
+    store.close()
+    ocr_book(file_name, pages, output_dir, workers, backend, resume, ocr_store_task, cache, store_cache_key)
+
+
+def process_directory(input_path, output_dir, language="nld", config=3, workers=1, backend="pytesseract", resume=False, layout=False, region_threads=1, cache=None):
     try:
         if not os.path.exists(input_path):
             print(f"Error: Input directory does not exist - {input_path}")
             return
 
         file_name = os.path.splitext(os.path.basename(input_path))[0]
-        data = {
-            "year": file_name,
-            "content": []
-        }
-
-        files = [file for file in os.listdir(input_path) if file.lower().endswith(".jpg")]
+        files = sorted(file for file in os.listdir(input_path) if file.lower().endswith(".jpg"))
 
         if not files:
             print(f"Warning: No image files found in {input_path}")
             return
 
-        for page_number, file in tqdm(enumerate(files), total=len(files), ncols=100, desc="OCRing Images", unit="image"):
-            img_path = os.path.join(input_path, file)
-            try:
-                text = ocr_page(img_path, language, config)
-                if text.strip():
-                    page_data = {
-                        "page": page_number + 1,
-                        "text": text
-                    }
-                    data["content"].append(page_data)
-            except Exception as e:
-                print(f"Error processing image {img_path}: {e}")
-
         if not os.path.exists(output_dir):
             try:
                 os.makedirs(output_dir, exist_ok=True)
@@ -58,13 +327,8 @@ def process_directory(input_path, output_dir, language="nld", config=3):
                 print(f"Error: Failed to create output directory - {output_dir}. {e}")
                 return
 
-        output_path = os.path.join(output_dir, file_name + ".json")
-        try:
-            with open(output_path, 'w', encoding='utf-8') as outfile:
-                json.dump(data, outfile, indent=4)
-            print(f"Successfully saved OCR results to {output_path}")
-        except IOError as e:
-            print(f"Error: Failed to save JSON file - {output_path}. {e}")
+        pages = [(page_number + 1, file, (page_number + 1, os.path.join(input_path, file), language, config, backend, layout, region_threads)) for page_number, file in enumerate(files)]
+        ocr_book(file_name, pages, output_dir, workers, backend, resume, cache=cache)
     except Exception as e:
         print(f"Unexpected error: {e}")
 
@@ -74,12 +338,23 @@ def main():
     #pytesseract.pytesseract.tesseract_cmd = 'C:/Program Files/Tesseract-OCR/tesseract.exe'
 
     parser = argparse.ArgumentParser(description="Perform OCR on images.")
-    parser.add_argument("-i", "--input", type=str, required=True, help="Path to a single image, or a directory of images.")
+    parser.add_argument("-i", "--input", type=str, required=True, help="Path to a single image, a directory of images, or a page store ('.pages') written by binarize_images.py.")
     parser.add_argument("-o", "--output", type=str, help="Path to the output directory. Default: 'ocr_results' in the current working directory.", default="./ocr_results")
     parser.add_argument("-c", "--config", type=int, help="Set the configuration for Tesseract.", default=3)
+    parser.add_argument("-w", "--workers", type=int, help="Number of images to OCR in parallel. Default: 1", default=1)
+    parser.add_argument("-b", "--backend", type=str, choices=BACKENDS, help="OCR backend: 'pytesseract' starts a Tesseract process per image, 'tesserocr' keeps Tesseract loaded in every worker. Default: pytesseract", default="pytesseract")
+    parser.add_argument("-l", "--layout", action="store_true", help="Split every page into columns and blocks, and OCR every region as a single block of text (--psm 6) instead of the whole page with --config.")
+    parser.add_argument("--region_threads", type=int, help="Number of regions of a page to OCR in parallel with --layout. Default: 1", default=1)
+    parser.add_argument("-r", "--resume", action="store_true", help="Resume an interrupted run: skip the images that are already recorded in the JSON Lines file in the output directory.")
+    parser.add_argument("--cache_dir", type=str, help="Directory of the persistent OCR cache. Default: 'ocr_cache' in the current working directory.", default="./ocr_cache")
+    parser.add_argument("--cache_size", type=float, help="Maximum size of the OCR cache in MB. Default: 1024", default=1024)
+    parser.add_argument("--no_cache", action="store_true", help="Do not read from or write to the OCR cache.")
 
     args = parser.parse_args()
 
+    if args.backend == "tesserocr" and tesserocr is None:
+        parser.error("The tesserocr backend requires the tesserocr package (pip install tesserocr).")
+
     # Access the arguments
     input_path = os.path.abspath(args.input)
     output_dir = os.path.abspath(args.output)
@@ -91,17 +366,28 @@ def main():
         except OSError as e:
             print(f"Failed to create directory: {e}")
 
-    if os.path.isfile(input_path):
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, args.cache_size, label="OCR cache")
+
+    if os.path.isfile(input_path) and input_path.endswith(".pages"):
+        print(f"Processing page store: {input_path}")
+        process_store(input_path, output_dir, config=args.config, workers=args.workers, backend=args.backend, resume=args.resume, layout=args.layout, region_threads=args.region_threads, cache=cache)
+    elif os.path.isfile(input_path):
         # Single PDF file
         print(f"Processing single file: {input_path}")
-        print(ocr_page(input_path = input_path, config=args.config))
+        print(ocr_page(input_path = input_path, config=args.config, backend=args.backend, layout=args.layout, region_threads=args.region_threads) or "")
     elif os.path.isdir(input_path):
         # Directory or nested directories of PDFs
         print(f"Processing directory: {input_path}")
-        process_directory(input_path=input_path, output_dir=output_dir, config=args.config)
+        process_directory(input_path=input_path, output_dir=output_dir, config=args.config, workers=args.workers, backend=args.backend, resume=args.resume, layout=args.layout, region_threads=args.region_threads, cache=cache)
     else:
         print(f"Error: The input path {input_path} does not exist or is not valid.")
         exit(1)
 
+    if cache:
+        print(cache.stats())
+        cache.close()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,177 @@
+import os
+import cv2
+import json
+import fitz
+import hashlib
+import argparse
+import functools
+import numpy as np
+from PIL import Image
+from binarize_images import METHODS, binarize
+from ocr import BACKENDS, tesserocr, ocr_image, ocr_book, hash_file, ocr_cache_key
+from llm_cache import ResponseCache
+
+
+@functools.lru_cache(maxsize=None)
+def open_document(pdf_path):
+    """
+    Opens a PDF once per process, so that the workers do not reopen the document for every page.
+    """
+    return fitz.open(pdf_path)
+
+
+@functools.lru_cache(maxsize=None)
+def hash_pdf(pdf_path):
+    """
+    Hashes a PDF once per run, instead of once for every page.
+    """
+    return hash_file(pdf_path)
+
+
+def pixmap_to_array(pixmap):
+    """
+    Wraps the samples of a pixmap as a NumPy array without copying them.
+
+    Parameters:
+        pixmap (fitz.Pixmap): The rendered page.
+
+    Returns:
+        numpy.ndarray: A (height, width) array for a grayscale pixmap, or a (height, width, channels) array otherwise.
+                       The array shares its memory with the pixmap, so the pixmap must stay alive while it is used.
+    """
+    shape = (pixmap.height, pixmap.width, pixmap.n)
+    strides = (pixmap.stride, pixmap.n, 1)
+    array = np.ndarray(shape, dtype=np.uint8, buffer=pixmap.samples_mv, strides=strides)
+    return array[:, :, 0] if pixmap.n == 1 else array
+
+
+def render_page(pdf_path, page_number, dpi=200, threshold=160, crop=0, method="global", auto_crop=False):
+    """
+    Renders a page of a PDF in grayscale, and binarizes and crops it in memory.
+
+    Parameters:
+        pdf_path (str): Path to the PDF.
+        page_number (int): Zero-based number of the page.
+        dpi (int): Resolution of the rendered page, the same as `convert_pdf_to_jpg.py` by default.
+        threshold (int): Threshold value for binarization.
+        crop (float): Fraction of the image dimensions to crop from each side.
+        method (str): Thresholding method, see `binarize_images.binarize`.
+        auto_crop (bool): Whether to crop the page to its text area.
+
+    Returns:
+        numpy.ndarray: The binarized and cropped page.
+    """
+    page = open_document(pdf_path).load_page(page_number)
+    # Rendering in grayscale replaces the grayscale conversion of binarize_images.py
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    return binarize(pixmap_to_array(pixmap), threshold, crop, method, auto_crop)
+
+
+def ocr_pdf_task(task):
+    page_number, pdf_path, dpi, threshold, crop, method, auto_crop, language, config, backend, layout, region_threads, debug_dir = task
+    try:
+        image = render_page(pdf_path, page_number - 1, dpi, threshold, crop, method, auto_crop)
+    except Exception as e:
+        print(f"Error rendering page {page_number} of {pdf_path}: {e}")
+        return page_number, None
+
+    if debug_dir:
+        page_name = f"{os.path.splitext(os.path.basename(pdf_path))[0]}_page_{page_number:04}"
+        cv2.imwrite(os.path.join(debug_dir, f"binarized_{page_name}.png"), image)
+
+    try:
+        return page_number, ocr_image(Image.fromarray(image), language, config, backend, layout, region_threads)
+    except Exception as e:
+        print(f"Error processing page {page_number} of {pdf_path}: {e}")
+        return page_number, None
+
+
+def pdf_cache_key(task):
+    page_number, pdf_path, dpi, threshold, crop, method, auto_crop, language, config, backend, layout, _, _ = task
+    # The rendered page is not hashed: it is determined by the PDF, the page and the rendering settings
+    page = [hash_pdf(pdf_path), page_number, dpi, threshold, crop, method, auto_crop]
+    content_hash = hashlib.sha256(json.dumps(page).encode("utf-8")).hexdigest()
+    return ocr_cache_key(content_hash, language, config, backend, layout)
+
+
+def process_pdf(pdf_path, output_dir, dpi=200, threshold=160, crop=0, method="global", auto_crop=False, language="nld", config=3, workers=1, backend="pytesseract", resume=False, layout=False, region_threads=1, debug_dir=None, cache=None):
+    """
+    Renders, binarizes and OCRs all pages of a PDF without writing intermediate images, and saves the OCR results.
+
+    The results are streamed to `<name>.jsonl` and compacted into the `<name>.json` consumed by `extract_people.py`,
+    exactly like `ocr.py`, so `--resume` skips the pages that are already recorded, and pages found in the `cache` are
+    not rendered or OCRed again.
+    """
+    file_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    try:
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+    except Exception as e:
+        print(f"Error: '{pdf_path}' is not a valid PDF file or is corrupted. {e}")
+        return
+
+    pages = [
+        (page_number, f"{file_name}_page_{page_number:04}", (page_number, pdf_path, dpi, threshold, crop, method, auto_crop, language, config, backend, layout, region_threads, debug_dir))
+        for page_number in range(1, page_count + 1)
+    ]
+    ocr_book(file_name, pages, output_dir, workers, backend, resume, ocr_pdf_task, cache, pdf_cache_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render, binarize and OCR the pages of PDF files in memory.")
+    parser.add_argument("-i", "--input", type=str, required=True, help="Path to a single PDF, or a directory of PDFs.")
+    parser.add_argument("-o", "--output", type=str, help="Path to the output directory. Default: 'ocr_results' in the current working directory.", default="./ocr_results")
+    parser.add_argument("-d", "--dpi", type=int, help="Resolution at which the pages are rendered. Default: 200", default=200)
+    parser.add_argument("-t", "--threshold", type=int, help="Threshold value for binarization. Default: 160", default=160)
+    parser.add_argument("-c", "--crop", type=float, help="Fraction of the image dimensions to crop from each side. Default: 0.0", default=0.0)
+    parser.add_argument("-m", "--method", type=str, choices=METHODS, help="Thresholding method, see binarize_images.py. Default: global", default="global")
+    parser.add_argument("-a", "--auto_crop", action="store_true", help="Crop every page to its text area.")
+    parser.add_argument("--config", type=int, help="Set the configuration for Tesseract page segmentation modes, see ocr.py. Default: 3", default=3)
+    parser.add_argument("-w", "--workers", type=int, help="Number of pages to process in parallel. Default: 1", default=1)
+    parser.add_argument("-b", "--backend", type=str, choices=BACKENDS, help="OCR backend, see ocr.py. Default: pytesseract", default="pytesseract")
+    parser.add_argument("-l", "--layout", action="store_true", help="OCR the columns and blocks of every page separately, see ocr.py.")
+    parser.add_argument("--region_threads", type=int, help="Number of regions of a page to OCR in parallel with --layout. Default: 1", default=1)
+    parser.add_argument("-r", "--resume", action="store_true", help="Resume an interrupted run: skip the pages that are already recorded in the JSON Lines file in the output directory.")
+    parser.add_argument("--cache_dir", type=str, help="Directory of the persistent OCR cache, shared with ocr.py. Default: 'ocr_cache' in the current working directory.", default="./ocr_cache")
+    parser.add_argument("--cache_size", type=float, help="Maximum size of the OCR cache in MB. Default: 1024", default=1024)
+    parser.add_argument("--no_cache", action="store_true", help="Do not read from or write to the OCR cache.")
+    parser.add_argument("--debug_dir", type=str, help="Also save the binarized pages as PNG files in this directory, for inspection.", default=None)
+
+    args = parser.parse_args()
+
+    if args.backend == "tesserocr" and tesserocr is None:
+        parser.error("The tesserocr backend requires the tesserocr package (pip install tesserocr).")
+
+    input_path = os.path.abspath(args.input)
+    output_dir = os.path.abspath(args.output)
+    debug_dir = os.path.abspath(args.debug_dir) if args.debug_dir else None
+
+    for directory in (output_dir, debug_dir):
+        if directory and not os.path.exists(directory):
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                print(f"Failed to create directory: {e}")
+
+    if os.path.isfile(input_path):
+        pdf_paths = [input_path]
+    elif os.path.isdir(input_path):
+        pdf_paths = sorted(os.path.join(input_path, file) for file in os.listdir(input_path) if file.lower().endswith(".pdf"))
+    else:
+        print(f"Error: The input path {input_path} does not exist or is not valid.")
+        exit(1)
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, args.cache_size, label="OCR cache")
+
+    for pdf_path in pdf_paths:
+        print(f"Processing file: {pdf_path}")
+        process_pdf(pdf_path, output_dir, args.dpi, args.threshold, args.crop, args.method, args.auto_crop, config=args.config, workers=args.workers, backend=args.backend, resume=args.resume, layout=args.layout, region_threads=args.region_threads, debug_dir=debug_dir, cache=cache)
+
+    if cache:
+        print(cache.stats())
+        cache.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import numpy as np
+
+
+class PageStore:
+    """
+    Compact store of the binarized pages of a book in a single file.
+
+    Binarized pages only contain two values, so every pixel is stored as a single bit with `np.packbits`, and all pages
+    of a book are stored in one file. The file is memory-mapped for reading, so any page can be loaded without reading
+    the other pages or decoding an image, and the pages are stored without the artefacts of JPEG compression.
+
+    Args:
+        path (str): The path to the store, usually `<book>.pages`.
+
+    Notes:
+        - The file starts with the magic bytes `GAPAGES1` and the offset of the index, followed by the bit-packed
+          pages, one after another. The index at the end of the file is a JSON list with the name, offset, size,
+          height, width and foreground value of every page, and whether the page is compressed.
+        - Every row of a page is packed separately and padded to whole bytes, so a page can be unpacked as one
+          (height, ceil(width / 8)) array.
+        - The packed pages are compressed with zlib by default. The long runs of white pixels of a text page compress
+          well, and decompressing a page is still much faster than decoding a JPEG.
+        - Use `PageStoreWriter` to create a store.
+    """
+
+    MAGIC = b"GAPAGES1"
+    HEADER = struct.Struct("<8sQ")
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, index_offset = self.HEADER.unpack(self.data[:self.HEADER.size].tobytes())
+        if magic != self.MAGIC or index_offset == 0:
+            raise ValueError(f"{path} is not a complete page store.")
+        self.index = json.loads(self.data[index_offset:].tobytes().decode("utf-8"))
+        self.names = [entry["name"] for entry in self.index]
+
+    def __len__(self):
+        return len(self.index)
+
+    def page(self, page_index):
+        """
+        Loads a page.
+
+        Args:
+            page_index (int): The zero-based index of the page in the store.
+
+        Returns:
+            numpy.ndarray: The binarized page as a (height, width) uint8 array with the values 0 and the foreground value.
+        """
+        entry = self.index[page_index]
+        height, width = entry["height"], entry["width"]
+        row_bytes = (width + 7) // 8
+        data = self.data[entry["offset"]:entry["offset"] + entry["size"]]
+        if entry["compressed"]:
+            data = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+        packed = data.reshape(height, row_bytes)
+        return np.unpackbits(packed, axis=1, count=width) * np.uint8(entry["value"])
+
+    def digest(self, page_index):
+        """
+        Returns a hash of the content of a page, which changes whenever the page changes.
+        """
+        entry = self.index[page_index]
+        digest = hashlib.sha256(json.dumps([entry["height"], entry["width"], entry["value"], entry["compressed"]]).encode("utf-8"))
+        digest.update(self.data[entry["offset"]:entry["offset"] + entry["size"]])
+        return digest.hexdigest()
+
+    def close(self):
+        self.data = None
+
+
+class PageStoreWriter:
+    """
+    Writes binarized pages to a `PageStore`.
+
+    The pages are appended in the order in which they are added, and the index is written when the writer is closed.
+    Until then, the header marks the store as incomplete, so a store left behind by an interrupted run is not read.
+
+    Args:
+        path (str): The path to the store, usually `<book>.pages`.
+        compression (int, optional): The zlib compression level of the pages, or 0 to store the packed pages
+                                     uncompressed. Defaults to 1.
+    """
+
+    def __init__(self, path, compression=1):
+        self.path = path
+        self.compression = compression
+        self.index = []
+        self.file = open(path, 'wb')
+        self.file.write(PageStore.HEADER.pack(PageStore.MAGIC, 0))
+
+    def add(self, name, image):
+        """
+        Appends a binarized page to the store.
+
+        Args:
+            name (str): The name of the page, e.g. the name of the image it was made from.
+            image (numpy.ndarray): The binarized page as a (height, width) array. All non-zero pixels must have the
+                                   same value.
+        """
+        foreground = image != 0
+        value = int(image[foreground][0]) if foreground.any() else 255
+        data = np.packbits(foreground, axis=1).tobytes()
+        if self.compression:
+            data = zlib.compress(data, self.compression)
+        self.index.append({
+            "name": name, "offset": self.file.tell(), "size": len(data), "height": image.shape[0], "width": image.shape[1],
+            "value": value, "compressed": bool(self.compression),
+        })
+        self.file.write(data)
+
+    def close(self):
+        """
+        Writes the index and completes the store.
+        """
+        index_offset = self.file.tell()
+        self.file.write(json.dumps(self.index).encode("utf-8"))
+        self.file.seek(0)
+        self.file.write(PageStore.HEADER.pack(PageStore.MAGIC, index_offset))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # After an error the store is left incomplete instead of completing it with the pages written so far
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+        return False
@@ -0,0 +1,415 @@
+import os
+import re
+import csv
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import functools
+import unicodedata
+from ocr import hash_file
+from convert_json_to_csv import iter_pages, iter_persons, find_inputs
+
+# 'De Vries (J. H.)': the surname, followed by the initials in parentheses
+NAME_PATTERN = re.compile(r"^(?P<surname>[^()]*?)\s*\((?P<initials>[^()]*)\)")
+# 'Hoofdstraat 12b', 'Oude Ebbingestraat 4-6': the street, followed by the house number
+ADDRESS_PATTERN = re.compile(r"^(?P<street>.*?)[\s,]*(?P<number>\d+\s*[a-zA-Z]?(?:\s*[-/]\s*\d+[a-zA-Z]?)?)$")
+COLUMNS = ["year", "page", "name", "jobTitle", "address"]
+
+
+def text(value):
+    # The LLM occasionally returns a list or a number instead of a string
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize(value):
+    """
+    Returns the search key of a surname or street: lower case, without diacritics and punctuation, and with single spaces.
+    Surnames and streets repeat on every page, so the keys are cached.
+    """
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(character for character in value if not unicodedata.combining(character)).casefold()
+    return " ".join(re.sub(r"[^\w\s]", " ", value).split())
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize_initials(value):
+    """
+    Returns the search key of initials, without spaces and dots, so 'J. H.', 'J.H.' and 'JH' have the same key.
+    """
+    return normalize(value).replace(" ", "")
+
+
+def split_name(name):
+    # Returns the surname and the initials of a name, or the whole name and no initials if it has no parentheses
+    match = NAME_PATTERN.match(name)
+    if match:
+        return match.group("surname").strip(), match.group("initials").strip()
+    return name.strip(), ""
+
+
+def split_address(address):
+    # Returns the street and the house number of an address, or the whole address and no house number
+    match = ADDRESS_PATTERN.match(address.strip())
+    if match and match.group("street"):
+        return match.group("street").strip(), match.group("number").replace(" ", "")
+    return address.strip(), ""
+
+
+class PersonsDatabase:
+    """
+    Searchable database of the persons of all address books, stored in a single SQLite file.
+
+    Every entry of the `register` lists of the combined JSONs of `combine_jsons.py` is a row of the `persons` table,
+    with its year and page. The surname and initials are split from the name and the house number from the address,
+    and all three are indexed with a normalized key, so a surname, street or initials can be looked up by its exact value
+    or by a prefix in milliseconds, also for a range of years. The name, job title and address are indexed for full-text
+    search with FTS5 as well.
+
+    Args:
+        path (str): The path to the database, e.g. `persons.sqlite`. It is created if it does not exist.
+
+    Notes:
+        - Every combined JSON is a source. A source is ingested in a single transaction: its previous rows are deleted
+          and all its rows are inserted in batches, so a search never sees a partially ingested year.
+        - The size, modification time and hash of every source are recorded, so ingesting a directory again only
+          ingests the combined JSONs that changed. Sources are identified by their file name, e.g. `1926_combined.json`.
+        - The keys ignore case, diacritics and punctuation, so 'De Vries', 'de vries' and 'De Vriës' are the same surname.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # Inserting into five indexes touches pages all over the file, which is much faster when they stay in memory
+        self.connection.execute("PRAGMA cache_size=-65536")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS sources (
+                id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL, persons INTEGER NOT NULL, ingested REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS persons (
+                id INTEGER PRIMARY KEY, source INTEGER NOT NULL, year TEXT NOT NULL, year_number INTEGER, page INTEGER,
+                name TEXT NOT NULL, job_title TEXT NOT NULL, address TEXT NOT NULL, surname_key TEXT NOT NULL,
+                initials_key TEXT NOT NULL, street_key TEXT NOT NULL, house_number TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS persons_surname ON persons (surname_key, year_number);
+            CREATE INDEX IF NOT EXISTS persons_street ON persons (street_key, year_number);
+            CREATE INDEX IF NOT EXISTS persons_initials ON persons (initials_key, year_number);
+            CREATE INDEX IF NOT EXISTS persons_year ON persons (year_number, page);
+            CREATE INDEX IF NOT EXISTS persons_source ON persons (source);
+            CREATE VIRTUAL TABLE IF NOT EXISTS persons_text USING fts5 (
+                name, job_title, address, content='persons', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+        """)
+        self.connection.commit()
+
+    @staticmethod
+    def make_rows(input_file, source_id):
+        """
+        Reads the persons of a combined JSON as rows of the `persons` table, one page at a time.
+
+        Args:
+            input_file (str): The path to the combined JSON.
+            source_id (int): The id of the source in the `sources` table.
+
+        Yields:
+            tuple: The values of the columns of the `persons` table, except the id.
+        """
+        for year, page in iter_pages(input_file):
+            year = text(year)
+            year_number = int(year) if year.isdigit() else None
+            page_number = page.get("page")
+            page_number = page_number if isinstance(page_number, int) else None
+            for entry in iter_persons(page.get("register", [])):
+                name, job_title, address = text(entry.get("name")), text(entry.get("jobTitle")), text(entry.get("address"))
+                surname, initials = split_name(name)
+                street, house_number = split_address(address)
+                yield (
+                    source_id, year, year_number, page_number, name, job_title, address,
+                    normalize(surname), normalize_initials(initials), normalize(street), house_number,
+                )
+
+    def ingest(self, input_file, force=False, batch_size=10000):
+        """
+        Adds the persons of a combined JSON to the database, replacing the persons of an earlier version of the file.
+
+        Args:
+            input_file (str): The path to the combined JSON.
+            force (bool, optional): Whether to ingest the file even if it did not change. Defaults to False.
+            batch_size (int, optional): The number of rows inserted at a time. Defaults to 10000.
+
+        Returns:
+            int or None: The number of persons, or `None` if the file did not change since it was ingested.
+        """
+        name = os.path.basename(input_file)
+        stat = os.stat(input_file)
+        source = self.connection.execute("SELECT id, size, mtime_ns, digest FROM sources WHERE name = ?", (name,)).fetchone()
+        if source and not force and source[1:3] == (stat.st_size, stat.st_mtime_ns):
+            return None
+        digest = hash_file(input_file)
+        if source and not force and source[3] == digest:
+            # Touched but not changed
+            with self.connection:
+                self.connection.execute("UPDATE sources SET size = ?, mtime_ns = ? WHERE id = ?", (stat.st_size, stat.st_mtime_ns, source[0]))
+            return None
+
+        with self.connection:
+            if source:
+                source_id = source[0]
+                self.remove_rows(source_id)
+            else:
+                source_id = self.connection.execute(
+                    "INSERT INTO sources (name, path, size, mtime_ns, digest, persons, ingested) VALUES (?, '', 0, 0, '', 0, 0)", (name,)
+                ).lastrowid
+
+            count = 0
+            batch = []
+            for row in self.make_rows(input_file, source_id):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    count += self.insert_rows(batch)
+                    batch = []
+            count += self.insert_rows(batch)
+            self.connection.execute(
+                "INSERT INTO persons_text (rowid, name, job_title, address) SELECT id, name, job_title, address FROM persons WHERE source = ?",
+                (source_id,),
+            )
+            self.connection.execute(
+                "UPDATE sources SET path = ?, size = ?, mtime_ns = ?, digest = ?, persons = ?, ingested = ? WHERE id = ?",
+                (os.path.abspath(input_file), stat.st_size, stat.st_mtime_ns, digest, count, time.time(), source_id),
+            )
+        return count
+
+    def insert_rows(self, rows):
+        self.connection.executemany(
+            "INSERT INTO persons (source, year, year_number, page, name, job_title, address, surname_key, initials_key, street_key, house_number) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        return len(rows)
+
+    def remove_rows(self, source_id):
+        # An FTS5 table with external content has to be told the values of the rows that are deleted
+        self.connection.execute(
+            "INSERT INTO persons_text (persons_text, rowid, name, job_title, address) "
+            "SELECT 'delete', id, name, job_title, address FROM persons WHERE source = ?",
+            (source_id,),
+        )
+        self.connection.execute("DELETE FROM persons WHERE source = ?", (source_id,))
+
+    def remove(self, name):
+        """
+        Removes a source and its persons from the database.
+
+        Args:
+            name (str): The file name of the source, e.g. `1926_combined.json`.
+
+        Returns:
+            bool: Whether the source was in the database.
+        """
+        source = self.connection.execute("SELECT id FROM sources WHERE name = ?", (name,)).fetchone()
+        if source is None:
+            return False
+        with self.connection:
+            self.remove_rows(source[0])
+            self.connection.execute("DELETE FROM sources WHERE id = ?", (source[0],))
+        return True
+
+    @staticmethod
+    def key_condition(column, key):
+        # An exact match, or a prefix match for a key that ends with '*', which both use the B-tree index of the column.
+        # The upper bound of a prefix is the prefix with its last character incremented.
+        if key.endswith("*"):
+            prefix = key[:-1]
+            if not prefix:
+                return None, []
+            return f"{column} >= ? AND {column} < ?", [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        return f"{column} = ?", [key]
+
+    @staticmethod
+    def text_query(query):
+        # Quotes every word of a full-text query, so punctuation in names cannot break the FTS5 syntax. A word that ends
+        # with '*' is a prefix.
+        terms = []
+        for word in query.split():
+            prefix = word.endswith("*")
+            word = word.rstrip("*").replace('"', '""')
+            if word:
+                terms.append(f'"{word}"' + ("*" if prefix else ""))
+        return " ".join(terms)
+
+    def search(self, surname=None, initials=None, street=None, house_number=None, text=None, year_from=None, year_to=None, limit=100):
+        """
+        Finds the persons that match all given criteria.
+
+        Args:
+            surname (str, optional): The surname, or the start of the surname followed by '*'. Defaults to None.
+            initials (str, optional): The initials, or the first initials followed by '*'. Defaults to None.
+            street (str, optional): The street, or the start of the street followed by '*'. Defaults to None.
+            house_number (str, optional): The house number, e.g. '12b'. Defaults to None.
+            text (str, optional): Words that must all occur in the name, job title or address, e.g. 'koopman'. A word
+                                  followed by '*' matches every word that starts with it. Defaults to None.
+            year_from (int, optional): The first year. Defaults to None.
+            year_to (int, optional): The last year. Defaults to None.
+            limit (int, optional): The maximum number of persons. Defaults to 100.
+
+        Returns:
+            list: A list of (year, page, name, job title, address) tuples, ordered by year and page.
+
+        Example:
+            database = PersonsDatabase("persons.sqlite")
+            for year, page, name, job_title, address in database.search(surname="Jansen", street="Hoofdstraat", year_from=1900, year_to=1940):
+                print(year, page, name, job_title, address)
+        """
+        conditions = []
+        parameters = []
+        for column, key in (("surname_key", surname and normalize(surname.rstrip("*")) + "*" * surname.endswith("*")),
+                            ("initials_key", initials and normalize_initials(initials.rstrip("*")) + "*" * initials.endswith("*")),
+                            ("street_key", street and normalize(street.rstrip("*")) + "*" * street.endswith("*"))):
+            if key:
+                condition, values = self.key_condition(column, key)
+                if condition:
+                    conditions.append(condition)
+                    parameters.extend(values)
+        if house_number:
+            conditions.append("house_number = ?")
+            parameters.append(house_number.replace(" ", ""))
+        if text and self.text_query(text):
+            conditions.append("id IN (SELECT rowid FROM persons_text WHERE persons_text MATCH ?)")
+            parameters.append(self.text_query(text))
+        if year_from is not None:
+            conditions.append("year_number >= ?")
+            parameters.append(year_from)
+        if year_to is not None:
+            conditions.append("year_number <= ?")
+            parameters.append(year_to)
+
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return self.connection.execute(
+            f"SELECT year, page, name, job_title, address FROM persons{where} ORDER BY year_number, year, page, id LIMIT ?",
+            parameters + [limit],
+        ).fetchall()
+
+    def sources(self):
+        """
+        Returns the ingested sources.
+
+        Returns:
+            list: A list of (name, number of persons, time of ingestion) tuples, ordered by name.
+        """
+        return self.connection.execute("SELECT name, persons, ingested FROM sources ORDER BY name").fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def ingest(args):
+    input_files = find_inputs(args.input)
+    database = PersonsDatabase(args.database)
+    ingested = 0
+    skipped = 0
+    start_time = time.perf_counter()
+    for input_file in input_files:
+        file_start = time.perf_counter()
+        try:
+            count = database.ingest(input_file, args.force, args.batch_size)
+        except FileNotFoundError as e:
+            print(f"File not found: {e.filename}")
+            continue
+        except (json.JSONDecodeError, ValueError) as e:
+            print(f"JSON decoding failed for {input_file}: {e}")
+            continue
+        if count is None:
+            skipped += 1
+        else:
+            ingested += 1
+            print(f"Ingested {count} persons from {input_file} in {time.perf_counter() - file_start:.1f} s")
+    if skipped:
+        print(f"Skipped {skipped} unchanged files")
+    print(f"Ingested {ingested} files in {time.perf_counter() - start_time:.1f} s into {args.database}")
+    database.close()
+
+
+def query(args):
+    if not os.path.exists(args.database):
+        print(f"Error: No database found at {args.database}")
+        exit(1)
+
+    database = PersonsDatabase(args.database)
+    start_time = time.perf_counter()
+    persons = database.search(args.surname, args.initials, args.street, args.house_number, args.text, args.year_from, args.year_to, args.limit)
+    elapsed = time.perf_counter() - start_time
+    database.close()
+
+    if args.format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(COLUMNS)
+        writer.writerows(persons)
+    elif args.format == "json":
+        print(json.dumps([dict(zip(COLUMNS, person)) for person in persons], indent=4, ensure_ascii=False))
+    else:
+        for year, page, name, job_title, address in persons:
+            print(f"{year}  {'' if page is None else page:>4}  {name:<30}  {job_title:<25}  {address}")
+        print(f"{len(persons)} persons in {elapsed * 1000:.1f} ms" + (f" (limited to {args.limit})" if len(persons) == args.limit else ""))
+
+
+def status(args):
+    if not os.path.exists(args.database):
+        print(f"Error: No database found at {args.database}")
+        exit(1)
+
+    database = PersonsDatabase(args.database)
+    if args.remove:
+        for name in args.remove:
+            print(f"Removed {name}" if database.remove(name) else f"Not in the database: {name}")
+    sources = database.sources()
+    print(f"Database: {args.database}")
+    print(f"Persons: {sum(persons for _, persons, _ in sources)} from {len(sources)} files")
+    for name, persons, ingested in sources:
+        print(f"  {name}: {persons} persons, ingested {time.ctime(ingested)}")
+    database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the persons of the combined JSONs into a searchable database, and search it.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Add combined JSONs to the database. Unchanged files are skipped.")
+    ingest_parser.add_argument("-d", "--database", type=str, help="Path to the database. Default: 'persons.sqlite' in the current working directory.", default="./persons.sqlite")
+    ingest_parser.add_argument("-i", "--input", type=str, nargs="+", required=True, help="Combined JSONs of combine_jsons.py: one or more files, or directories of files.")
+    ingest_parser.add_argument("-f", "--force", action="store_true", help="Ingest every file, also if it did not change since it was ingested.")
+    ingest_parser.add_argument("-b", "--batch_size", type=int, help="Number of persons inserted at a time. Default: 10000", default=10000)
+    ingest_parser.set_defaults(function=ingest)
+
+    query_parser = subparsers.add_parser("query", help="Find persons. All given criteria must match; end a surname, initials, street or word with '*' to match its start.")
+    query_parser.add_argument("-d", "--database", type=str, help="Path to the database. Default: 'persons.sqlite' in the current working directory.", default="./persons.sqlite")
+    query_parser.add_argument("-s", "--surname", type=str, help="Surname, e.g. 'Jansen' or 'Jans*'. Case, diacritics and punctuation are ignored.", default=None)
+    query_parser.add_argument("--initials", type=str, help="Initials, e.g. 'J. H.'. Spaces and dots are ignored.", default=None)
+    query_parser.add_argument("--street", type=str, help="Street without the house number, e.g. 'Hoofdstraat' or 'Hoofd*'.", default=None)
+    query_parser.add_argument("--house_number", type=str, help="House number, e.g. '12b'.", default=None)
+    query_parser.add_argument("-t", "--text", type=str, help="Words that must all occur in the name, job title or address, e.g. 'koopman'.", default=None)
+    query_parser.add_argument("--from", dest="year_from", type=int, help="First year.", default=None)
+    query_parser.add_argument("--to", dest="year_to", type=int, help="Last year.", default=None)
+    query_parser.add_argument("-l", "--limit", type=int, help="Maximum number of persons. Default: 100", default=100)
+    query_parser.add_argument("--format", type=str, choices=["table", "csv", "json"], help="Output format. Default: table", default="table")
+    query_parser.set_defaults(function=query)
+
+    status_parser = subparsers.add_parser("status", help="Show the ingested files, or remove files from the database.")
+    status_parser.add_argument("-d", "--database", type=str, help="Path to the database. Default: 'persons.sqlite' in the current working directory.", default="./persons.sqlite")
+    status_parser.add_argument("--remove", type=str, nargs="+", help="File names of ingested files to remove, e.g. '1926_combined.json'.", default=None)
+    status_parser.set_defaults(function=status)
+
+    args = parser.parse_args()
+    args.function(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,586 @@
+import os
+import json
+import time
+import fitz
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+import functools
+import contextlib
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import ocr
+import binarize_images
+from convert_pdf_to_jpg import render_ranges
+from combine_jsons import combine_directory
+from convert_json_to_csv import convert_json_to_csv
+from llm_cache import ResponseCache
+from journal import ProgressJournal
+from extract_people import extract_pages, process_pages_async, load_json, get_text, make_system_message
+from templates.prompt import prompt_template, packed_prompt_template
+from templates.json_schema import guided_json_schema, packed_json_schema
+
+
+STAGES = ["render", "binarize", "ocr", "extract", "combine", "csv"]
+
+# The parameters of every book, which can be set for all books and overridden per book in the configuration file
+DEFAULTS = {
+    "dpi": 200,
+    "threshold": 160,
+    "crop": 0.0,
+    "method": "global",
+    "auto_crop": False,
+    "language": "nld",
+    "config": 3,
+    "backend": "pytesseract",
+    "layout": False,
+    "region_threads": 1,
+    "start_page": 1,
+    "end_page": None,
+    "endpoints": ["http://localhost:8000/v1/"],
+    "api_key": "EMPTY",
+    "model": "meta-llama/Llama-3.1-8B-Instruct",
+    "concurrency": 1,
+    "timeout": 60.0,
+    "pack_tokens": 0,
+    "guided": False,
+    "max_tokens": None,
+    "fast_path_threshold": None,
+    "retries": 3,
+    "line_retries": 2,
+}
+
+# The parameters that determine the output of every stage, and are therefore part of its build key. Parameters that
+# only affect the speed, such as the number of workers or the LLM endpoints, are left out.
+STAGE_PARAMETERS = {
+    "render": ["dpi"],
+    "binarize": ["threshold", "crop", "method", "auto_crop"],
+    "ocr": ["language", "config", "backend", "layout"],
+    "extract": ["model", "pack_tokens", "guided", "max_tokens", "fast_path_threshold"],
+    "combine": [],
+    "csv": [],
+}
+
+# Number of pages rendered by a worker at a time, as in convert_pdf_to_jpg.py
+RENDER_CHUNK_SIZE = 16
+
+
+def build_key(stage, book, inputs):
+    """
+    Computes the build key of an artefact from the content hashes of its inputs and the parameters of its stage.
+
+    Args:
+        stage (str): The stage that builds the artefact.
+        book (dict): The parameters of the book.
+        inputs (list): The content hashes of the inputs of the artefact, and anything else that determines it.
+
+    Returns:
+        str: The SHA-256 hex digest identifying the artefact.
+    """
+    parameters = {name: book[name] for name in STAGE_PARAMETERS[stage]}
+    payload = json.dumps([stage, parameters, inputs], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def prompt_fingerprint():
+    """
+    Returns a hash of the prompts of `extract_people.py`, so that a changed prompt invalidates the extracted pages.
+    """
+    prompts = [make_system_message(), make_system_message(schema=guided_json_schema), make_system_message(schema=packed_json_schema), prompt_template, packed_prompt_template]
+    return hashlib.sha256(json.dumps(prompts).encode("utf-8")).hexdigest()
+
+
+def page_ranges(page_numbers, chunk_size=None):
+    """
+    Groups page numbers into ranges of consecutive pages.
+
+    Args:
+        page_numbers (list): The sorted page numbers.
+        chunk_size (int, optional): The maximum number of pages per range. Defaults to None (no limit).
+
+    Returns:
+        list: The (first page, last page + 1) of every range.
+    """
+    ranges = []
+    for page_number in page_numbers:
+        if ranges and ranges[-1][1] == page_number and (chunk_size is None or page_number - ranges[-1][0] < chunk_size):
+            ranges[-1] = (ranges[-1][0], page_number + 1)
+        else:
+            ranges.append((page_number, page_number + 1))
+    return ranges
+
+
+class BuildState:
+    """
+    Persistent record of the artefacts built by the pipeline, stored as JSON in the work directory.
+
+    For every artefact the state holds the build key it was built with, see `build_key`, and its content hash, size
+    and modification time. An artefact is up to date if it exists, was built with the current key and was not modified
+    since. Because build keys are computed from the content hashes of the inputs, an artefact that is rebuilt with the
+    same content does not make the artefacts built from it stale.
+
+    Args:
+        path (str): The path to the state file.
+
+    Notes:
+        - Files that are not built by the pipeline, such as the PDFs, are recorded without a key, so that they are only
+          hashed again after they change.
+        - The state is shared by the threads that build different books, and is saved after every stage.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def name(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def lookup(self, path):
+        """
+        Returns the entry of a file if the file has not been modified since it was recorded, or None otherwise.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(self.name(path))
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry
+        return None
+
+    def digest(self, path):
+        """
+        Returns the content hash of a file, and only hashes the file if it changed since it was recorded.
+        """
+        entry = self.lookup(path)
+        if entry:
+            return entry["hash"]
+        return self.record(path)
+
+    def is_fresh(self, path, key):
+        """
+        Returns whether a file exists, was built with the build key `key` and was not modified since.
+        """
+        entry = self.lookup(path)
+        return entry is not None and entry["key"] == key
+
+    def record(self, path, key=None):
+        """
+        Records that a file was built with the build key `key`, and returns its content hash.
+        """
+        stat = os.stat(path)
+        content_hash = ocr.hash_file(path)
+        with self.lock:
+            self.entries[self.name(path)] = {"key": key, "hash": content_hash, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+        return content_hash
+
+    def save(self):
+        """
+        Writes the state to a temporary file, which then replaces the state file.
+        """
+        with self.lock:
+            with tempfile.NamedTemporaryFile('w', dir=self.root, suffix='.tmp', delete=False, encoding='utf-8') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(f.name, self.path)
+
+
+class WorkerBudget:
+    """
+    Global budget of worker processes and threads, shared by the books that are built at the same time.
+
+    A stage reserves workers before it starts, and waits until enough workers are free. A stage never reserves more than
+    its share of the budget, so that every book that is being built can make progress.
+
+    Args:
+        workers (int): The total number of workers.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(workers, 1)
+        self.available = self.workers
+        self.active_books = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def book(self):
+        """
+        Counts a book as active while it is being built.
+        """
+        with self.condition:
+            self.active_books += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active_books -= 1
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, count):
+        """
+        Reserves up to `count` workers for a stage.
+
+        Args:
+            count (int): The number of workers the stage can use, e.g. the number of pages it has to process.
+
+        Yields:
+            int: The number of reserved workers, at least 1.
+        """
+        with self.condition:
+            share = max(self.workers // max(self.active_books, 1), 1)
+            count = max(min(count, share), 1)
+            self.condition.wait_for(lambda: self.available >= count)
+            self.available -= count
+        try:
+            yield count
+        finally:
+            with self.condition:
+                self.available += count
+                self.condition.notify_all()
+
+
+class Pipeline:
+    """
+    Incremental build of all stages of the pipeline, from the PDFs to the CSV files, for a set of books.
+
+    The stages form a chain for every book: the PDF is rendered to images, which are binarized and OCRed, the people
+    are extracted from the OCR text page by page, and the pages are combined into one JSON and converted to CSV. Every
+    artefact is rebuilt only if its build key changed, i.e. if the content of one of its inputs or a parameter of its
+    stage changed, see `BuildState`. Rendering, binarization and extraction are tracked per page, OCR, combining and
+    the conversion to CSV per book. Pages within an OCRed book are still reused through the OCR cache of `ocr.py`, and
+    lines within an extracted page through the LLM response cache.
+
+    Independent books are built at the same time, each in a thread of its own, and share one `WorkerBudget`.
+
+    Args:
+        work_dir (str): The directory in which all artefacts, the caches and the build state are stored.
+        books (dict): The parameters of every book, by name, see `DEFAULTS`. Every book needs a `pdf`.
+        workers (int): The total number of worker processes and threads.
+        until (str, optional): The last stage to build. Defaults to "csv".
+        force (list, optional): The stages to rebuild even if they are up to date. Defaults to None.
+        use_cache (bool, optional): Whether to use the OCR cache and the LLM response cache, which are stored in
+                                    `ocr_cache/` and `llm_cache/` in the work directory. Defaults to True.
+
+    Notes:
+        - The artefacts of book `<book>` are stored in the work directory as `images/<book>/`, `binarized/<book>/`,
+          `ocr/<book>.json`, `llm/<book>/`, `combined/<book>_combined.json` and `csv/<book>.csv`, the same names as
+          the scripts of the individual stages use.
+        - A stage that did not complete, e.g. because pages could not be OCRed or lines could not be extracted, stops
+          its book. The artefacts that were built are recorded, so the next run continues with the rest.
+        - Changes to the code of a stage are not detected; use `force` to rebuild a stage after such a change.
+        - The stages start their worker processes from the threads of the books. Forking a process that runs several
+          threads can copy locks that another thread holds, so `main` uses the spawn start method; other callers that
+          build several books at the same time should do the same.
+    """
+
+    def __init__(self, work_dir, books, workers, until="csv", force=None, use_cache=True):
+        self.work_dir = os.path.abspath(work_dir)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.books = books
+        self.stages = STAGES[:STAGES.index(until) + 1]
+        self.force = set(force or [])
+        self.use_cache = use_cache
+        self.state = BuildState(os.path.join(self.work_dir, "pipeline_state.json"))
+        self.budget = WorkerBudget(workers)
+        self.print_lock = threading.Lock()
+
+    def path(self, *parts):
+        return os.path.join(self.work_dir, *parts)
+
+    def log(self, name, message):
+        with self.print_lock:
+            print(f"[{name}] {message}")
+
+    def is_fresh(self, stage, path, key):
+        return stage not in self.force and self.state.is_fresh(path, key)
+
+    def render(self, name, book):
+        """
+        Renders the pages of the PDF that are not up to date, and returns the paths of all page images.
+        """
+        output_dir = self.path("images", name)
+        os.makedirs(output_dir, exist_ok=True)
+        with fitz.open(book["pdf"]) as doc:
+            page_count = doc.page_count
+        pdf_hash = self.state.digest(book["pdf"])
+
+        # Page numbers are zero-based, as in convert_pdf_to_jpg.py
+        images, keys, stale = [], {}, []
+        for page_number in range(page_count):
+            image_path = os.path.join(output_dir, f"{os.path.basename(book['pdf']).split('.')[0]}_page_{1 + page_number:04}.jpg")
+            keys[image_path] = build_key("render", book, [pdf_hash, page_number])
+            images.append(image_path)
+            if not self.is_fresh("render", image_path, keys[image_path]):
+                stale.append(page_number)
+
+        if stale:
+            tasks = [(book["pdf"], output_dir, first_page, last_page, 2, book["dpi"]) for first_page, last_page in page_ranges(stale, RENDER_CHUNK_SIZE)]
+            with self.budget.reserve(len(tasks)) as workers:
+                render_ranges(tasks, workers)
+            for page_number in stale:
+                if os.path.exists(images[page_number]):
+                    self.state.record(images[page_number], keys[images[page_number]])
+        self.log(name, f"render: {len(stale)} of {page_count} pages rebuilt")
+        return images if all(os.path.exists(image_path) for image_path in images) else None
+
+    def binarize(self, name, book, images):
+        """
+        Binarizes the page images that are not up to date, and returns the paths of all binarized images.
+        """
+        output_dir = self.path("binarized", name)
+        os.makedirs(output_dir, exist_ok=True)
+
+        binarized, keys, stale = [], {}, []
+        for image_path in images:
+            binarized_path = os.path.join(output_dir, f"binarized_{os.path.splitext(os.path.basename(image_path))[0]}.jpg")
+            keys[binarized_path] = build_key("binarize", book, [self.state.digest(image_path)])
+            binarized.append(binarized_path)
+            if not self.is_fresh("binarize", binarized_path, keys[binarized_path]):
+                stale.append((image_path, binarized_path))
+
+        if stale:
+            process = functools.partial(binarize_images.process_image, output_dir=output_dir, threshold=book["threshold"], crop=book["crop"], method=book["method"], auto_crop=book["auto_crop"])
+            with self.budget.reserve(len(stale)) as threads:
+                for _ in binarize_images.map_images(process, [image_path for image_path, _ in stale], threads):
+                    pass
+            for _, binarized_path in stale:
+                self.state.record(binarized_path, keys[binarized_path])
+        self.log(name, f"binarize: {len(stale)} of {len(images)} pages rebuilt")
+        return binarized
+
+    def ocr(self, name, book, binarized):
+        """
+        OCRs the binarized images if any of them changed, and returns the path of the OCR results.
+        """
+        output_dir = self.path("ocr")
+        output_path = os.path.join(output_dir, f"{name}.json")
+        key = build_key("ocr", book, [self.state.digest(binarized_path) for binarized_path in binarized])
+        if self.is_fresh("ocr", output_path, key):
+            self.log(name, "ocr: up to date")
+            return output_path
+
+        cache = ResponseCache(self.path("ocr_cache"), label="OCR cache") if self.use_cache else None
+        with self.budget.reserve(len(binarized)) as workers:
+            ocr.process_directory(self.path("binarized", name), output_dir, book["language"], book["config"], workers, book["backend"], False, book["layout"], book["region_threads"], cache)
+        if cache:
+            self.log(name, cache.stats())
+            cache.close()
+
+        # Pages that could not be OCRed are not recorded, see ocr.ocr_book
+        records_path = os.path.join(output_dir, f"{name}.jsonl")
+        recorded = {record["image"] for _, record in ocr.read_records(records_path)} if os.path.exists(records_path) else set()
+        if len(recorded) < len(binarized) or not os.path.exists(output_path):
+            self.log(name, f"ocr: {len(binarized) - len(recorded)} of {len(binarized)} pages could not be OCRed")
+            return None
+        self.state.record(output_path, key)
+        self.log(name, f"ocr: {len(binarized)} pages rebuilt")
+        return output_path
+
+    def extract(self, name, book, ocr_path):
+        """
+        Extracts the people of the pages whose OCR text changed, and returns the paths of all page JSONs.
+        """
+        output_dir = self.path("llm", name)
+        os.makedirs(output_dir, exist_ok=True)
+        data = load_json(ocr_path)
+        if not data:
+            return None
+        first_page = book["start_page"]
+        text_list = get_text(data, first_page, book["end_page"] or len(data["content"]))
+
+        # The pages are numbered as in extract_people.py, from `start_page` on
+        pages, keys, stale = [], {}, []
+        for page_number, text in enumerate(text_list, first_page):
+            page_path = os.path.join(output_dir, f"{name}_{page_number}.json")
+            keys[page_path] = build_key("extract", book, [hashlib.sha256(text.encode("utf-8")).hexdigest(), prompt_fingerprint()])
+            pages.append(page_path)
+            if not self.is_fresh("extract", page_path, keys[page_path]):
+                stale.append(page_number)
+
+        if stale:
+            cache = ResponseCache(self.path("llm_cache")) if self.use_cache else None
+            journal = ProgressJournal(os.path.join(output_dir, f"{name}_journal.jsonl"))
+            # The statistics are returned per call, so the books that are extracted at the same time do not share them
+            stats = Counter()
+            for start, stop in page_ranges(stale):
+                texts = text_list[start - first_page:stop - first_page]
+                if book["concurrency"] > 1:
+                    stats += asyncio.run(process_pages_async(texts, start, name, output_dir, book["endpoints"], book["api_key"], book["model"], book["concurrency"], book["timeout"], book["pack_tokens"], cache, journal, book["guided"], book["max_tokens"], book["fast_path_threshold"], book["retries"], book["line_retries"]))
+                else:
+                    stats += extract_pages(texts, start, name, output_dir, book["endpoints"], book["api_key"], book["model"], book["timeout"], book["pack_tokens"], cache, journal, book["guided"], book["max_tokens"], book["fast_path_threshold"], book["retries"], book["line_retries"])
+            journal.close()
+            self.log(name, f"extract: {stats['llm_lines']} lines sent to the LLM in {stats['requests']} requests, {stats['completion_tokens']} decoded tokens")
+            if cache:
+                self.log(name, cache.stats())
+                cache.close()
+
+            # Pages with lines that could not be extracted are saved, but not marked as done in the journal, so they
+            # stay stale and are extracted again by the next run
+            for page_number in stale:
+                if journal.is_page_done(page_number):
+                    page_path = pages[page_number - first_page]
+                    self.state.record(page_path, keys[page_path])
+            failed = [page_number for page_number in stale if not journal.is_page_done(page_number)]
+            if failed:
+                self.log(name, f"extract: {len(failed)} of {len(pages)} pages could not be extracted completely")
+                return None
+        self.log(name, f"extract: {len(stale)} of {len(pages)} pages rebuilt")
+        return pages
+
+    def combine(self, name, book, pages):
+        """
+        Combines the page JSONs if any of them changed, and returns the path of the combined JSON.
+        """
+        output_dir = self.path("combined")
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, f"{name}_combined.json")
+        key = build_key("combine", book, [self.state.digest(page_path) for page_path in pages])
+        if self.is_fresh("combine", output_path, key):
+            self.log(name, "combine: up to date")
+            return output_path
+
+        with self.budget.reserve(len(pages) // 1000 + 1) as workers:
+            output = combine_directory(self.path("llm", name), output_dir, workers)
+        if output is None:
+            return None
+        self.state.record(output_path, key)
+        self.log(name, "combine: rebuilt")
+        return output_path
+
+    def csv(self, name, book, combined_path):
+        """
+        Converts the combined JSON to CSV if it changed, and returns the path of the CSV file.
+        """
+        output_path = self.path("csv", f"{name}.csv")
+        key = build_key("csv", book, [self.state.digest(combined_path)])
+        if self.is_fresh("csv", output_path, key):
+            self.log(name, "csv: up to date")
+            return output_path
+
+        if not convert_json_to_csv(combined_path, output_path):
+            return None
+        self.state.record(output_path, key)
+        self.log(name, "csv: rebuilt")
+        return output_path
+
+    def build_book(self, name):
+        """
+        Builds the stages of a book one after another, and returns the last stage that was completed.
+        """
+        book = self.books[name]
+        artefact = None
+        completed = None
+        with self.budget.book():
+            for stage in self.stages:
+                try:
+                    if stage == "render":
+                        artefact = self.render(name, book)
+                    else:
+                        artefact = getattr(self, stage)(name, book, artefact)
+                except Exception as e:
+                    self.log(name, f"{stage}: failed: {e}")
+                    artefact = None
+                self.state.save()
+                if artefact is None:
+                    break
+                completed = stage
+        return completed
+
+    def run(self, parallel_books=1):
+        """
+        Builds all books, up to `parallel_books` at the same time.
+
+        Returns:
+            dict: The last completed stage of every book, or None if its first stage failed.
+        """
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max(parallel_books, 1)) as executor:
+            results = dict(zip(self.books, executor.map(self.build_book, self.books)))
+        elapsed = time.perf_counter() - start_time
+        complete = sum(stage == self.stages[-1] for stage in results.values())
+        print(f"Built {complete} of {len(results)} books up to '{self.stages[-1]}' in {elapsed:.1f} s")
+        for name, stage in results.items():
+            if stage != self.stages[-1]:
+                print(f"  {name}: stopped after {stage or 'nothing'}")
+        return results
+
+
+def load_books(input_path, config=None, only=None):
+    """
+    Finds the books to build and merges their parameters.
+
+    Args:
+        input_path (str): A single PDF, or a directory of PDFs.
+        config (dict, optional): The configuration file, with the parameters of all books under "defaults" and the
+                                 parameters of single books under "books", by book name. Defaults to None.
+        only (list, optional): The names of the books to build. Defaults to None (all books).
+
+    Returns:
+        dict: The parameters of every book, by name, in the order of the names.
+    """
+    config = config or {}
+    if os.path.isfile(input_path):
+        pdf_paths = [input_path]
+    else:
+        pdf_paths = [os.path.join(input_path, file) for file in os.listdir(input_path) if file.lower().endswith(".pdf")]
+
+    books = {}
+    for pdf_path in sorted(pdf_paths):
+        name = os.path.basename(pdf_path).split('.')[0]
+        if only and name not in only:
+            continue
+        books[name] = {**DEFAULTS, **config.get("defaults", {}), **config.get("books", {}).get(name, {}), "pdf": os.path.abspath(pdf_path)}
+    return books
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build all stages of the pipeline incrementally, from PDFs to CSV files.")
+    parser.add_argument("-c", "--config", type=str, help="Path to a JSON configuration file with the parameters of all books ('defaults') and of single books ('books'), and optionally 'input' and 'work_dir'.", default=None)
+    parser.add_argument("-i", "--input", type=str, help="Path to a single PDF, or a directory of PDFs. Overrides 'input' of the configuration file.", default=None)
+    parser.add_argument("-o", "--work_dir", type=str, help="Directory of all intermediate and final results and of the build state. Overrides 'work_dir' of the configuration file. Default: 'pipeline' in the current working directory.", default=None)
+    parser.add_argument("--only", type=str, nargs="+", help="Names of the books to build. Default: all PDFs of the input", default=None)
+    parser.add_argument("-u", "--until", type=str, choices=STAGES, help="Last stage to build, e.g. 'ocr' to build without an LLM server. Default: csv", default="csv")
+    parser.add_argument("-f", "--force", type=str, nargs="+", choices=STAGES, help="Stages to rebuild even if they are up to date, e.g. after changing their code.", default=None)
+    parser.add_argument("-w", "--workers", type=int, help="Total number of worker processes and threads shared by all books. Default: number of available CPUs", default=ocr.available_cpus())
+    parser.add_argument("-b", "--parallel_books", type=int, help="Number of books built at the same time. Default: 2", default=2)
+    parser.add_argument("--no_cache", action="store_true", help="Do not use the OCR and LLM caches in the work directory.")
+
+    args = parser.parse_args()
+
+    # The worker processes are started from the threads of the books, see `Pipeline`
+    multiprocessing.set_start_method("spawn")
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+
+    input_path = args.input or config.get("input")
+    if not input_path or not os.path.exists(input_path):
+        print(f"Error: The input path {input_path} does not exist or is not valid.")
+        exit(1)
+    work_dir = args.work_dir or config.get("work_dir") or "./pipeline"
+
+    books = load_books(input_path, config, args.only)
+    if not books:
+        print(f"Error: No PDF files found in {input_path}")
+        exit(1)
+    print(f"Building {len(books)} books in {os.path.abspath(work_dir)} with {args.workers} workers, {args.parallel_books} books at a time")
+
+    pipeline = Pipeline(work_dir, books, args.workers, args.until, args.force, not args.no_cache)
+    results = pipeline.run(args.parallel_books)
+    if any(stage != pipeline.stages[-1] for stage in results.values()):
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from extract_people import estimate_tokens, parse_line_rule_based
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # Every request is handled in its own thread. The default backlog of 5 connections refuses the connections of a
+    # client with many requests in flight.
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubLLMServer:
+    """
+    Local OpenAI-compatible server that answers the requests of `extract_people.py` without a GPU.
+
+    The server answers `/v1/chat/completions` with the persons that the rule-based parser of `extract_people.py` finds in
+    the records of the prompt, for single and packed requests, and `/v1/models` for the health checks of the
+    `AsyncClientPool`. Every response is delayed like the response of a served model: a fixed latency, plus the time to
+    read the prompt and to generate the reply at the configured token rates.
+
+    Args:
+        host (str, optional): The address to listen on. Defaults to "127.0.0.1".
+        port (int, optional): The port to listen on, or 0 for any free port. Defaults to 0.
+        latency (float, optional): The fixed delay of every response in seconds. Defaults to 0.05.
+        prompt_rate (float, optional): The number of prompt tokens read per second by a request. Defaults to 5000.
+        decode_rate (float, optional): The number of tokens generated per second by a request. Defaults to 50.
+        slots (int, optional): The number of requests processed at the same time, like the batch of a vLLM server. Other
+                               requests wait for a free slot. Defaults to 64.
+        error_rate (float, optional): The share of requests that fail with a 503 error. Defaults to 0.0.
+        model (str, optional): The name of the served model. Defaults to "meta-llama/Llama-3.1-8B-Instruct".
+
+    Notes:
+        - Token counts use `estimate_tokens` of `extract_people.py`, so they match its packing and usage statistics.
+        - The number of requests and tokens is counted, and can be read with `stats` or from `/stats`.
+        - Use `start` to serve in a background thread, e.g. in a benchmark, and `stop` to shut the server down. A stopped
+          server drops the requests in progress and on open connections without a response, like a server that crashed,
+          so clients can be tested to fail over to other servers.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.05, prompt_rate=5000, decode_rate=50, slots=64, error_rate=0.0, model="meta-llama/Llama-3.1-8B-Instruct"):
+        self.latency = latency
+        self.prompt_rate = prompt_rate
+        self.decode_rate = decode_rate
+        self.error_rate = error_rate
+        self.model = model
+        self.slots = threading.BoundedSemaphore(slots)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.server = StubHTTPServer((host, port), self.make_handler())
+        self.thread = None
+        self.stopped = False
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up on the request, e.g. after a timeout or a cancelled extraction
+                    self.close_connection = True
+
+            def drop(self):
+                # Closes the connection without a response, like a server that crashed
+                self.close_connection = True
+
+            def do_GET(self):
+                if stub.stopped:
+                    self.drop()
+                elif self.path.rstrip("/").endswith("/models"):
+                    self.send_json(200, {"object": "list", "data": [{"id": stub.model, "object": "model", "owned_by": "stub"}]})
+                elif self.path.rstrip("/").endswith("/stats"):
+                    self.send_json(200, stub.stats())
+                else:
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def do_POST(self):
+                if stub.stopped:
+                    self.drop()
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    request = json.loads(self.rfile.read(length))
+                except json.JSONDecodeError:
+                    self.send_json(400, {"error": {"message": "Invalid JSON"}})
+                    return
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                status, response = stub.complete(request)
+                if stub.stopped:
+                    self.drop()
+                    return
+                self.send_json(status, response)
+
+        return Handler
+
+    @staticmethod
+    def reply(prompt):
+        """
+        Answers a prompt of `extract_people.py` with the persons of its records.
+
+        Args:
+            prompt (str): The human message, see `templates/prompt.py`.
+
+        Returns:
+            str: A JSON object for a single record, or a JSON array with the `record` number of every person for a
+                 packed request.
+        """
+        packed = re.findall(r"^(\d+)\. (.*)$", prompt, re.MULTILINE) if "Records:" in prompt else None
+        if packed is None:
+            match = re.search(r"Record: (.*)", prompt)
+            record = match.group(1).strip() if match else ""
+            persons, _ = parse_line_rule_based(record)
+            return json.dumps(persons[0] if persons else {"name": record, "jobTitle": "", "address": ""}, ensure_ascii=False)
+
+        reply = []
+        for number, record in packed:
+            persons, _ = parse_line_rule_based(record)
+            for person in persons or [{"name": record.strip(), "jobTitle": "", "address": ""}]:
+                reply.append({"record": int(number), **person})
+        return json.dumps(reply, ensure_ascii=False)
+
+    def complete(self, request):
+        """
+        Answers a chat completion request after the delay of a served model.
+
+        Args:
+            request (dict): The body of the request.
+
+        Returns:
+            tuple: The HTTP status and the body of the response, or (None, None) if the server was stopped meanwhile.
+        """
+        messages = request.get("messages", [])
+        prompt = "\n".join(str(message.get("content", "")) for message in messages)
+        human = str(messages[-1].get("content", "")) if messages else ""
+        content = self.reply(human)
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(content)
+        if request.get("max_tokens"):
+            completion_tokens = min(completion_tokens, request["max_tokens"])
+
+        with self.slots:
+            if self.error_rate and random.random() < self.error_rate:
+                with self.lock:
+                    self.counts["requests"] += 1
+                    self.counts["errors"] += 1
+                return 503, {"error": {"message": "Stub server is busy", "type": "server_error"}}
+            time.sleep(self.latency + prompt_tokens / self.prompt_rate + completion_tokens / self.decode_rate)
+        if self.stopped:
+            return None, None
+
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts["prompt_tokens"] += prompt_tokens
+            self.counts["completion_tokens"] += completion_tokens
+        return 200, {
+            "id": f"chatcmpl-stub-{self.counts['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", self.model),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def stats(self):
+        """
+        Returns the number of requests, failed requests, and prompt and completion tokens served so far.
+        """
+        with self.lock:
+            return dict(self.counts)
+
+    def start(self):
+        """
+        Serves requests in a background thread, and returns the base URL of the server.
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.stopped = True
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local OpenAI-compatible stub of the LLM for testing and benchmarking extract_people.py.")
+    parser.add_argument("--host", type=str, help="Address to listen on. Default: 127.0.0.1", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, help="Port to listen on. Default: 8000", default=8000)
+    parser.add_argument("-l", "--latency", type=float, help="Fixed delay of every response in seconds. Default: 0.05", default=0.05)
+    parser.add_argument("--prompt_rate", type=float, help="Prompt tokens read per second by a request. Default: 5000", default=5000)
+    parser.add_argument("--decode_rate", type=float, help="Tokens generated per second by a request. Default: 50", default=50)
+    parser.add_argument("-s", "--slots", type=int, help="Number of requests processed at the same time. Default: 64", default=64)
+    parser.add_argument("-e", "--error_rate", type=float, help="Share of requests (0-1) that fail with a 503 error. Default: 0", default=0.0)
+
+    args = parser.parse_args()
+
+    stub = StubLLMServer(args.host, args.port, args.latency, args.prompt_rate, args.decode_rate, args.slots, args.error_rate)
+    print(f"Stub LLM server on {stub.url} (latency {args.latency} s, {args.prompt_rate:g} prompt and {args.decode_rate:g} completion tokens/s per request, {args.slots} slots)")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(stub.stats())
+    stub.server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -11,4 +11,66 @@ Respond **ONLY** in valid JSON format, according to the following JSON schema:
 
 
 Do NOT include the schema in your reply. Do NOT include any additional text outside of the JSON object.
-"""
\ No newline at end of file
+"""
+
+guided_json_schema = """
+Respond **ONLY** with a valid JSON array. For every person found in the record, add one object to the array according to the following JSON schema:
+  {
+    "name": "",
+    "jobTitle": "",
+    "address": ""
+  },
+    "required": ["name", "jobTitle", "address"],
+    "additionalProperties": false
+  }
+
+
+Do NOT include the schema in your reply. Do NOT include any additional text outside of the JSON array.
+"""
+
+packed_json_schema = """
+Respond **ONLY** with a valid JSON array. The input contains numbered records. For every person found in record N, add one object to the array according to the following JSON schema:
+  {
+    "record": N,
+    "name": "",
+    "jobTitle": "",
+    "address": ""
+  },
+    "required": ["record", "name", "jobTitle", "address"],
+    "additionalProperties": false
+  }
+
+
+Do NOT include the schema in your reply. Do NOT include any additional text outside of the JSON array.
+"""
+
+
+person_list_json_schema = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "jobTitle": {"type": "string"},
+            "address": {"type": "string"}
+        },
+        "required": ["name", "jobTitle", "address"],
+        "additionalProperties": False
+    }
+}
+
+
+packed_person_list_json_schema = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "record": {"type": "integer"},
+            "name": {"type": "string"},
+            "jobTitle": {"type": "string"},
+            "address": {"type": "string"}
+        },
+        "required": ["record", "name", "jobTitle", "address"],
+        "additionalProperties": False
+    }
+}
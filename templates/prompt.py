@@ -2,4 +2,11 @@ prompt_template = """
 Record: {record}
 
 Please extract the relavent information from the given record.
-"""
\ No newline at end of file
+"""
+
+packed_prompt_template = """
+Records:
+{records}
+
+Please extract the relavent information from each of the given records.
+"""
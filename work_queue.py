@@ -0,0 +1,520 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import functools
+import contextlib
+from collections import Counter
+from llm_cache import ResponseCache
+from journal import ProgressJournal
+from client_pool import load_endpoints
+from extract_people import extract_pages, process_pages_async, load_json, get_text
+
+
+def write_json(path, data):
+    """
+    Writes a JSON file atomically, so that other workers never read a partially written file.
+    """
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False, encoding='utf-8') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, path)
+
+
+def read_json(path):
+    """
+    Reads a JSON file, or returns None if it does not exist or was removed while it was read.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class WorkQueue:
+    """
+    Queue of page ranges to extract, shared by any number of workers through a shared file system.
+
+    The queue is a directory without a central service. Every unit of work, a range of pages of one book, is a file in
+    `units/`. A worker leases a unit by creating a lease file `leases/<unit>.<generation>.lease` with
+    `O_CREAT | O_EXCL`, which succeeds for exactly one worker, also over NFS. While it works on the unit, the worker
+    renews the lease by touching the lease file. A lease that was not renewed for `lease_seconds` belongs to a dead
+    worker, and is superseded by the next worker that comes across it by creating the lease of the next generation. A
+    finished unit gets a marker in `done/`.
+
+    Args:
+        queue_dir (str): The directory of the queue.
+
+    Notes:
+        - Expired leases are never renamed or overwritten, only superseded, so a live worker can never lose its lease
+          to a race between two workers that reclaim the same expired lease.
+        - A worker checks that its lease is still the current lease of its unit every time it renews the lease, so a
+          worker that was presumed dead notices that it lost its unit, and stops working on it.
+        - A unit is only marked as done by the worker that holds its current lease.
+        - Every attempt at a unit is recorded in `attempts/`. Units that failed `max_attempts` times are not leased
+          again and are reported as failed.
+        - The expiry of a lease is judged from the modification time of its file, so the clocks of the nodes must agree
+          to within a small fraction of `lease_seconds`.
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = os.path.abspath(queue_dir)
+        settings = read_json(os.path.join(self.queue_dir, "queue.json"))
+        if settings is None:
+            raise FileNotFoundError(f"No work queue found in {self.queue_dir}")
+        self.lease_seconds = settings["lease_seconds"]
+        self.max_attempts = settings["max_attempts"]
+
+    @classmethod
+    def create(cls, queue_dir, units, lease_seconds=600, max_attempts=3):
+        """
+        Creates a queue, or adds units to an existing queue.
+
+        Args:
+            queue_dir (str): The directory of the queue.
+            units (list): The units, as dictionaries with an `id` and everything a worker needs to process the unit.
+            lease_seconds (float, optional): The time in seconds after which a lease that was not renewed expires.
+                                             Defaults to 600.
+            max_attempts (int, optional): The number of attempts after which a unit is given up. Defaults to 3.
+
+        Returns:
+            WorkQueue: The queue.
+        """
+        for directory in ("units", "leases", "done", "attempts"):
+            os.makedirs(os.path.join(queue_dir, directory), exist_ok=True)
+        if not os.path.exists(os.path.join(queue_dir, "queue.json")):
+            write_json(os.path.join(queue_dir, "queue.json"), {"lease_seconds": lease_seconds, "max_attempts": max_attempts})
+        for unit in units:
+            unit_path = os.path.join(queue_dir, "units", f"{unit['id']}.json")
+            if not os.path.exists(unit_path):
+                write_json(unit_path, unit)
+        return cls(queue_dir)
+
+    def path(self, directory, unit_id, suffix=".json"):
+        return os.path.join(self.queue_dir, directory, unit_id + suffix)
+
+    def unit_ids(self):
+        return sorted(os.path.splitext(file)[0] for file in os.listdir(os.path.join(self.queue_dir, "units")) if file.endswith(".json"))
+
+    def attempts(self):
+        """
+        Returns the number of attempts at every unit, listing the directory once instead of once per unit.
+        """
+        # The files are named `<unit>.<generation>.<uuid>`, and the unit id itself may contain dots
+        return Counter(file.rsplit(".", 2)[0] for file in os.listdir(os.path.join(self.queue_dir, "attempts")))
+
+    def done(self):
+        return {os.path.splitext(file)[0] for file in os.listdir(os.path.join(self.queue_dir, "done")) if file.endswith(".json")}
+
+    def is_done(self, unit_id):
+        return os.path.exists(self.path("done", unit_id))
+
+    def leases(self):
+        """
+        Returns the current lease of every leased unit: the lease with the highest generation.
+
+        Returns:
+            dict: The (generation, path) of the current lease, by unit id.
+        """
+        leases = {}
+        leases_dir = os.path.join(self.queue_dir, "leases")
+        for file in os.listdir(leases_dir):
+            # Split from the right, because the unit id is the name of the book, which may contain dots
+            parts = file.rsplit(".", 2)
+            if len(parts) != 3 or parts[2] != "lease" or not parts[1].isdigit():
+                continue
+            unit_id, generation = parts[0], int(parts[1])
+            if generation > leases.get(unit_id, (-1, None))[0]:
+                leases[unit_id] = (generation, os.path.join(leases_dir, file))
+        return leases
+
+    def lease_path(self, unit_id, token):
+        # The token starts with the generation of the lease
+        return self.path("leases", unit_id, f".{token.split('.')[0]}.lease")
+
+    def is_expired(self, lease_path):
+        """
+        Returns whether a lease was not renewed for `lease_seconds`, or None if the lease no longer exists.
+        """
+        try:
+            return time.time() - os.stat(lease_path).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return None
+
+    def acquire(self, worker):
+        """
+        Leases the first unit that is not done, not leased by a live worker and not given up.
+
+        Args:
+            worker (str): The name of the worker, for `status`.
+
+        Returns:
+            tuple: The unit and the token of the lease, or (None, None) if no unit is available.
+        """
+        done, attempts, leases = self.done(), self.attempts(), self.leases()
+        for unit_id in self.unit_ids():
+            if unit_id in done or attempts[unit_id] >= self.max_attempts:
+                continue
+            generation, current_path = leases.get(unit_id, (-1, None))
+            if current_path and self.is_expired(current_path) is False:
+                continue
+
+            # Creating the lease of the next generation succeeds for exactly one worker, and supersedes the expired lease
+            token = f"{generation + 1}.{uuid.uuid4().hex}"
+            lease_path = self.lease_path(unit_id, token)
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({"worker": worker, "token": token, "acquired": time.time()}, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Another worker may have superseded the lease from a newer listing, or finished the unit while its lease
+            # expired
+            if not self.owns(unit_id, token) or self.is_done(unit_id):
+                os.remove(lease_path)
+                continue
+            if current_path:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(current_path)
+            open(self.path("attempts", unit_id, f".{token}"), 'w').close()
+            return read_json(self.path("units", unit_id)), token
+        return None, None
+
+    def owns(self, unit_id, token):
+        """
+        Returns whether a lease is still the current lease of its unit.
+        """
+        lease_path = self.lease_path(unit_id, token)
+        current = self.leases().get(unit_id)
+        lease = read_json(lease_path)
+        return current is not None and current[1] == lease_path and lease is not None and lease["token"] == token
+
+    def renew(self, unit_id, token):
+        """
+        Renews a lease. Returns False if the lease was lost to another worker.
+        """
+        try:
+            os.utime(self.lease_path(unit_id, token))
+        except FileNotFoundError:
+            return False
+        return self.owns(unit_id, token)
+
+    def release(self, unit_id, token):
+        """
+        Gives up a lease, so that another worker can lease the unit.
+        """
+        lease_path = self.lease_path(unit_id, token)
+        lease = read_json(lease_path)
+        if lease is not None and lease["token"] == token:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(lease_path)
+
+    def complete(self, unit_id, token, result):
+        """
+        Marks a unit as done and releases its lease.
+
+        Args:
+            unit_id (str): The id of the unit.
+            token (str): The token of the lease.
+            result (dict): Information about the work, stored in the marker.
+
+        Returns:
+            bool: True if the unit was marked as done, False if the lease was lost to another worker, whose marker is
+                  then left alone.
+        """
+        if not self.owns(unit_id, token):
+            return False
+        write_json(self.path("done", unit_id), result)
+        self.release(unit_id, token)
+        return True
+
+    def is_finished(self):
+        """
+        Returns whether every unit is either done or given up.
+        """
+        done, attempts = self.done(), self.attempts()
+        return all(unit_id in done or attempts[unit_id] >= self.max_attempts for unit_id in self.unit_ids())
+
+    def status(self):
+        """
+        Returns the state of every unit.
+
+        Returns:
+            list: A list of (unit, state, lease, attempts) tuples, where the state is "done", "leased", "expired",
+                  "failed" or "pending", and the lease is the content of the lease file or None.
+        """
+        states = []
+        done, attempts, leases = self.done(), self.attempts(), self.leases()
+        for unit_id in self.unit_ids():
+            unit = read_json(self.path("units", unit_id))
+            lease_path = leases.get(unit_id, (None, None))[1]
+            lease = read_json(lease_path) if lease_path else None
+            if unit_id in done:
+                state = "done"
+            elif lease is not None:
+                state = "expired" if self.is_expired(lease_path) else "leased"
+            elif attempts[unit_id] >= self.max_attempts:
+                state = "failed"
+            else:
+                state = "pending"
+            states.append((unit, state, lease, attempts[unit_id]))
+        return states
+
+
+class LeaseKeeper:
+    """
+    Renews a lease in a background thread while its unit is processed.
+
+    When a renewal finds that the lease was lost to another worker, the `lost` event is set, which stops
+    `process_unit`.
+
+    Args:
+        queue (WorkQueue): The queue.
+        unit_id (str): The id of the unit.
+        token (str): The token of the lease.
+    """
+
+    def __init__(self, queue, unit_id, token):
+        self.queue = queue
+        self.unit_id = unit_id
+        self.token = token
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        # Renewing three times per lease period leaves room for a slow file system
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.renew(self.unit_id, self.token):
+                self.lost.set()
+                print(f"Lost the lease of {self.unit_id} to another worker")
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+def make_units(input_paths, output_dir, unit_pages=20, start_page=1, end_page=None, books=None):
+    """
+    Splits the pages of OCR results into units of work.
+
+    Args:
+        input_paths (list): The paths to the OCR results, the `<book>.json` files of `ocr.py`.
+        output_dir (str): The directory in which the page JSONs of every book are saved, in `<output_dir>/<book>/`.
+        unit_pages (int, optional): The number of pages per unit. Defaults to 20.
+        start_page (int, optional): The first page of every book. Defaults to 1.
+        end_page (int, optional): The last page of every book. Defaults to None (the last page of the OCR results).
+        books (dict, optional): The `start_page` and `end_page` of single books, by name. Defaults to None.
+
+    Returns:
+        list: The units, with the input, output directory, book name and page range of every unit.
+    """
+    units = []
+    for input_path in input_paths:
+        name = os.path.splitext(os.path.basename(input_path))[0]
+        data = load_json(input_path)
+        if not data:
+            continue
+        book = (books or {}).get(name, {})
+        first_page = book.get("start_page", start_page)
+        last_page = min(book.get("end_page", end_page) or len(data["content"]), len(data["content"]))
+        for unit_start in range(first_page, last_page + 1, unit_pages):
+            unit_end = min(unit_start + unit_pages - 1, last_page)
+            units.append({
+                "id": f"{name}_{unit_start:05}-{unit_end:05}",
+                "input": os.path.abspath(input_path),
+                "output": os.path.join(os.path.abspath(output_dir), name),
+                "name": name,
+                "start_page": unit_start,
+                "end_page": unit_end,
+            })
+    return units
+
+
+@functools.lru_cache(maxsize=4)
+def load_pages(input_path):
+    """
+    Loads the OCR results of a book once per worker, instead of once per unit.
+    """
+    return load_json(input_path)
+
+
+def process_unit(unit, args, endpoints, cache, stop=None):
+    """
+    Extracts the people of the pages of a unit, exactly like `extract_people.py` for the same page range.
+
+    Once `stop` is set, e.g. by a `LeaseKeeper` that lost its lease, no further page is started or saved.
+
+    Returns:
+        bool: True if every page of the unit was saved without failed lines.
+    """
+    os.makedirs(unit["output"], exist_ok=True)
+    text_list = get_text(load_pages(unit["input"]), unit["start_page"], unit["end_page"])
+
+    # Every unit has a journal of its own, so a unit that is reclaimed continues where its previous worker stopped
+    journal_path = os.path.join(unit["output"], f"{unit['id']}_journal.jsonl")
+    journal = ProgressJournal(journal_path, resume=True)
+    if args.concurrency > 1:
+        asyncio.run(process_pages_async(text_list, unit["start_page"], unit["name"], unit["output"], endpoints, args.api_key, args.model, args.concurrency, args.timeout, args.pack_tokens, cache, journal, args.guided, args.max_tokens, args.fast_path_threshold, args.retries, args.line_retries, stop=stop))
+    else:
+        extract_pages(text_list, unit["start_page"], unit["name"], unit["output"], endpoints, args.api_key, args.model, args.timeout, args.pack_tokens, cache, journal, args.guided, args.max_tokens, args.fast_path_threshold, args.retries, args.line_retries, stop)
+    journal.close()
+    return all(journal.is_page_done(page_number) for page_number in range(unit["start_page"], unit["start_page"] + len(text_list)))
+
+
+def work(args):
+    queue = WorkQueue(args.queue)
+    worker = args.worker or f"{socket.gethostname()}-{os.getpid()}"
+    endpoints = load_endpoints(args.endpoints_file) if args.endpoints_file else args.endpoints
+    cache = None if args.no_cache else ResponseCache(args.cache_dir, args.cache_size)
+    print(f"Worker {worker} on {queue.queue_dir}, LLM endpoints: {', '.join(endpoints)}")
+
+    completed = failed = lost = 0
+    while True:
+        unit, token = queue.acquire(worker)
+        if unit is None:
+            # Units leased by other workers may still come back if those workers die
+            if queue.is_finished() or not args.wait:
+                break
+            time.sleep(args.poll)
+            continue
+
+        print(f"Processing {unit['id']} (pages {unit['start_page']}-{unit['end_page']} of {unit['name']})")
+        start_time = time.perf_counter()
+        keeper = LeaseKeeper(queue, unit["id"], token)
+        try:
+            with keeper:
+                success = process_unit(unit, args, endpoints, cache, keeper.lost)
+        except Exception as e:
+            print(f"Error processing {unit['id']}: {e}")
+            success = False
+
+        if keeper.lost.is_set():
+            # The unit belongs to another worker now, which also completes or releases it
+            print(f"Stopped processing {unit['id']} after losing its lease")
+            lost += 1
+        elif success:
+            if queue.complete(unit["id"], token, {"worker": worker, "seconds": time.perf_counter() - start_time, "finished": time.time()}):
+                completed += 1
+            else:
+                print(f"Lost the lease of {unit['id']} to another worker before it was marked as done")
+                lost += 1
+        else:
+            # The pages that were saved are in the journal of the unit, so the next attempt only does the rest
+            queue.release(unit["id"], token)
+            failed += 1
+
+    print(f"Worker {worker} finished: {completed} units completed, {failed} units released after errors, {lost} units lost to other workers")
+    if cache:
+        print(cache.stats())
+        cache.close()
+
+
+def init(args):
+    config = {}
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+
+    input_paths = []
+    for input_path in args.input:
+        if os.path.isdir(input_path):
+            input_paths.extend(sorted(os.path.join(input_path, file) for file in os.listdir(input_path) if file.endswith(".json")))
+        else:
+            input_paths.append(input_path)
+
+    units = make_units(input_paths, args.output, args.unit_pages, args.start_page, args.end_page, config.get("books"))
+    queue = WorkQueue.create(args.queue, units, args.lease_seconds, args.max_attempts)
+    print(f"Work queue {queue.queue_dir}: {len(queue.unit_ids())} units of at most {args.unit_pages} pages")
+
+
+def status(args):
+    queue = WorkQueue(args.queue)
+    states = queue.status()
+    units = Counter(state for _, state, _, _ in states)
+    pages = Counter()
+    for unit, state, _, _ in states:
+        pages[state] += unit["end_page"] - unit["start_page"] + 1
+    total_pages = sum(pages.values())
+    done_share = 100 * pages["done"] / total_pages if total_pages else 0.0
+
+    print(f"Work queue: {queue.queue_dir}")
+    print(f"Units: {len(states)} total, " + ", ".join(f"{units[state]} {state}" for state in ("done", "leased", "expired", "pending", "failed")))
+    print(f"Pages: {pages['done']} of {total_pages} done ({done_share:.1f}%)")
+
+    books = {}
+    for unit, state, _, _ in states:
+        books.setdefault(unit["name"], Counter())[state] += 1
+    for name, counts in books.items():
+        print(f"  {name}: {counts['done']} of {sum(counts.values())} units done")
+
+    for unit, state, lease, attempts in states:
+        if state in ("leased", "expired"):
+            print(f"  {unit['id']}: {state} by {lease['worker']} since {time.ctime(lease['acquired'])} (attempt {attempts})")
+        elif state == "failed":
+            print(f"  {unit['id']}: failed after {attempts} attempts")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the extraction of people over any number of workers with a work queue on a shared file system.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init", help="Create a work queue, or add units to an existing one.")
+    init_parser.add_argument("-q", "--queue", type=str, required=True, help="Directory of the work queue, on a file system shared by all workers.")
+    init_parser.add_argument("-i", "--input", type=str, nargs="+", required=True, help="OCR results of ocr.py: one or more JSON files, or directories of JSON files.")
+    init_parser.add_argument("-o", "--output", type=str, required=True, help="Directory in which the page JSONs of every book are saved, in a subdirectory per book.")
+    init_parser.add_argument("-u", "--unit_pages", type=int, help="Number of pages per unit of work. Default: 20", default=20)
+    init_parser.add_argument("-s", "--start_page", type=int, help="First page of every book. Default: 1", default=1)
+    init_parser.add_argument("-e", "--end_page", type=int, help="Last page of every book. Default: the last page", default=None)
+    init_parser.add_argument("-c", "--config", type=str, help="JSON file with the 'start_page' and 'end_page' of single books under 'books', as for pipeline.py.", default=None)
+    init_parser.add_argument("--lease_seconds", type=float, help="Time after which the unit of a worker that stopped renewing its lease is given to another worker. Default: 600", default=600)
+    init_parser.add_argument("--max_attempts", type=int, help="Number of attempts after which a unit is given up. Default: 3", default=3)
+    init_parser.set_defaults(function=init)
+
+    work_parser = subparsers.add_parser("work", help="Process units until the queue is empty.")
+    work_parser.add_argument("-q", "--queue", type=str, required=True, help="Directory of the work queue.")
+    work_parser.add_argument("--worker", type=str, help="Name of the worker in the status. Default: <hostname>-<pid>", default=None)
+    work_parser.add_argument("--wait", action="store_true", help="Keep polling while units are leased by other workers, to take over the units of workers that die.")
+    work_parser.add_argument("--poll", type=float, help="Seconds between polls with --wait. Default: 30", default=30)
+    work_parser.add_argument("-n", "--concurrency", type=int, help="Maximum number of LLM requests in flight, see extract_people.py. Default: 1", default=1)
+    work_parser.add_argument("-p", "--pack_tokens", type=int, help="Token budget for packing several lines into one LLM request. Default: 0", default=0)
+    work_parser.add_argument("-g", "--guided", action="store_true", help="Use schema-guided decoding, see extract_people.py.")
+    work_parser.add_argument("-m", "--max_tokens", type=int, help="Maximum number of tokens the LLM may generate per line. Default: no limit", default=None)
+    work_parser.add_argument("-f", "--fast_path_threshold", type=float, help="Confidence threshold of the rule-based parser, see extract_people.py. Default: send all lines to the LLM", default=None)
+    work_parser.add_argument("--cache_dir", type=str, help="Directory of the LLM response cache. Use a directory on the local disk of the node. Default: 'llm_cache' in the current working directory.", default="./llm_cache")
+    work_parser.add_argument("--cache_size", type=float, help="Maximum size of the LLM response cache in MB. Default: 1024", default=1024)
+    work_parser.add_argument("--no_cache", action="store_true", help="Do not read from or write to the LLM response cache.")
+    work_parser.add_argument("--endpoints", type=str, nargs="+", help="Base URLs of one or more LLM servers. Default: http://localhost:8000/v1/", default=["http://localhost:8000/v1/"])
+    work_parser.add_argument("--endpoints_file", type=str, help="Path to a file with the base URL of one LLM server per line, instead of --endpoints.", default=None)
+    work_parser.add_argument("--model", type=str, help="Name of the served model. Default: meta-llama/Llama-3.1-8B-Instruct", default="meta-llama/Llama-3.1-8B-Instruct")
+    work_parser.add_argument("--api_key", type=str, help="API key of the LLM servers. Default: EMPTY", default="EMPTY")
+    work_parser.add_argument("-t", "--timeout", type=float, help="Timeout per LLM request in seconds. Default: 60", default=60.0)
+    work_parser.add_argument("--retries", type=int, help="Number of retries of an LLM request. Default: 3", default=3)
+    work_parser.add_argument("--line_retries", type=int, help="Number of rounds in which the failed lines of a page are sent again. Default: 2", default=2)
+    work_parser.set_defaults(function=work)
+
+    status_parser = subparsers.add_parser("status", help="Show the progress of the work queue.")
+    status_parser.add_argument("-q", "--queue", type=str, required=True, help="Directory of the work queue.")
+    status_parser.set_defaults(function=status)
+
+    args = parser.parse_args()
+    args.function(args)
+
+if __name__ == "__main__":
+    main()